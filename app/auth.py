@@ -1,9 +1,14 @@
+import hashlib
 import jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from dotenv import load_dotenv
 import os
 
+from database import AsyncSessionLocal
+from models import User
+from utils.ttl_cache import TTLCache
+
 load_dotenv()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -11,17 +16,63 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+
+# Проверенные claims по SHA-256 токена и загруженные пользователи по id
+claims_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+users_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Не удалось проверить учетные данные",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if user_id is None:
-            raise credentials_exception
-        return user_id
-    except jwt.PyJWTError:
-        raise credentials_exception
+
+
+def decode_token(token: str) -> dict:
+    key = hashlib.sha256(token.encode()).digest()
+    payload = claims_cache.get(key)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except jwt.PyJWTError:
+            raise _credentials_exception()
+        # Запись не переживает exp токена
+        claims_cache.set(key, payload, payload.get("exp"))
+    return payload
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    user_id = decode_token(token).get("user_id")
+    if user_id is None:
+        raise _credentials_exception()
+    return user_id
+
+
+async def resolve_user(user_id: int):
+    user = users_cache.get(user_id)
+    if user is None:
+        async with AsyncSessionLocal() as db:
+            user = await db.get(User, user_id)
+            if user is None:
+                return None
+            # Объект отвязывается от сессии и дальше используется только для чтения
+            db.expunge(user)
+        users_cache.set(user_id, user)
+    return user
+
+
+async def get_current_user_record(user_id: int = Depends(get_current_user)) -> User:
+    user = await resolve_user(user_id)
+    if user is None:
+        raise _credentials_exception()
+    return user
+
+
+def invalidate_user(user_id: int):
+    # Вызывать после изменения или удаления строки users: его токены будут проверены заново
+    users_cache.pop(user_id)
+    claims_cache.discard_where(lambda payload: payload.get("user_id") == user_id)
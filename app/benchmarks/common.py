@@ -0,0 +1,126 @@
+import contextlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import jwt
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_SECRET_KEY = "benchmark-secret"
+
+
+def make_token(user_id: int, secret_key: str = BENCH_SECRET_KEY) -> str:
+    return jwt.encode(
+        {"user_id": user_id, "exp": datetime.utcnow() + timedelta(hours=1)},
+        secret_key,
+        algorithm="HS256"
+    )
+
+
+def percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def latency_summary(values_ms) -> dict:
+    return {
+        "count": len(values_ms),
+        "p50_ms": round(percentile(values_ms, 0.50), 3),
+        "p99_ms": round(percentile(values_ms, 0.99), 3),
+        "max_ms": round(max(values_ms), 3) if values_ms else 0.0,
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def default_database_url() -> str:
+    path = os.path.join(tempfile.mkdtemp(prefix="chat-bench-"), "bench.db")
+    return f"sqlite:///{path}"
+
+
+def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.5):
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"Server did not start on port {port}")
+
+
+@contextlib.contextmanager
+def run_server(database_url: str, port: int, extra_env: dict = None, app: str = "main:app"):
+    env = dict(os.environ, DATABASE_URL=database_url, SECRET_KEY=BENCH_SECRET_KEY)
+    env.update(extra_env or {})
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--port", str(port), "--log-level", "warning"],
+        cwd=APP_DIR,
+        env=env,
+    )
+    try:
+        wait_for_port(port)
+        yield process
+    finally:
+        process.terminate()
+        with contextlib.suppress(subprocess.TimeoutExpired):
+            process.wait(timeout=10)
+        if process.poll() is None:
+            process.kill()
+
+
+def seed_direct_history(database_url: str, user_a: int, user_b: int, count: int, batch_size: int = 10000):
+    from sqlalchemy import create_engine, insert
+
+    from models import Base, ContentType, Message, MessageStatus
+
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        for start in range(0, count, batch_size):
+            rows = []
+            for i in range(start, min(count, start + batch_size)):
+                sender, receiver = (user_a, user_b) if i % 2 else (user_b, user_a)
+                rows.append({
+                    "sender_id": sender,
+                    "receiver_id": receiver,
+                    "content": f"history message {i}",
+                    "content_type": ContentType.TEXT,
+                    "timestamp": now - timedelta(seconds=count - i),
+                    "status": MessageStatus.READ,
+                })
+            conn.execute(insert(Message), rows)
+    engine.dispose()
+
+
+def seed_users(database_url: str, usernames, password: str):
+    from passlib.context import CryptContext
+    from sqlalchemy import create_engine, insert
+
+    from models import Base, User
+
+    # Один хэш на всех: стоимость проверки bcrypt от этого не меняется
+    hashed_password = CryptContext(schemes=["bcrypt"]).hash(password)
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {"username": username, "hashed_password": hashed_password} for username in usernames
+        ])
+    engine.dispose()
+
+
+def emit(report: dict):
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
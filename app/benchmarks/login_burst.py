@@ -0,0 +1,103 @@
+"""
+Задержка WebSocket во время всплеска логинов.
+
+Несколько клиентов по кругу отправляют сообщения самим себе и замеряют время до получения.
+Сначала замер без нагрузки, затем столько же времени параллельно идут запросы /token
+с проверкой пароля bcrypt. Задержки в обеих фазах должны быть близки,
+ответы 503 означают срабатывание ограничения очереди хэширования.
+
+Запуск из директории app:
+    python -m benchmarks.login_burst --clients 20 --logins 50 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import httpx
+import websockets
+
+from benchmarks.common import (
+    default_database_url, emit, free_port, latency_summary, make_token, run_server, seed_users
+)
+
+CLIENT_ID_OFFSET = 1000
+PASSWORD = "benchmark-password"
+
+
+async def echo_client(port: int, user_id: int, stop_at: float, latencies: list):
+    uri = f"ws://127.0.0.1:{port}/ws/chat?token={make_token(user_id)}"
+    async with websockets.connect(uri, max_size=None) as websocket:
+        sequence = 0
+        while time.monotonic() < stop_at:
+            marker = f"{user_id}:{sequence}"
+            sent_at = time.perf_counter()
+            await websocket.send(json.dumps({
+                "action": "send_message",
+                "receiver_id": user_id,
+                "content": marker,
+                "content_type": "text",
+            }))
+            while True:
+                frame = json.loads(await websocket.recv())
+                if frame.get("content") == marker:
+                    break
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+            sequence += 1
+
+
+async def login_worker(port: int, username: str, stop_at: float, statuses: Counter, login_latencies: list):
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None) as client:
+        while time.monotonic() < stop_at:
+            started_at = time.perf_counter()
+            response = await client.post("/token", data={"username": username, "password": PASSWORD})
+            statuses[response.status_code] += 1
+            if response.status_code == 200:
+                login_latencies.append((time.perf_counter() - started_at) * 1000)
+
+
+async def phase(port: int, args, with_logins: bool) -> dict:
+    latencies, login_latencies, statuses = [], [], Counter()
+    stop_at = time.monotonic() + args.duration
+    tasks = [echo_client(port, CLIENT_ID_OFFSET + i, stop_at, latencies) for i in range(args.clients)]
+    if with_logins:
+        tasks += [
+            login_worker(port, f"user{i}", stop_at, statuses, login_latencies) for i in range(args.logins)
+        ]
+    await asyncio.gather(*tasks)
+    result = {"ws_round_trip": latency_summary(latencies)}
+    if with_logins:
+        result["logins"] = latency_summary(login_latencies)
+        result["login_statuses"] = {str(code): count for code, count in sorted(statuses.items())}
+    return result
+
+
+async def run(args, port: int) -> dict:
+    return {
+        "benchmark": "login_burst",
+        "clients": args.clients,
+        "concurrent_logins": args.logins,
+        "duration_s": args.duration,
+        "idle": await phase(port, args, with_logins=False),
+        "burst": await phase(port, args, with_logins=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+
+    database_url = args.database_url or default_database_url()
+    seed_users(database_url, [f"user{i}" for i in range(args.logins)], PASSWORD)
+    port = free_port()
+    with run_server(database_url, port):
+        emit(asyncio.run(run(args, port)))
+
+
+if __name__ == "__main__":
+    main()
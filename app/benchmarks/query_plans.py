@@ -0,0 +1,174 @@
+"""
+Проверка планов запросов на больших объемах сообщений.
+
+Заполняет базу личными и групповыми сообщениями, затем выполняет EXPLAIN для
+запросов истории, недоставленных сообщений, ленты чата, списка переписок и
+счетчика непрочитанного и проверяет, что используются составные индексы.
+Код возврата 1, если индекс не используется.
+
+Запуск из директории app:
+    python -m benchmarks.query_plans --messages 2000000
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, func, insert, select, text
+
+from benchmarks.common import default_database_url, emit
+from models import (
+    Base, ChatParticipant, ContentType, ConversationSummary, Message, MessageStatus, direct_conversation_key
+)
+
+
+def seed(
+        engine, messages: int, users: int, chats: int, chat_size: int, peers: int, batch_size: int = 20000
+):
+    Base.metadata.create_all(bind=engine)
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(ChatParticipant), [
+            {"chat_id": chat_id, "user_id": rng.randint(1, users)}
+            for chat_id in range(1, chats + 1)
+            for _ in range(chat_size)
+        ])
+        # Сводки переписок для списка: у каждого пользователя peers собеседников
+        for start in range(1, users + 1, batch_size // peers or 1):
+            conn.execute(insert(ConversationSummary), [
+                {
+                    "user_id": user_id, "peer_id": peer_id, "last_message_id": 0, "last_sender_id": peer_id,
+                    "unread_count": 0,
+                }
+                for user_id in range(start, min(users + 1, start + (batch_size // peers or 1)))
+                for peer_id in rng.sample(range(1, users + 1), min(peers, users))
+            ])
+        for start in range(0, messages, batch_size):
+            rows = []
+            for i in range(start, min(messages, start + batch_size)):
+                sender = rng.randint(1, users)
+                timestamp = now - timedelta(seconds=messages - i)
+                status = MessageStatus.SENT if rng.random() < 0.05 else MessageStatus.READ
+                if i % 4 == 0:
+                    rows.append({
+                        "sender_id": sender, "receiver_id": None, "chat_id": rng.randint(1, chats),
+                        "content": f"group message {i}", "content_type": ContentType.TEXT,
+                        "timestamp": timestamp, "status": status, "conversation_key": None,
+                    })
+                else:
+                    receiver = rng.randint(1, users)
+                    rows.append({
+                        "sender_id": sender, "receiver_id": receiver, "chat_id": None,
+                        "content": f"direct message {i}", "content_type": ContentType.TEXT,
+                        "timestamp": timestamp, "status": status,
+                        "conversation_key": direct_conversation_key(sender, receiver),
+                    })
+            conn.execute(insert(Message), rows)
+
+
+def checked_queries(user_a: int, user_b: int, chat_id: int):
+    # Те же условия, что и в обработчиках main.py
+    return {
+        "direct_history": (
+            select(Message).filter(
+                Message.conversation_key == direct_conversation_key(user_a, user_b)
+            ).order_by(Message.id.desc()).limit(100),
+            "ix_messages_conversation_key_id",
+        ),
+        "undelivered_personal": (
+            select(Message).filter(
+                Message.receiver_id == user_a,
+                Message.status == MessageStatus.SENT,
+                Message.chat_id == None
+            ).order_by(Message.id.asc()),
+            "ix_messages_undelivered",
+        ),
+        "chat_timeline": (
+            select(Message).filter(
+                Message.chat_id == chat_id,
+                Message.receiver_id == None
+            ).order_by(Message.id.desc()).limit(100),
+            "ix_messages_chat_id_id",
+        ),
+        "inbox_direct": (
+            select(ConversationSummary).filter(ConversationSummary.user_id == user_a),
+            "ix_conversation_summaries_user_id_peer_id",
+        ),
+        "inbox_chats": (
+            select(ChatParticipant).filter(ChatParticipant.user_id == user_a),
+            "ix_chat_participants_user_id_chat_id",
+        ),
+        "chat_unread": (
+            # utils.inbox.chat_unread_after
+            select(func.count(Message.id)).filter(
+                Message.chat_id == chat_id,
+                Message.receiver_id == None,
+                Message.id > 0,
+                Message.sender_id != user_a
+            ),
+            "ix_messages_chat_id_id",
+        ),
+    }
+
+
+def explain(conn, statement) -> str:
+    sql = str(statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == "sqlite":
+        rows = conn.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        return "\n".join(str(row[-1]) for row in rows)
+    rows = conn.execute(text(f"EXPLAIN {sql}")).all()
+    return "\n".join(row[0] for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--chat-size", type=int, default=50)
+    parser.add_argument("--peers", type=int, default=20)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url or default_database_url())
+    if not args.skip_seed:
+        started = time.perf_counter()
+        seed(engine, args.messages, args.users, args.chats, args.chat_size, args.peers)
+        seed_seconds = time.perf_counter() - started
+    else:
+        seed_seconds = 0.0
+
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("ANALYZE messages"))
+        else:
+            conn.execute(text("ANALYZE"))
+
+        results = {}
+        for name, (statement, index_name) in checked_queries(1, 2, 1).items():
+            plan = explain(conn, statement)
+            started = time.perf_counter()
+            conn.execute(statement).all()
+            results[name] = {
+                "expected_index": index_name,
+                "uses_index": index_name in plan,
+                "query_ms": round((time.perf_counter() - started) * 1000, 3),
+                "plan": plan,
+            }
+
+    emit({
+        "benchmark": "query_plans",
+        "dialect": engine.dialect.name,
+        "messages": args.messages,
+        "seed_s": round(seed_seconds, 1),
+        "queries": results,
+    })
+    if not all(result["uses_index"] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Микробенчмарк сериализации сообщений: прежний путь через MessageSchema.json()
+на каждого получателя против MessagePayload, закодированного один раз.
+
+Запуск из директории app:
+    python -m benchmarks.serializer --messages 2000 --fanout 1 50 500
+"""
+import argparse
+import time
+from datetime import datetime
+
+from benchmarks.common import emit
+from models import ContentType, Message
+from schemas import MessageSchema
+from utils import message_serializer
+from utils.message_serializer import MessagePayload
+
+
+def legacy_serialize(message: Message, receiver_id: int) -> str:
+    return MessageSchema(
+        message_id=message.id,
+        sender_id=message.sender_id,
+        receiver_id=receiver_id,
+        chat_id=message.chat_id,
+        content=message.content,
+        content_type=message.content_type.value,
+        timestamp=message.timestamp,
+        file_url=message.file_url
+    ).json()
+
+
+def make_messages(count: int):
+    now = datetime.utcnow()
+    return [
+        Message(
+            id=i, sender_id=1, chat_id=7, content=f"Сообщение номер {i} для группового чата",
+            content_type=ContentType.TEXT, timestamp=now, file_url=None
+        )
+        for i in range(count)
+    ]
+
+
+def measure(fn, messages, fanout: int) -> dict:
+    receivers = range(2, fanout + 2)
+    started = time.perf_counter()
+    for message in messages:
+        fn(message, receivers)
+    elapsed = time.perf_counter() - started
+    frames = len(messages) * fanout
+    return {"total_ms": round(elapsed * 1000, 3), "us_per_frame": round(elapsed * 1e6 / frames, 3)}
+
+
+def run_legacy(message, receivers):
+    for receiver_id in receivers:
+        legacy_serialize(message, receiver_id)
+
+
+def run_payload_json(message, receivers):
+    payload = MessagePayload.from_message(message)
+    for receiver_id in receivers:
+        payload.json(receiver_id)
+
+
+def run_payload_msgpack(message, receivers):
+    payload = MessagePayload.from_message(message)
+    for receiver_id in receivers:
+        payload.msgpack(receiver_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--fanout", type=int, nargs="+", default=[1, 50, 500])
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages)
+    assert legacy_serialize(messages[0], 2) == MessagePayload.from_message(messages[0]).json(2)
+
+    results = {}
+    for fanout in args.fanout:
+        results[str(fanout)] = {
+            "legacy_pydantic": measure(run_legacy, messages, fanout),
+            "payload_json": measure(run_payload_json, messages, fanout),
+        }
+        if message_serializer.msgpack is not None:
+            results[str(fanout)]["payload_msgpack"] = measure(run_payload_msgpack, messages, fanout)
+
+    emit({
+        "benchmark": "serializer",
+        "json_backend": "orjson" if message_serializer.orjson is not None else "json",
+        "messages": args.messages,
+        "fanout": results,
+    })
+
+
+if __name__ == "__main__":
+    main()
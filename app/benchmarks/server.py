@@ -0,0 +1,38 @@
+"""
+Приложение для бенчмарков: main.app плюс служебный маршрут /_bench/stats
+со счетчиком SQL-запросов, RSS процесса и числом открытых соединений.
+
+Запускается из benchmarks.run через uvicorn benchmarks.server:app, в рабочем развертывании не используется.
+"""
+import os
+
+from sqlalchemy import event
+
+from database import async_engine
+from main import app, manager
+
+queries = {"total": 0}
+
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    queries["total"] += 1
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        # Без /proc доступен только пиковый RSS (в КБ на Linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+@app.get("/_bench/stats")
+async def bench_stats():
+    return {
+        "queries": queries["total"],
+        "rss_bytes": rss_bytes(),
+        "connections": manager.connection_count,
+    }
@@ -0,0 +1,93 @@
+"""
+Задержка доставки по WebSocket при параллельной нагрузке на базу данных.
+
+Каждый клиент отправляет сообщение самому себе и замеряет время до его получения,
+одновременно несколько HTTP-клиентов читают длинную историю через /messages/{user_id}.
+
+Запуск из директории app:
+    python -m benchmarks.ws_latency --clients 200 --duration 20
+Для сравнения «до/после» запускается на двух коммитах с одинаковыми параметрами.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+import websockets
+
+from benchmarks.common import (
+    default_database_url, emit, free_port, latency_summary, make_token, run_server, seed_direct_history
+)
+
+HISTORY_USER_A = 1
+HISTORY_USER_B = 2
+CLIENT_ID_OFFSET = 1000
+
+
+async def ws_client(port: int, user_id: int, stop_at: float, latencies: list):
+    uri = f"ws://127.0.0.1:{port}/ws/chat?token={make_token(user_id)}"
+    async with websockets.connect(uri, max_size=None) as websocket:
+        sequence = 0
+        while time.monotonic() < stop_at:
+            marker = f"{user_id}:{sequence}"
+            sent_at = time.perf_counter()
+            await websocket.send(json.dumps({
+                "action": "send_message",
+                "receiver_id": user_id,
+                "content": marker,
+                "content_type": "text",
+            }))
+            while True:
+                frame = json.loads(await websocket.recv())
+                if frame.get("content") == marker:
+                    break
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+            sequence += 1
+
+
+async def db_load_worker(port: int, stop_at: float, counter: list):
+    headers = {"Authorization": f"Bearer {make_token(HISTORY_USER_A)}"}
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None) as client:
+        while time.monotonic() < stop_at:
+            response = await client.get(f"/messages/{HISTORY_USER_B}", headers=headers)
+            response.raise_for_status()
+            counter[0] += 1
+
+
+async def run(args, port: int) -> dict:
+    latencies = []
+    db_requests = [0]
+    stop_at = time.monotonic() + args.duration
+    tasks = [ws_client(port, CLIENT_ID_OFFSET + i, stop_at, latencies) for i in range(args.clients)]
+    tasks += [db_load_worker(port, stop_at, db_requests) for _ in range(args.db_workers)]
+    await asyncio.gather(*tasks)
+    return {
+        "benchmark": "ws_latency",
+        "clients": args.clients,
+        "db_workers": args.db_workers,
+        "history_size": args.history,
+        "duration_s": args.duration,
+        "ws_round_trip": latency_summary(latencies),
+        "db_requests": db_requests[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--db-workers", type=int, default=8)
+    parser.add_argument("--history", type=int, default=50000)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+
+    database_url = args.database_url or default_database_url()
+    seed_direct_history(database_url, HISTORY_USER_A, HISTORY_USER_B, args.history)
+    port = free_port()
+    with run_server(database_url, port):
+        emit(asyncio.run(run(args, port)))
+
+
+if __name__ == "__main__":
+    main()
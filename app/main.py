@@ -1,17 +1,35 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, UploadFile, File, HTTPException, status
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, UploadFile, File, HTTPException, Query, Request, Response, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from typing import List
-from models import Base, Message, MessageStatus, ContentType, Chat, ChatParticipant, UploadedFile, User
-from database import SessionLocal, engine
-from auth import get_current_user
-from utils.connection_manager import ConnectionManager, authenticate_user, create_access_token
+from fastapi.responses import JSONResponse
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from models import Base, Message, MessageStatus, ContentType, Chat, ChatParticipant, UploadedFile, direct_conversation_key
+from database import AsyncSessionLocal, engine, get_db
+from auth import claims_cache, get_current_user, users_cache
+from utils.connection_manager import Connection, ConnectionManager, authenticate_user, create_access_token
+from utils.backplane import create_backplane
+from utils.retry_scheduler import RetryScheduler
 from datetime import datetime
 import json
 import asyncio
-import uuid
 import logging
-
-from utils.message_serializer import serialize_message
+import os
+
+from utils.message_serializer import MessagePayload, negotiate_encoding
+from utils.history import fetch_history_page, stream_history
+from utils.backlog import advance_delivery_cursors, replay_backlog, save_device_cursor
+from utils.ack_buffer import AckBuffer
+from utils.file_storage import DEFAULT_MEDIA_TYPE, UploadTooLarge, store_upload, upload_media_type
+from utils.file_response import MediaFileResponse
+from utils.password_hasher import HasherOverloaded, password_hasher
+from utils.membership import MembershipIndex
+from utils.persistence import PERSISTENCE_PIPELINE, PersistencePipeline
+from utils.search import SearchIndex
+from utils.inbox import fetch_inbox, record_messages
+from utils.archive import ARCHIVE_ENABLED, ArchiveJob, ColdScope
+from utils import metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,16 +41,98 @@ logging.basicConfig(
 
 logger = logging.getLogger("chat_app")
 
-app = FastAPI()
+PONG_FRAME = json.dumps({"action": "pong"})
+CONTENT_TYPES = tuple(content_type.value for content_type in ContentType)
+# Длина device_id совпадает с колонкой device_cursors.device_id
+DEVICE_ID_MAX_LENGTH = 64
+
+
+def parse_id(value) -> Optional[int]:
+    # id из кадра клиента: число или строка с числом; bool и прочее отклоняются
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
 Base.metadata.create_all(bind=engine)
-manager = ConnectionManager()
+manager = ConnectionManager(backplane=create_backplane(os.getenv("BACKPLANE_URL")), replay=replay_backlog)
+
+
+async def resend_message(message: Message) -> bool:
+    return await manager.send_personal_message(MessagePayload.from_message(message), message.receiver_id)
+
+
+membership = MembershipIndex(manager.backplane)
+search_index = SearchIndex()
+retry_scheduler = RetryScheduler(send=resend_message, offline_users=manager.offline_users)
+
+
+async def on_messages_committed(messages: List[Message]):
+    search_index.add_messages(messages)
+    # Сообщения, не поместившиеся в очередь до записи, теперь может дослать досылка
+    manager.replay_spilled(max(message.id for message in messages))
+    # Повторы планируются только после коммита: планировщик читает сообщения из БД
+    for message in messages:
+        if message.chat_id is None and message.status == MessageStatus.SENT:
+            retry_scheduler.schedule(message.id, message.receiver_id)
+
+
+metrics.active_connections.set_function(lambda: manager.connection_count)
+metrics.queued_frames.set_function(lambda: sum(connection.queue.qsize() for connection in manager.iter_connections()))
+metrics.retry_pending.set_function(lambda: len(retry_scheduler.pending))
+metrics.retry_parked.set_function(lambda: retry_scheduler.parked_count)
+metrics.auth_cache_hits.set_function(lambda: claims_cache.hits)
+metrics.auth_cache_misses.set_function(lambda: claims_cache.misses)
+metrics.auth_cache_size.set_function(lambda: len(claims_cache))
+metrics.auth_user_cache_hits.set_function(lambda: users_cache.hits)
+metrics.auth_user_cache_misses.set_function(lambda: users_cache.misses)
+metrics.auth_user_cache_size.set_function(lambda: len(users_cache))
+
+persistence = PersistencePipeline(
+    notify=manager.send_personal_message, on_committed=on_messages_committed
+) if PERSISTENCE_PIPELINE else None
+archive_job = ArchiveJob() if ARCHIVE_ENABLED else None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await search_index.start()
+    await manager.start()
+    retry_scheduler.start()
+    if persistence:
+        persistence.start()
+    if archive_job:
+        archive_job.start()
+    yield
+    if archive_job:
+        await archive_job.stop()
+    if persistence:
+        await persistence.stop()
+    await retry_scheduler.stop()
+    await manager.stop()
+    password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token") # при необходимости изменить
 
 
+@app.exception_handler(HasherOverloaded)
+async def hasher_overloaded_handler(request: Request, exc: HasherOverloaded):
+    # Общий ответ для всех эндпоинтов, которые хэшируют или проверяют пароль
+    logger.warning(f"Request {request.method} {request.url.path} rejected: password hasher overloaded ({exc})")
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Сервер перегружен, повторите попытку позже"},
+        headers={"Retry-After": "1"},
+    )
+
+
 @app.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    db = SessionLocal()
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -46,50 +146,116 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
 
 
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...), user_id: int = Depends(get_current_user)):
-    unique_filename = f"{uuid.uuid4()}_{file.filename}"
-    file_location = f"media/{unique_filename}"
-
-    db = SessionLocal()
+async def upload_file(
+        file: UploadFile = File(...),
+        user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
     try:
         # Сохранение файла
-        with open(file_location, "wb+") as f:
-            f.write(await file.read())
-        logger.info(f"User {user_id} uploaded file {unique_filename}")
+        stored = await store_upload(file)
+        if stored.created:
+            logger.info(f"User {user_id} uploaded file {file.filename} ({stored.size} bytes)")
+        else:
+            logger.info(f"User {user_id} uploaded duplicate of blob {stored.content_hash}")
 
         uploaded_file = UploadedFile(
             filename=file.filename,
-            file_url=file_location,
+            file_url=stored.file_url,
+            content_hash=stored.content_hash,
+            size=stored.size,
+            content_type=upload_media_type(file.filename, file.content_type),
             uploader_id=user_id
         )
         db.add(uploaded_file)
-        db.commit()
-        db.refresh(uploaded_file)
-        logger.info(f"File {unique_filename} saved to database by user {user_id}")
+        await db.commit()
+        logger.info(f"File {file.filename} saved to database by user {user_id}")
 
-        return {"file_url": file_location}
+        return {"file_id": uploaded_file.id, "file_url": stored.file_url}
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Файл слишком большой")
     except Exception as e:
         logger.error(f"Error uploading file for user {user_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при загрузке файла")
-    finally:
-        db.close()
+
+
+async def can_access_file(db: AsyncSession, uploaded_file: UploadedFile, user_id: int) -> bool:
+    if uploaded_file.uploader_id == user_id:
+        return True
+    # Файл доступен участникам переписки, в которой он был отправлен
+    result = await db.execute(select(Message.id).filter(
+        Message.file_url == uploaded_file.file_url,
+        or_(
+            Message.sender_id == user_id,
+            Message.receiver_id == user_id,
+            Message.chat_id.in_(select(ChatParticipant.chat_id).filter(ChatParticipant.user_id == user_id))
+        )
+    ).limit(1))
+    return result.first() is not None
+
+
+@app.api_route("/files/{file_id}", methods=["GET", "HEAD"])
+async def download_file(
+        file_id: int,
+        request: Request,
+        user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+    uploaded_file = await db.get(UploadedFile, file_id)
+    if not uploaded_file or not await can_access_file(db, uploaded_file, user_id):
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    path = uploaded_file.file_url
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        logger.error(f"File {file_id} is missing on disk: {path}")
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    # Сильный ETag по хэшу содержимого, для старых записей — слабый по mtime и размеру
+    if uploaded_file.content_hash:
+        etag = f'"{uploaded_file.content_hash}"'
+    else:
+        etag = f'W/"{int(stat.st_mtime)}-{stat.st_size}"'
+
+    return MediaFileResponse(
+        path,
+        etag=etag,
+        media_type=uploaded_file.content_type or DEFAULT_MEDIA_TYPE,
+        filename=uploaded_file.filename,
+        range_header=request.headers.get("range"),
+        if_none_match=request.headers.get("if-none-match"),
+        if_range=request.headers.get("if-range")
+    )
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Отдается без авторизации: закрывайте на уровне сети или прокси
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/messages/{user_id}")
-async def get_messages_with_user(user_id: int, current_user_id: int = Depends(get_current_user)):
-    db = SessionLocal()
+async def get_messages_with_user(
+        user_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = Query(None, ge=1),
+        stream: bool = False,
+        current_user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
     try:
-        messages = db.query(Message).filter(
-            ((Message.sender_id == current_user_id) & (Message.receiver_id == user_id)) |
-            ((Message.sender_id == user_id) & (Message.receiver_id == current_user_id))
-        ).order_by(Message.timestamp.asc()).all()
-        logger.info(f"User {current_user_id} fetched messages with user {user_id}")
-        return messages
+        conversation_key = direct_conversation_key(current_user_id, user_id)
+        query = select(Message).filter(Message.conversation_key == conversation_key)
+        cold = ColdScope(conversation_key=conversation_key)
+        logger.debug("User %s fetched messages with user %s", current_user_id, user_id)
+        if stream:
+            return stream_history(query, before_id, after_id, limit, cold)
+        return await fetch_history_page(db, query, before_id, after_id, limit, cold)
     except Exception as e:
         logger.error(f"Error fetching messages for user {current_user_id} with user {user_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при получении сообщений")
-    finally:
-        db.close()
 
 
 @app.post("/send_message")
@@ -99,9 +265,9 @@ async def send_message(
         content: str = "",
         content_type: ContentType = ContentType.TEXT,
         file_url: str = None,
-        current_user_id: int = Depends(get_current_user)
+        current_user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
 ):
-    db = SessionLocal()
     try:
         if not receiver_id and not chat_id:
             raise HTTPException(status_code=400, detail="Необходимо указать receiver_id или chat_id")
@@ -113,18 +279,26 @@ async def send_message(
             content=content,
             content_type=content_type,
             timestamp=datetime.utcnow(),
-            file_url=file_url
+            file_url=file_url,
+            status=MessageStatus.SENT
         )
-        db.add(new_message)
-        db.commit()
-        db.refresh(new_message)
+        metrics.messages_in.labels("direct" if receiver_id else "group").inc()
+        if persistence:
+            persisted = await send_message_write_behind(new_message)
+            if persisted is None:
+                raise HTTPException(status_code=404, detail="Чат не найден")
+            # Ответ уходит после коммита пачки, в которую попало сообщение
+            await persisted
+            return {"message_id": new_message.id}
+
+        await save_message(db, new_message)
 
         if receiver_id:
             await send_message_to_user(new_message, db)
-            logger.info(f"User {current_user_id} sent message to user {receiver_id}")
+            logger.debug("User %s sent message to user %s", current_user_id, receiver_id)
         elif chat_id:
             await send_message_to_chat(new_message, db)
-            logger.info(f"User {current_user_id} sent message to chat {chat_id}")
+            logger.debug("User %s sent message to chat %s", current_user_id, chat_id)
 
         return {"message_id": new_message.id}
     except HTTPException as he:
@@ -133,232 +307,273 @@ async def send_message(
     except Exception as e:
         logger.error(f"Error sending message from user {current_user_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при отправке сообщения")
-    finally:
-        db.close()
 
 
 @app.post("/chats/")
-async def create_chat(participants: List[int], name: str = None, current_user_id: int = Depends(get_current_user)):
-    db = SessionLocal()
+async def create_chat(
+        participants: List[int],
+        name: str = None,
+        current_user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
     try:
         new_chat = Chat(name=name, is_group=True)
         db.add(new_chat)
-        db.commit()
-        db.refresh(new_chat)
+        await db.flush()
         logger.info(f"User {current_user_id} created chat {new_chat.id} with participants {participants}")
 
         participant_ids = set(participants + [current_user_id])
-        for user_id in participant_ids:
-            chat_participant = ChatParticipant(chat_id=new_chat.id, user_id=user_id)
-            db.add(chat_participant)
-        db.commit()
+        db.add_all([ChatParticipant(chat_id=new_chat.id, user_id=user_id) for user_id in participant_ids])
+        await db.commit()
         logger.info(f"Chat {new_chat.id} participants added: {participant_ids}")
+        await membership.chat_changed(new_chat.id, new_chat.membership_version, participant_ids, participant_ids)
 
         return {"chat_id": new_chat.id}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error creating chat for user {current_user_id}: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при создании чата")
-    finally:
-        db.close()
 
 
-async def send_message_to_chat(message: Message, db):
-    chat = db.query(Chat).filter(Chat.id == message.chat_id).first()
-    if not chat:
-        logger.warning(f"Chat {message.chat_id} not found")
+async def send_message_to_chat(message: Message, db: AsyncSession):
+    chat_id = message.chat_id
+    participant_ids = await membership.participants(chat_id, db)
+    if participant_ids is None:
+        logger.warning(f"Chat {chat_id} not found")
         return
 
-    participants = db.query(ChatParticipant).filter(ChatParticipant.chat_id == chat.id).all()
-
-    for participant in participants:
-        receiver_id = participant.user_id
-        if receiver_id != message.sender_id:
-            message_copy = Message(
-                sender_id=message.sender_id,
-                receiver_id=receiver_id,
-                chat_id=message.chat_id,
-                content=message.content,
-                content_type=message.content_type,
-                timestamp=message.timestamp,
-                file_url=message.file_url,
-                status=MessageStatus.SENT
-            )
-            db.add(message_copy)
-            db.commit()
-            await send_message_to_user(message_copy, db)
-    logger.info(f"Message {message.id} sent to chat {chat.id}")
+    # Копии сообщения не создаются: офлайн-участники получат его из курсора при подключении
+    payload = MessagePayload.from_message(message)
+    recipients = [receiver_id for receiver_id in participant_ids if receiver_id != message.sender_id]
+    metrics.fanout_size.observe(len(recipients))
+    delivered_to = await manager.broadcast(payload, recipients)
 
-
-@app.get("/chats/{chat_id}/messages")
-async def get_chat_messages(chat_id: int, current_user: User = Depends(get_current_user)):
-    current_user_id = current_user.id
-    db = SessionLocal()
-    try:
-        is_participant = db.query(ChatParticipant).filter(
-            ChatParticipant.chat_id == chat_id,
-            ChatParticipant.user_id == current_user_id
-        ).first()
-        if not is_participant:
-            raise HTTPException(status_code=403, detail="Access denied")
-
-        messages = db.query(Message).filter(
-            Message.chat_id == chat_id
-        ).order_by(Message.timestamp.asc()).all()
-        return messages
-    finally:
-        db.close()
+    # Отправитель свое сообщение уже имеет: без этого его курсор застрял бы перед ним
+    await advance_delivery_cursors(db, chat_id, message.id, delivered_to + [message.sender_id])
+    with metrics.db_commit_seconds.labels("group_cursor").time():
+        await db.commit()
+    logger.debug("Message %s sent to chat %s, delivered to %s participants", message.id, chat_id, len(delivered_to))
 
 
-async def send_undelivered_personal_messages(user_id: int, websocket: WebSocket):
-    db = SessionLocal()
-    try:
-        undelivered_messages = db.query(Message).filter(
-            Message.receiver_id == user_id,
-            Message.status == MessageStatus.SENT,
-            Message.chat_id == None
-        ).all()
-        for message in undelivered_messages:
-            message_json = serialize_message(message)
-            await websocket.send_text(message_json)
-            message.status = MessageStatus.DELIVERED
-        db.commit()
-    except WebSocketDisconnect:
-        logger.info(f"WebSocket disconnected while sending undelivered personal messages to user {user_id}")
-    except Exception as e:
-        logger.error(f"An error occurred in send_undelivered_personal_messages for user {user_id}: {e}")
+@app.get("/chats/{chat_id}/messages")
+async def get_chat_messages(
+        chat_id: int,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = Query(None, ge=1),
+        stream: bool = False,
+        current_user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+    if not await membership.is_member(chat_id, current_user_id, db):
+        raise HTTPException(status_code=403, detail="Access denied")
 
-async def send_undelivered_group_messages(user_id: int, websocket: WebSocket):
-    db = SessionLocal()
+    # receiver_id заполнен только у старых копий групповых сообщений
+    query = select(Message).filter(
+        Message.chat_id == chat_id,
+        Message.receiver_id == None
+    )
+    cold = ColdScope(chat_id=chat_id)
+    if stream:
+        return stream_history(query, before_id, after_id, limit, cold)
+    return await fetch_history_page(db, query, before_id, after_id, limit, cold)
+
+
+@app.get("/inbox")
+async def get_inbox(
+        limit: Optional[int] = Query(None, ge=1),
+        offset: int = Query(0, ge=0),
+        current_user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+    return await fetch_inbox(db, current_user_id, limit, offset)
 
-    try:
-        undelivered_messages = db.query(Message).join(ChatParticipant).filter(
-            ChatParticipant.user_id == user_id,
-            Message.status == MessageStatus.SENT,
-            Message.chat_id != None  # Групповые сообщения
-        ).all()
-        for message in undelivered_messages:
-            message_json = serialize_message(message)
-            await websocket.send_text(message_json)
-            message.status = MessageStatus.DELIVERED
-        db.commit()
-    except WebSocketDisconnect:
-        logger.info(f"WebSocket disconnected while sending undelivered group messages to user {user_id}")
-    except Exception as e:
-        logger.error(f"An error occurred in send_undelivered_group_messages for user {user_id}: {e}")
 
+@app.get("/search")
+async def search_messages(
+        q: str = Query(..., min_length=1),
+        limit: Optional[int] = Query(None, ge=1),
+        offset: int = Query(0, ge=0),
+        current_user_id: int = Depends(get_current_user),
+        db: AsyncSession = Depends(get_db)
+):
+    # Только личные переписки пользователя и чаты, где он участник
+    chat_ids = await membership.chats_of(current_user_id, db)
+    return await search_index.search(db, q, current_user_id, chat_ids, limit, offset)
 
 
-async def receive_messages(websocket: WebSocket, user_id: int):
+async def receive_messages(connection: Connection):
+    websocket, user_id = connection.websocket, connection.user_id
+    ack_buffer = AckBuffer(
+        user_id, manager.send_personal_message, wait_persisted=persistence.wait_persisted if persistence else None
+    )
     try:
-        db = SessionLocal()
         while True:
             data = await websocket.receive_json()
+            # Любой входящий кадр подтверждает, что клиент жив
+            connection.touch()
             action = data.get("action")
-            if action == "send_message":
-                receiver_id = data.get("receiver_id")
-                chat_id = data.get("chat_id")
-                content = data.get("content")
-                content_type = data.get("content_type")
-                file_url = data.get("file_url")
-
-                if receiver_id:
-                    new_message = Message(
-                        sender_id=user_id,
-                        receiver_id=receiver_id,
-                        content=content,
-                        content_type=ContentType(content_type),
-                        timestamp=datetime.utcnow(),
-                        file_url=file_url,
-                        status=MessageStatus.SENT
-                    )
-                    db.add(new_message)
-                    db.commit()
-
-                    await send_message_to_user(new_message, db)
-                elif chat_id:
-                    new_message = Message(
-                        sender_id=user_id,
-                        chat_id=chat_id,
-                        content=content,
-                        content_type=ContentType(content_type),
-                        timestamp=datetime.utcnow(),
-                        file_url=file_url,
-                        status=MessageStatus.SENT
-                    )
-                    db.add(new_message)
-                    db.commit()
-
-                    await send_message_to_chat(new_message, db)
+            if action == "pong":
+                continue
+            if action == "ping":
+                manager.offer(connection, PONG_FRAME)
+                continue
+            # Отдельная короткая сессия на каждое действие, чтобы не держать соединение пула
+            async with AsyncSessionLocal() as db:
+                if action == "send_message":
+                    receiver_id = data.get("receiver_id")
+                    chat_id = data.get("chat_id")
+                    content = data.get("content")
+                    content_type = data.get("content_type")
+                    file_url = data.get("file_url")
+
+                    if content_type not in CONTENT_TYPES:
+                        await websocket.send_text(json.dumps({
+                            "error": "Недопустимый content_type"
+                        }))
+                    elif receiver_id or chat_id:
+                        new_message = Message(
+                            sender_id=user_id,
+                            receiver_id=receiver_id,
+                            chat_id=None if receiver_id else chat_id,
+                            content=content,
+                            content_type=ContentType(content_type),
+                            timestamp=datetime.utcnow(),
+                            file_url=file_url,
+                            status=MessageStatus.SENT
+                        )
+                        metrics.messages_in.labels("direct" if receiver_id else "group").inc()
+                        if persistence:
+                            persisted = await send_message_write_behind(
+                                new_message, notify_sender=True, client_id=data.get("client_id")
+                            )
+                            if persisted is None:
+                                await websocket.send_text(json.dumps({
+                                    "error": "Чат не найден",
+                                    "client_id": data.get("client_id")
+                                }))
+                            continue
+
+                        await save_message(db, new_message)
+
+                        if receiver_id:
+                            await send_message_to_user(new_message, db)
+                        else:
+                            await send_message_to_chat(new_message, db)
+                    else:
+                        await websocket.send_text(json.dumps({
+                            "error": "receiver_id или chat_id должны быть указаны"
+                        }))
+
+                elif action == "acknowledge":
+                    message_ids = data.get("message_ids") or [data.get("message_id")]
+                    # Проверяем весь кадр до добавления в буфер, чтобы не подтвердить его частично
+                    parsed = [parse_id(message_id) for message_id in message_ids] if isinstance(message_ids, list) else [None]
+                    if None in parsed:
+                        await websocket.send_text(json.dumps({
+                            "error": "Некорректные id сообщений"
+                        }))
+                    else:
+                        ack_buffer.add(parsed)
+                elif action == "read_up_to":
+                    chat_id, message_id = parse_id(data.get("chat_id")), parse_id(data.get("message_id"))
+                    if chat_id is None or message_id is None:
+                        await websocket.send_text(json.dumps({
+                            "error": "chat_id и message_id должны быть указаны"
+                        }))
+                    else:
+                        ack_buffer.add_read_up_to(chat_id, message_id)
                 else:
                     await websocket.send_text(json.dumps({
-                        "error": "receiver_id или chat_id должны быть указаны"
+                        "error": "Неизвестное действие"
                     }))
-
-            elif action == "acknowledge":
-                message_id = data.get("message_id")
-                message = db.query(Message).filter(Message.id == message_id).first()
-                if message:
-                    message.status = MessageStatus.READ
-                    db.commit()
-            else:
-                await websocket.send_text(json.dumps({
-                    "error": "Неизвестное действие"
-                }))
     except WebSocketDisconnect:
         logger.info(f"WebSocket disconnected for user {user_id}")
-        await manager.disconnect(user_id)
     except Exception as e:
         logger.error(f"An error occurred in receive_messages for user {user_id}: {e}")
+    finally:
+        await ack_buffer.close()
 
 
 @app.websocket("/ws/chat")
-async def websocket_endpoint(websocket: WebSocket, token: str = None):
+async def websocket_endpoint(websocket: WebSocket, token: str = None, encoding: str = None, device_id: str = None):
+    if device_id is not None and not 0 < len(device_id) <= DEVICE_ID_MAX_LENGTH:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        logger.warning("WebSocket connection closed: Invalid device_id")
+        return
     if token is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         logger.warning("WebSocket connection closed: Missing token")
         return
-    current_user = await get_current_user(token)
-    user_id = current_user.id
-    await manager.connect(user_id, websocket)
-    db = SessionLocal()
-
     try:
-        receive_task = asyncio.create_task(receive_messages(websocket, user_id))
-
-        await send_undelivered_personal_messages(user_id, websocket)
-        await send_undelivered_group_messages(user_id, websocket)
-
-        await receive_task
+        user_id = await get_current_user(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        logger.warning("WebSocket connection closed: Invalid token")
+        return
+    connection = await manager.connect(user_id, websocket, negotiate_encoding(encoding), device_id)
+    retry_scheduler.resume(user_id)
 
-    except WebSocketDisconnect:
-        await manager.disconnect(user_id)
+    # Досылка накопленных сообщений идет параллельно с приемом, у каждой задачи свои сессии
+    manager.start_replay(connection)
+    # Прием в отдельной задаче: ее отменяет сервер, если закрывает соединение сам (тишина, ошибка записи)
+    connection.reader = asyncio.create_task(receive_messages(connection))
+    try:
+        await asyncio.wait((connection.reader,))
     finally:
-        db.close()
-
-async def send_message_to_user(message: Message, db):
+        connection.reader.cancel()
+        await manager.disconnect(user_id, connection)
+        await save_device_cursor(connection)
+
+async def save_message(db: AsyncSession, message: Message):
+    # Сводки для списка переписок пишутся в той же транзакции, что и сообщение
+    db.add(message)
+    await db.flush()
+    await record_messages(db, (message,))
+    with metrics.db_commit_seconds.labels("send").time():
+        await db.commit()
+    search_index.add_messages((message,))
+
+
+async def send_message_write_behind(
+        message: Message,
+        notify_sender: bool = False,
+        client_id=None
+) -> Optional[asyncio.Future]:
+    # Проверка до отправки в пачку: строка с несуществующим чатом уронила бы запись всей пачки.
+    # None — сообщение отклонено
+    participant_ids = None
+    if not message.receiver_id:
+        participant_ids = await membership.participants(message.chat_id)
+        if participant_ids is None:
+            logger.warning(f"Chat {message.chat_id} not found")
+            return None
+
+    # Доставка до записи: статус и курсоры доставки попадают в БД уже итоговыми
+    message.id = await persistence.allocate_id()
+    try:
+        payload = MessagePayload.from_message(message)
+        delivered_to = []
+        if message.receiver_id:
+            if await manager.send_personal_message(payload, message.receiver_id):
+                message.status = MessageStatus.DELIVERED
+        else:
+            recipients = [receiver_id for receiver_id in participant_ids if receiver_id != message.sender_id]
+            metrics.fanout_size.observe(len(recipients))
+            delivered_to = await manager.broadcast(payload, recipients)
+    except BaseException:
+        persistence.release(message.id)
+        raise
+    return persistence.submit(message, delivered_to, notify_sender, client_id)
+
+
+async def send_message_to_user(message: Message, db: AsyncSession):
     receiver_id = message.receiver_id
-    message_json = serialize_message(message)
-    if await manager.send_personal_message(message_json, receiver_id):
+    if await manager.send_personal_message(MessagePayload.from_message(message), receiver_id):
         message.status = MessageStatus.DELIVERED
-        db.commit()
-        logger.info(f"Message {message.id} delivered to user {receiver_id}")
+        with metrics.db_commit_seconds.labels("delivery_status").time():
+            await db.commit()
+        logger.debug("Message %s delivered to user %s", message.id, receiver_id)
     else:
-        logger.info(f"User {receiver_id} is offline. Message {message.id} not delivered.")
-        asyncio.create_task(resend_message_if_no_ack(message.id))
-
-async def resend_message_if_no_ack(message_id: int, attempts: int = 3, delay: int = 10):
-    db = SessionLocal()
-    try:
-        for attempt in range(attempts):
-            await asyncio.sleep(delay)
-            message = db.query(Message).filter(Message.id == message_id).first()
-            if message and message.status != MessageStatus.READ:
-                if message.receiver_id:
-                    await send_message_to_user(message, db)
-                else:
-                    await send_message_to_user(message, db)
-            else:
-                break
-    finally:
-        db.close()
+        logger.debug("User %s is offline. Message %s not delivered.", receiver_id, message.id)
+        retry_scheduler.schedule(message.id, receiver_id)
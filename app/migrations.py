@@ -0,0 +1,192 @@
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from database import engine
+from models import Base, ChatParticipant, Message, UploadedFile
+from utils.file_storage import upload_media_type
+from utils.search import create_search_schema
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def _add_column(conn, table: str, column: str, ddl: str):
+    columns = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def migrate_group_message_cursors(conn):
+    _add_column(conn, "chat_participants", "last_delivered_message_id", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(conn, "chat_participants", "last_read_message_id", "INTEGER NOT NULL DEFAULT 0")
+
+    # Курсор участника — последний оригинал, после которого у него нет недоставленных копий
+    for cursor_column, pending_condition in (
+        ("last_delivered_message_id", "c.status = 'SENT'"),
+        ("last_read_message_id", "c.status != 'READ'"),
+    ):
+        conn.execute(text(f"""
+            UPDATE chat_participants SET {cursor_column} = COALESCE((
+                SELECT MAX(m.id) FROM messages m
+                WHERE m.chat_id = chat_participants.chat_id
+                  AND m.receiver_id IS NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM messages c
+                      WHERE c.chat_id = chat_participants.chat_id
+                        AND c.receiver_id = chat_participants.user_id
+                        AND {pending_condition}
+                        AND c.timestamp <= m.timestamp
+                  )
+            ), 0)
+        """))
+
+    # Копии групповых сообщений больше не нужны: оригинал хранится с receiver_id = NULL
+    result = conn.execute(text(
+        "DELETE FROM messages WHERE chat_id IS NOT NULL AND receiver_id IS NOT NULL"
+    ))
+    logger.info(f"Removed {result.rowcount} per-recipient group message copies")
+
+
+def migrate_conversation_key(conn):
+    _add_column(conn, "messages", "conversation_key", "BIGINT")
+
+    # Ключ пары как в models.direct_conversation_key: (меньший id << 32) | больший id
+    conn.execute(text("""
+        UPDATE messages SET conversation_key =
+            (CASE WHEN sender_id < receiver_id THEN sender_id ELSE receiver_id END) * 4294967296
+            + (CASE WHEN sender_id < receiver_id THEN receiver_id ELSE sender_id END)
+        WHERE chat_id IS NULL AND receiver_id IS NOT NULL AND conversation_key IS NULL
+    """))
+
+    for index in Message.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def migrate_uploaded_file_hash(conn):
+    _add_column(conn, "uploaded_files", "content_hash", "VARCHAR(64)")
+    _add_column(conn, "uploaded_files", "size", "BIGINT")
+    for index in UploadedFile.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def migrate_message_file_url_index(conn):
+    for index in Message.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def migrate_chat_membership_version(conn):
+    _add_column(conn, "chats", "membership_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def migrate_message_search(conn):
+    # Индекс поиска по тексту сообщений: FTS5 в SQLite, GIN по tsvector в PostgreSQL
+    if create_search_schema(conn) is None:
+        logger.warning("Full-text search is not supported by the database, the in-memory index will be used")
+
+
+def migrate_conversation_summaries(conn):
+    # Таблицу conversation_summaries создает create_all в run_migrations
+    _add_column(conn, "chats", "last_message_id", "INTEGER")
+    _add_column(conn, "chats", "last_sender_id", "INTEGER")
+    _add_column(conn, "chats", "last_preview", "VARCHAR")
+    _add_column(conn, "chats", "last_message_at", "TIMESTAMP")
+    _add_column(conn, "chat_participants", "unread_count", "INTEGER NOT NULL DEFAULT 0")
+    for index in ChatParticipant.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+    # Личные переписки: строка на каждого из участников пары
+    conn.execute(text("""
+        INSERT INTO conversation_summaries (user_id, peer_id, last_message_id, last_sender_id, unread_count)
+        SELECT user_id, peer_id, MAX(id), 0, SUM(unread) FROM (
+            SELECT sender_id AS user_id, receiver_id AS peer_id, id, 0 AS unread
+            FROM messages WHERE chat_id IS NULL AND receiver_id IS NOT NULL
+            UNION ALL
+            SELECT receiver_id, sender_id, id, CASE WHEN status != 'READ' THEN 1 ELSE 0 END
+            FROM messages WHERE chat_id IS NULL AND receiver_id IS NOT NULL
+        ) AS pairs
+        WHERE NOT EXISTS (
+            SELECT 1 FROM conversation_summaries s WHERE s.user_id = pairs.user_id AND s.peer_id = pairs.peer_id
+        )
+        GROUP BY user_id, peer_id
+    """))
+    conn.execute(text("""
+        UPDATE conversation_summaries SET
+            last_sender_id = (SELECT m.sender_id FROM messages m WHERE m.id = conversation_summaries.last_message_id),
+            preview = (SELECT SUBSTR(m.content, 1, 100) FROM messages m WHERE m.id = conversation_summaries.last_message_id),
+            last_message_at = (SELECT m.timestamp FROM messages m WHERE m.id = conversation_summaries.last_message_id)
+        WHERE last_sender_id = 0
+    """))
+
+    conn.execute(text("""
+        UPDATE chats SET last_message_id = (
+            SELECT MAX(m.id) FROM messages m WHERE m.chat_id = chats.id AND m.receiver_id IS NULL
+        )
+        WHERE last_message_id IS NULL
+    """))
+    conn.execute(text("""
+        UPDATE chats SET
+            last_sender_id = (SELECT m.sender_id FROM messages m WHERE m.id = chats.last_message_id),
+            last_preview = (SELECT SUBSTR(m.content, 1, 100) FROM messages m WHERE m.id = chats.last_message_id),
+            last_message_at = (SELECT m.timestamp FROM messages m WHERE m.id = chats.last_message_id)
+        WHERE last_message_id IS NOT NULL AND last_sender_id IS NULL
+    """))
+    conn.execute(text("""
+        UPDATE chat_participants SET unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.chat_id = chat_participants.chat_id
+              AND m.receiver_id IS NULL
+              AND m.id > chat_participants.last_read_message_id
+              AND m.sender_id != chat_participants.user_id
+        )
+    """))
+
+
+def migrate_uploaded_file_content_type(conn):
+    _add_column(conn, "uploaded_files", "content_type", "VARCHAR")
+    # Для старых загрузок заявленный тип не сохранился, тип определяется по имени один раз
+    rows = conn.execute(text("SELECT id, filename FROM uploaded_files WHERE content_type IS NULL")).all()
+    for file_id, filename in rows:
+        conn.execute(
+            text("UPDATE uploaded_files SET content_type = :content_type WHERE id = :id"),
+            {"content_type": upload_media_type(filename, None), "id": file_id}
+        )
+
+
+MIGRATIONS = [
+    ("0001_group_message_cursors", migrate_group_message_cursors),
+    ("0002_conversation_key", migrate_conversation_key),
+    ("0003_uploaded_file_hash", migrate_uploaded_file_hash),
+    ("0004_message_file_url_index", migrate_message_file_url_index),
+    ("0005_chat_membership_version", migrate_chat_membership_version),
+    ("0006_message_search", migrate_message_search),
+    ("0007_conversation_summaries", migrate_conversation_summaries),
+    ("0008_uploaded_file_content_type", migrate_uploaded_file_content_type),
+]
+
+
+def run_migrations(bind=engine):
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "name VARCHAR PRIMARY KEY, applied_at TIMESTAMP NOT NULL)"
+        ))
+        applied = set(conn.execute(text("SELECT name FROM schema_migrations")).scalars())
+
+    for name, migration in MIGRATIONS:
+        if name in applied:
+            continue
+        with bind.begin() as conn:
+            migration(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :applied_at)"),
+                {"name": name, "applied_at": datetime.utcnow()}
+            )
+        logger.info(f"Applied migration {name}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    run_migrations()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Enum, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Enum, Boolean, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 import enum
@@ -28,6 +28,19 @@ class User(Base):
     uploaded_files = relationship("UploadedFile", back_populates="uploader")
 
 
+def direct_conversation_key(user_a: int, user_b: int) -> int:
+    # Упорядоченная пара id пользователей в одном BigInteger: одинакова для обоих направлений
+    low, high = sorted((user_a, user_b))
+    return (low << 32) | high
+
+
+def default_conversation_key(context):
+    params = context.get_current_parameters()
+    if params.get("chat_id") is None and params.get("receiver_id") is not None:
+        return direct_conversation_key(params["sender_id"], params["receiver_id"])
+    return None
+
+
 class Message(Base):
     __tablename__ = 'messages'
 
@@ -40,9 +53,30 @@ class Message(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     status = Column(Enum(MessageStatus), default=MessageStatus.SENT)
     file_url = Column(String, nullable=True)
+    conversation_key = Column(BigInteger, nullable=True, default=default_conversation_key)
 
     chat = relationship("Chat", back_populates="messages")
 
+    __table_args__ = (
+        # История личной переписки и лента чата — по ключу и id
+        Index("ix_messages_conversation_key_id", conversation_key, id),
+        Index("ix_messages_chat_id_id", chat_id, id),
+        # Недоставленные личные сообщения получателя
+        Index(
+            "ix_messages_undelivered",
+            receiver_id, status, id,
+            postgresql_where=chat_id.is_(None),
+            sqlite_where=chat_id.is_(None),
+        ),
+        # Проверка доступа к вложению по ссылке на файл
+        Index(
+            "ix_messages_file_url",
+            file_url,
+            postgresql_where=file_url.isnot(None),
+            sqlite_where=file_url.isnot(None),
+        ),
+    )
+
 
 class Chat(Base):
     __tablename__ = 'chats'
@@ -51,6 +85,13 @@ class Chat(Base):
     name = Column(String, nullable=True)
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Увеличивается при каждом изменении состава, по нему узлы сбрасывают кэш участников
+    membership_version = Column(Integer, nullable=False, default=0, server_default='0')
+    # Последнее сообщение чата для списка переписок (utils/inbox.py)
+    last_message_id = Column(Integer, nullable=True)
+    last_sender_id = Column(Integer, nullable=True)
+    last_preview = Column(String, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
 
     messages = relationship("Message", back_populates="chat")
     participants = relationship("ChatParticipant", back_populates="chat")
@@ -62,9 +103,53 @@ class ChatParticipant(Base):
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey('chats.id'))
     user_id = Column(Integer, nullable=False)
+    # Групповое сообщение хранится один раз, доставка и прочтение — курсоры участника
+    last_delivered_message_id = Column(Integer, nullable=False, default=0, server_default='0')
+    last_read_message_id = Column(Integer, nullable=False, default=0, server_default='0')
+    # Непрочитанные сообщения чата после last_read_message_id
+    unread_count = Column(Integer, nullable=False, default=0, server_default='0')
 
     chat = relationship("Chat", back_populates="participants")
 
+    __table_args__ = (
+        # Чаты пользователя: список переписок и кэш состава
+        Index("ix_chat_participants_user_id_chat_id", user_id, chat_id),
+    )
+
+
+class ConversationSummary(Base):
+    """Сводка личной переписки для одного из ее участников: последнее сообщение и непрочитанные."""
+
+    __tablename__ = 'conversation_summaries'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    peer_id = Column(Integer, nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    last_sender_id = Column(Integer, nullable=False)
+    preview = Column(String, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index("ix_conversation_summaries_user_id_peer_id", user_id, peer_id, unique=True),
+    )
+
+
+class DeviceCursor(Base):
+    """Курсор доставки устройства: все адресованное пользователю до last_message_id принято очередью устройства."""
+
+    __tablename__ = 'device_cursors'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    device_id = Column(String(64), nullable=False)
+    last_message_id = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index("ix_device_cursors_user_id_device_id", user_id, device_id, unique=True),
+    )
+
 
 class UploadedFile(Base):
     __tablename__ = 'uploaded_files'
@@ -72,7 +157,38 @@ class UploadedFile(Base):
     id = Column(Integer, primary_key=True, index=True)
     filename = Column(String, nullable=False)
     file_url = Column(String, nullable=False)
+    # Блобы хранятся по SHA-256 содержимого, повторная загрузка ссылается на тот же файл
+    content_hash = Column(String(64), nullable=True, index=True)
+    size = Column(BigInteger, nullable=True)
+    # Тип содержимого, определенный при загрузке; при отдаче по имени файла не угадывается
+    content_type = Column(String, nullable=True)
     uploader_id = Column(Integer, ForeignKey('users.id'))
     uploaded_at = Column(DateTime, default=datetime.utcnow())
 
-    uploader = relationship("User", back_populates="uploaded_files")
\ No newline at end of file
+    uploader = relationship("User", back_populates="uploaded_files")
+
+class ArchiveSegment(Base):
+    """
+    Сжатый сегмент холодной истории: сообщения одной переписки (личной или чата)
+    за один месяц, перенесенные из messages в файл под ARCHIVE_ROOT.
+    """
+
+    __tablename__ = 'archive_segments'
+
+    id = Column(Integer, primary_key=True)
+    # Заполнено одно из двух: ключ личной переписки или чат
+    conversation_key = Column(BigInteger, nullable=True)
+    chat_id = Column(Integer, nullable=True)
+    window_start = Column(DateTime, nullable=False)
+    min_message_id = Column(Integer, nullable=False)
+    max_message_id = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    # Путь относительно ARCHIVE_ROOT
+    path = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_archive_segments_conversation_key_max_id", conversation_key, max_message_id),
+        Index("ix_archive_segments_chat_id_max_id", chat_id, max_message_id),
+    )
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import httpx
+import jwt
+import pytest
+from sqlalchemy import select
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix="chat-tests-")
+
+# Окружение задается до импорта приложения: движок и хранилища создаются при импорте
+os.environ["DATABASE_URL"] = f"sqlite:///{DATA_DIR}/test.db"
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["MEDIA_ROOT"] = os.path.join(DATA_DIR, "media")
+os.environ["ARCHIVE_ROOT"] = os.path.join(DATA_DIR, "archive")
+sys.path.insert(0, APP_DIR)
+
+import main  # noqa: E402
+from database import AsyncSessionLocal, async_engine, engine  # noqa: E402
+from models import Base, Chat, ChatParticipant, ContentType, Message, MessageStatus  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def database():
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    for cache in (main.membership.chats, main.membership.user_chats, main.membership.seen_versions):
+        cache.clear()
+    yield
+
+
+def run(coro):
+    # Соединения aiosqlite привязаны к циклу событий: пул закрывается вместе с ним
+    async def scenario():
+        try:
+            return await coro
+        finally:
+            await async_engine.dispose()
+    return asyncio.run(scenario())
+
+
+def api_client(user_id: int) -> httpx.AsyncClient:
+    # ASGI без lifespan: фоновые задачи приложения тестам HTTP не нужны
+    token = jwt.encode({"user_id": user_id, "exp": datetime.utcnow() + timedelta(hours=1)}, "test-secret", algorithm="HS256")
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=main.app),
+        base_url="http://test",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+
+
+class FakeWebSocket:
+    """WebSocket без сети: исходящие кадры копятся в frames, входящие кладутся через push."""
+
+    def __init__(self, gate: asyncio.Event = None):
+        self.frames = []
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.closed = False
+        # Пока gate не установлен, отправка висит — так имитируется медленный клиент
+        self.gate = gate
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        if self.gate:
+            await self.gate.wait()
+        self.frames.append(json.loads(data))
+
+    async def send_bytes(self, data: bytes):
+        raise AssertionError("tests use the JSON encoding")
+
+    async def close(self, code: int = 1000):
+        self.closed = True
+
+    def push(self, data: dict):
+        self.incoming.put_nowait(data)
+
+    async def receive_json(self):
+        return await self.incoming.get()
+
+    def message_ids(self):
+        ids = []
+        for frame in self.frames:
+            if frame.get("action") == "new_messages":
+                ids.extend(message["message_id"] for message in frame["messages"])
+            elif "message_id" in frame:
+                ids.append(frame["message_id"])
+        return ids
+
+
+async def drain(connection):
+    # Ждем, пока задача записи отправит все кадры из очереди
+    while not connection.queue.empty():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+
+
+async def create_chat(user_ids) -> int:
+    async with AsyncSessionLocal() as db:
+        chat = Chat(name="test", is_group=True)
+        db.add(chat)
+        await db.flush()
+        db.add_all([ChatParticipant(chat_id=chat.id, user_id=user_id) for user_id in user_ids])
+        await db.commit()
+        return chat.id
+
+
+async def send_group_message(sender_id: int, chat_id: int, content: str) -> Message:
+    async with AsyncSessionLocal() as db:
+        message = Message(
+            sender_id=sender_id,
+            chat_id=chat_id,
+            content=content,
+            content_type=ContentType.TEXT,
+            timestamp=datetime.utcnow(),
+            status=MessageStatus.SENT
+        )
+        await main.save_message(db, message)
+        await main.send_message_to_chat(message, db)
+        return message
+
+
+async def send_direct_message(sender_id: int, receiver_id: int, content: str) -> Message:
+    async with AsyncSessionLocal() as db:
+        message = Message(
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            content=content,
+            content_type=ContentType.TEXT,
+            timestamp=datetime.utcnow(),
+            status=MessageStatus.SENT
+        )
+        await main.save_message(db, message)
+        return message
+
+
+async def delivered_cursor(chat_id: int, user_id: int) -> int:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(ChatParticipant.last_delivered_message_id).filter(
+            ChatParticipant.chat_id == chat_id,
+            ChatParticipant.user_id == user_id
+        ))
+        return result.scalar_one()
@@ -0,0 +1,122 @@
+import asyncio
+from typing import Dict, List, Set
+
+
+class ReplyError(str):
+    pass
+
+
+def encode(value) -> bytes:
+    if isinstance(value, ReplyError):
+        return b"-%s\r\n" % value.encode()
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+%s\r\n" % value.encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+def parse_score(value: bytes) -> float:
+    return {b"-inf": float("-inf"), b"+inf": float("inf")}.get(value) or float(value)
+
+
+class RespServer:
+    """
+    Локальная замена Redis для тестов бэкплейна: упорядоченные множества, EXPIRE без истечения
+    и pub/sub — только то, что использует RedisBackplane.
+    """
+
+    def __init__(self):
+        self.zsets: Dict[bytes, Dict[bytes, float]] = {}
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.commands: List[List[bytes]] = []
+        self.server = None
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}/0"
+
+    async def stop(self):
+        self.drop_subscribers()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop_subscribers(self):
+        # Имитация обрыва подписок, например при перезапуске Redis
+        writers = {writer for subscribers in self.channels.values() for writer in subscribers}
+        self.channels.clear()
+        for writer in writers:
+            writer.close()
+
+    def subscribers(self, channel: str) -> int:
+        return len(self.channels.get(channel.encode(), ()))
+
+    def count(self, name: str) -> int:
+        return sum(1 for command in self.commands if command[0].upper() == name.encode())
+
+    async def read_command(self, reader: asyncio.StreamReader) -> List[bytes]:
+        header = await reader.readline()
+        if not header:
+            raise ConnectionError("client closed")
+        args = []
+        for _ in range(int(header[1:-2])):
+            length = int((await reader.readline())[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                args = await self.read_command(reader)
+                self.commands.append(args)
+                for reply in self.execute(args, writer):
+                    writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subscribers in self.channels.values():
+                subscribers.discard(writer)
+            writer.close()
+
+    def execute(self, args: List[bytes], writer: asyncio.StreamWriter) -> list:
+        name, args = args[0].upper(), args[1:]
+        if name in (b"AUTH", b"SELECT", b"PING"):
+            return ["OK"]
+        if name == b"EXPIRE":
+            return [1]
+        if name == b"ZADD":
+            members = self.zsets.setdefault(args[0], {})
+            added = int(args[2] not in members)
+            members[args[2]] = float(args[1])
+            return [added]
+        if name == b"ZREM":
+            return [int(self.zsets.get(args[0], {}).pop(args[1], None) is not None)]
+        if name in (b"ZRANGEBYSCORE", b"ZREMRANGEBYSCORE"):
+            low, high = parse_score(args[1]), parse_score(args[2])
+            members = self.zsets.get(args[0], {})
+            matched = sorted((score, member) for member, score in members.items() if low <= score <= high)
+            if name == b"ZRANGEBYSCORE":
+                if b"WITHSCORES" in (arg.upper() for arg in args[3:]):
+                    return [[item for score, member in matched for item in (member, repr(score).encode())]]
+                return [[member for _, member in matched]]
+            for _, member in matched:
+                del members[member]
+            return [len(matched)]
+        if name == b"PUBLISH":
+            subscribers = self.channels.get(args[0], set())
+            for subscriber in subscribers:
+                subscriber.write(encode([b"message", args[0], args[1]]))
+            return [len(subscribers)]
+        if name == b"SUBSCRIBE":
+            replies = []
+            for index, channel in enumerate(args, 1):
+                self.channels.setdefault(channel, set()).add(writer)
+                replies.append([b"subscribe", channel, index])
+            return replies
+        return [ReplyError(f"ERR unknown command {name.decode()}")]
@@ -0,0 +1,43 @@
+import asyncio
+
+from conftest import FakeWebSocket, create_chat, drain, run, send_group_message
+from sqlalchemy import select
+
+import main
+from database import AsyncSessionLocal
+from models import ChatParticipant
+
+
+def test_malformed_ack_gets_error_frame_and_keeps_socket():
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        message = await send_group_message(1, chat_id, "hello")
+        websocket = FakeWebSocket()
+        connection = await main.manager.connect(2, websocket)
+        await drain(connection)
+        receiving = asyncio.create_task(main.receive_messages(connection))
+        try:
+            websocket.push({"action": "acknowledge", "message_ids": [message.id, "abc"]})
+            websocket.push({"action": "acknowledge", "message_ids": "12"})
+            websocket.push({"action": "read_up_to", "message_id": message.id})
+            websocket.push({"action": "read_up_to", "chat_id": chat_id, "message_id": None})
+            # После некорректных кадров соединение продолжает принимать корректные
+            websocket.push({"action": "read_up_to", "chat_id": str(chat_id), "message_id": message.id})
+            while not websocket.incoming.empty() and not receiving.done():
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+            assert not receiving.done()
+            errors = [frame["error"] for frame in websocket.frames if "error" in frame]
+            assert errors == ["Некорректные id сообщений"] * 2 + ["chat_id и message_id должны быть указаны"] * 2
+        finally:
+            receiving.cancel()
+            await asyncio.gather(receiving, return_exceptions=True)
+            await main.manager.disconnect(2, connection)
+
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(ChatParticipant.last_read_message_id).filter(
+                ChatParticipant.chat_id == chat_id,
+                ChatParticipant.user_id == 2
+            ))
+            assert result.scalar_one() == message.id
+    run(scenario())
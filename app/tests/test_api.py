@@ -0,0 +1,39 @@
+import asyncio
+
+from conftest import FakeWebSocket, api_client, drain, run
+
+import main
+
+
+def test_chat_round_trip_over_async_sessions():
+    async def scenario():
+        async with api_client(1) as alice, api_client(2) as bob, api_client(3) as carol:
+            response = await alice.post("/chats/", params={"name": "team"}, json=[2])
+            assert response.status_code == 200
+            chat_id = response.json()["chat_id"]
+
+            websocket = FakeWebSocket()
+            connection = await main.manager.connect(2, websocket)
+            try:
+                # Параллельные запросы получают каждый свою сессию и не мешают друг другу
+                responses = await asyncio.gather(*(
+                    alice.post("/send_message", params={"chat_id": chat_id, "content": f"hi {index}"})
+                    for index in range(10)
+                ))
+                sent = sorted(response.json()["message_id"] for response in responses)
+                assert len(set(sent)) == 10
+                await drain(connection)
+                assert sorted(websocket.message_ids()) == sent
+            finally:
+                await main.manager.disconnect(2, connection)
+
+            response = await bob.get(f"/chats/{chat_id}/messages")
+            assert [record["id"] for record in response.json()] == sent
+            assert (await carol.get(f"/chats/{chat_id}/messages")).status_code == 403
+
+            response = await bob.post("/send_message", params={"receiver_id": 1, "content": "direct"})
+            direct_id = response.json()["message_id"]
+            response = await alice.get("/messages/2")
+            assert [(record["id"], record["content"]) for record in response.json()] == [(direct_id, "direct")]
+            assert (await carol.post("/send_message", params={"content": "nowhere"})).status_code == 400
+    run(scenario())
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from conftest import DATA_DIR, api_client, run, send_direct_message
+
+from database import AsyncSessionLocal
+from models import ArchiveSegment, ContentType, Message, MessageStatus, direct_conversation_key
+from utils.archive import ArchiveJob, ArchiveStore, ColdScope, archive_store
+
+
+class BarrierStore(ArchiveStore):
+    """Держит запись сегментов, пока все запуски не выбрали свои пачки."""
+
+    def __init__(self, root: str, parties: int):
+        super().__init__(root)
+        self.parties = parties
+        self.arrived = 0
+        self.ready = asyncio.Event()
+
+    async def write(self, path, records):
+        self.arrived += 1
+        if self.arrived >= self.parties:
+            self.ready.set()
+        await self.ready.wait()
+        return await super().write(path, records)
+
+
+async def add_old_direct_messages(count: int):
+    async with AsyncSessionLocal() as db:
+        db.add_all([
+            Message(
+                sender_id=1,
+                receiver_id=2,
+                conversation_key=direct_conversation_key(1, 2),
+                content=f"old {index}",
+                content_type=ContentType.TEXT,
+                timestamp=datetime(2020, 1, 15),
+                status=MessageStatus.DELIVERED
+            )
+            for index in range(count)
+        ])
+        await db.commit()
+
+
+def test_concurrent_runs_do_not_duplicate_segments():
+    async def scenario():
+        await add_old_direct_messages(10)
+        store = BarrierStore(os.path.join(DATA_DIR, "archive-concurrent"), parties=2)
+        jobs = [ArchiveJob(store=store, after_days=30), ArchiveJob(store=store, after_days=30)]
+        archived = await asyncio.gather(*(job.run_once() for job in jobs))
+
+        assert sorted(archived) == [0, 10]
+        assert sum(job.conflicts_total for job in jobs) == 1
+        async with AsyncSessionLocal() as db:
+            assert (await db.execute(select(func.count(Message.id)))).scalar() == 0
+            segments = (await db.execute(select(ArchiveSegment))).scalars().all()
+        assert sum(segment.message_count for segment in segments) == 10
+
+        ids = [record["id"] async for record in store.iterate(ColdScope(conversation_key=direct_conversation_key(1, 2)), None, None)]
+        assert ids == list(range(1, 11))
+        # Откат проигравшего запуска не удалил файлы победителя
+        for segment in segments:
+            assert os.path.exists(store.full_path(segment.path))
+    run(scenario())
+
+
+def test_archived_messages_are_merged_into_history():
+    async def scenario():
+        await add_old_direct_messages(10)
+        for index in range(5):
+            await send_direct_message(2, 1, f"new {index}")
+        assert await ArchiveJob(store=archive_store, after_days=30).run_once() == 10
+
+        async with api_client(1) as client:
+            async def page(**params) -> list:
+                response = await client.get("/messages/2", params=params)
+                assert response.status_code == 200
+                return [record["id"] for record in response.json()]
+
+            async def stream(**params) -> list:
+                response = await client.get("/messages/2", params={**params, "stream": "true"})
+                assert response.status_code == 200
+                return [json.loads(line)["id"] for line in response.text.splitlines()]
+
+            # Страницы на границе архива и горячей таблицы не теряют и не дублируют сообщения
+            assert await page() == list(range(1, 16))
+            assert await page(limit=4) == [12, 13, 14, 15]
+            assert await page(before_id=12, limit=4) == [8, 9, 10, 11]
+            assert await page(after_id=8, limit=4) == [9, 10, 11, 12]
+            assert await stream() == list(range(1, 16))
+            assert await stream(before_id=13, limit=5) == [8, 9, 10, 11, 12]
+            assert await stream(before_id=6, limit=3) == [3, 4, 5]
+
+        async with api_client(3) as client:
+            assert (await client.get("/messages/2")).json() == []
+    run(scenario())
@@ -0,0 +1,83 @@
+import hashlib
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+from conftest import api_client, run
+
+import main  # noqa: F401  подключает счетчики кэша к метрикам
+from auth import claims_cache, decode_token, invalidate_user, resolve_user, users_cache
+from database import AsyncSessionLocal
+from models import User
+from utils import metrics
+from utils.connection_manager import get_password_hash, verify_password
+from utils.password_hasher import HasherOverloaded, password_hasher
+
+
+def test_claims_cache_counters_are_exported():
+    token = jwt.encode(
+        {"user_id": 1, "exp": datetime.utcnow() + timedelta(hours=1)}, "test-secret", algorithm="HS256"
+    )
+    # Другие тесты могли закэшировать побайтно такой же токен, выпущенный в ту же секунду
+    claims_cache.clear()
+    hits, misses = metrics.auth_cache_hits.function(), metrics.auth_cache_misses.function()
+    assert decode_token(token)["user_id"] == 1
+    assert decode_token(token)["user_id"] == 1
+    assert metrics.auth_cache_misses.function() - misses == 1
+    assert metrics.auth_cache_hits.function() - hits == 1
+    assert f"chat_auth_cache_hits_total {hits + 1}" in metrics.registry.render()
+
+
+def test_user_cache_is_invalidated():
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            db.add(User(id=7, username="alice", hashed_password="x"))
+            await db.commit()
+        token = jwt.encode({"user_id": 7, "exp": datetime.utcnow() + timedelta(hours=1)}, "test-secret", algorithm="HS256")
+        decode_token(token)
+
+        misses = users_cache.misses
+        assert (await resolve_user(7)).username == "alice"
+        assert (await resolve_user(7)).username == "alice"
+        assert users_cache.misses - misses == 1
+
+        async with AsyncSessionLocal() as db:
+            (await db.get(User, 7)).username = "bob"
+            await db.commit()
+        # Без сброса отдается закэшированная строка, после него — измененная, а токены проверяются заново
+        assert (await resolve_user(7)).username == "alice"
+        invalidate_user(7)
+        assert users_cache.peek(7) is None
+        assert claims_cache.peek(hashlib.sha256(token.encode()).digest()) is None
+        assert (await resolve_user(7)).username == "bob"
+        assert await resolve_user(8) is None
+    users_cache.clear()
+    run(scenario())
+    assert f"chat_auth_user_cache_misses_total {users_cache.misses}" in metrics.registry.render()
+
+
+def test_password_hashing_is_rejected_when_hasher_is_overloaded():
+    async def scenario():
+        hashed = await get_password_hash("secret")
+        assert await verify_password("secret", hashed)
+        async with AsyncSessionLocal() as db:
+            db.add(User(id=7, username="alice", hashed_password=hashed))
+            await db.commit()
+
+        async with api_client(7) as client:
+            response = await client.post("/token", data={"username": "alice", "password": "secret"})
+            assert response.status_code == 200
+            # Очередь пула заполнена: и вход, и хэширование отклоняются без обращения к bcrypt
+            password_hasher.in_flight = password_hasher.limit
+            try:
+                response = await client.post("/token", data={"username": "alice", "password": "secret"})
+                assert response.status_code == 503
+                assert response.headers["retry-after"] == "1"
+                rejected = password_hasher.rejected
+                with pytest.raises(HasherOverloaded):
+                    await get_password_hash("other")
+                assert password_hasher.rejected - rejected == 1
+            finally:
+                password_hasher.in_flight = 0
+    run(scenario())
@@ -0,0 +1,226 @@
+import asyncio
+
+import pytest
+
+from conftest import run
+from resp_server import RespServer
+
+from utils.backplane import Backplane, RedisBackplane, RespConnection, RespError
+from utils.connection_manager import ConnectionManager
+from utils.retry_scheduler import RetryScheduler
+
+
+class Node:
+    """Узел бэкплейна с записью доставленных сообщений вместо сокетов."""
+
+    def __init__(self, url: str, accept: bool = True, **options):
+        self.backplane = RedisBackplane(url, ack_timeout=0.5, reconnect_max=0.2, **options)
+        self.accept = accept
+        self.delivered = []
+
+    async def deliver(self, user_id, message) -> bool:
+        self.delivered.append((user_id, message))
+        return self.accept
+
+    async def start(self) -> "Node":
+        await self.backplane.start(self.deliver)
+        return self
+
+
+async def wait_for(predicate, timeout: float = 2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "condition was not met in time"
+        await asyncio.sleep(0.01)
+
+
+def with_server(scenario):
+    async def wrapper():
+        server = RespServer()
+        url = await server.start()
+        try:
+            await scenario(server, url)
+        finally:
+            await server.stop()
+    run(wrapper())
+
+
+def test_backplane_is_abstract():
+    with pytest.raises(TypeError):
+        Backplane()
+
+
+def test_pipeline_reads_every_reply_after_error():
+    async def scenario(server, url):
+        connection = await RespConnection.open(url)
+        try:
+            with pytest.raises(RespError):
+                await connection.pipeline([("NOSUCH",), ("ZADD", "key", "1", "member")])
+            # Ответ на ZADD дочитан внутри конвейера и не достался следующей команде
+            assert await connection.execute("ZRANGEBYSCORE", "key", "-inf", "+inf") == [b"member"]
+        finally:
+            await connection.close()
+    with_server(scenario)
+
+
+def test_publish_waits_for_remote_delivery():
+    async def scenario(server, url):
+        sender, receiver = await Node(url).start(), await Node(url).start()
+        refusing = await Node(url, accept=False).start()
+        try:
+            await receiver.backplane.register(1)
+            await refusing.backplane.register(2)
+            assert await sender.backplane.publish(1, "hello")
+            assert receiver.delivered == [(1, "hello")]
+            # Подписчик у канала есть, но сообщение не принято: это не доставка
+            assert not await sender.backplane.publish(2, "hello")
+            assert refusing.delivered == [(2, "hello")]
+            assert not await sender.backplane.publish(3, "nobody")
+        finally:
+            for node in (sender, receiver, refusing):
+                await node.backplane.stop()
+    with_server(scenario)
+
+
+def test_group_fanout_is_one_publish_per_node():
+    async def scenario(server, url):
+        sender, receiver = await Node(url).start(), await Node(url).start()
+        try:
+            for user_id in range(1, 51):
+                await receiver.backplane.register(user_id)
+            publishes = server.count("PUBLISH")
+            delivered = await sender.backplane.publish_many(range(1, 61), "group")
+            assert delivered == set(range(1, 51))
+            # Одно сообщение узлу получателей и одно подтверждение обратно
+            assert server.count("PUBLISH") - publishes == 2
+            assert len(receiver.delivered) == 50
+        finally:
+            await sender.backplane.stop()
+            await receiver.backplane.stop()
+    with_server(scenario)
+
+
+def test_presence_of_dead_node_expires():
+    async def scenario(server, url):
+        sender = await Node(url).start()
+        dead = await Node(url, presence_ttl=0.3).start()
+        try:
+            await dead.backplane.register(1)
+            # Узел перестает продлевать присутствие и слушать канал, не убирая записи
+            dead.backplane.refresher.cancel()
+            dead.backplane.listener.cancel()
+            await dead.backplane.subscriber.close()
+            assert not await sender.backplane.publish(1, "lost")
+
+            await asyncio.sleep(0.4)
+            publishes = server.count("PUBLISH")
+            assert await sender.backplane.publish_many([1], "lost") == set()
+            assert server.count("PUBLISH") == publishes
+        finally:
+            await sender.backplane.stop()
+    with_server(scenario)
+
+
+def test_listener_resubscribes_after_connection_loss():
+    async def scenario(server, url):
+        sender, receiver = await Node(url).start(), await Node(url).start()
+        try:
+            await receiver.backplane.register(1)
+            server.zsets.clear()
+            server.drop_subscribers()
+            # После переподписки узел заново объявляет присутствие своих пользователей
+            await wait_for(lambda: server.subscribers(receiver.backplane.channel) == 1)
+            await wait_for(lambda: server.zsets)
+            await wait_for(lambda: server.subscribers(sender.backplane.channel) == 1)
+            assert await sender.backplane.publish(1, "again")
+            assert receiver.delivered == [(1, "again")]
+        finally:
+            await sender.backplane.stop()
+            await receiver.backplane.stop()
+    with_server(scenario)
+
+
+def test_offline_users_are_parked_after_one_presence_lookup():
+    async def scenario(server, url):
+        receiver = await Node(url).start()
+        manager = ConnectionManager(backplane=RedisBackplane(url))
+        await manager.start()
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+            return True
+
+        scheduler = RetryScheduler(send=send, offline_users=manager.offline_users, delay=0)
+        try:
+            await receiver.backplane.register(1)
+            assert await manager.offline_users([1, 2, 3]) == {2, 3}
+
+            lookups = server.count("ZRANGEBYSCORE")
+            scheduler.start()
+            for message_id in range(1, 4):
+                scheduler.schedule(message_id, 2)
+            await wait_for(lambda: scheduler.parked_count == 3)
+            # Одна пачка повторов — один запрос присутствия, отправок нет
+            assert server.count("ZRANGEBYSCORE") - lookups == 2
+            assert sent == []
+        finally:
+            await scheduler.stop()
+            await manager.stop()
+            await receiver.backplane.stop()
+    with_server(scenario)
+
+
+def test_unresponsive_node_is_skipped_until_it_refreshes():
+    async def scenario(server, url):
+        sender = await Node(url).start()
+        silent = await Node(url).start()
+        try:
+            await silent.backplane.register(1)
+            # Узел подписан на канал, но не отвечает: например, завис или упал без закрытия соединения
+            silent.backplane.listener.cancel()
+            loop = asyncio.get_running_loop()
+
+            started = loop.time()
+            assert not await sender.backplane.publish(1, "first")
+            assert loop.time() - started >= 0.5
+
+            started, publishes = loop.time(), server.count("PUBLISH")
+            assert not await sender.backplane.publish(1, "second")
+            assert loop.time() - started < 0.25
+            assert server.count("PUBLISH") == publishes
+            assert await sender.backplane.offline_users([1]) == {1}
+
+            # Продлив срок, узел снова получает сообщения
+            await asyncio.sleep(0.01)
+            await silent.backplane.refresh_presence()
+            assert await sender.backplane.offline_users([1]) == set()
+        finally:
+            await sender.backplane.stop()
+            await silent.backplane.stop()
+    with_server(scenario)
+
+
+def test_broadcast_resolves_presence_in_one_pipeline(monkeypatch):
+    async def scenario(server, url):
+        receiver = await Node(url).start()
+        manager = ConnectionManager(backplane=RedisBackplane(url))
+        await manager.start()
+        try:
+            for user_id in range(1, 21):
+                await receiver.backplane.register(user_id)
+            pipelines = []
+            pipeline = manager.backplane.pipeline
+
+            async def recording_pipeline(commands):
+                pipelines.append([command[0] for command in commands])
+                return await pipeline(commands)
+
+            monkeypatch.setattr(manager.backplane, "pipeline", recording_pipeline)
+            delivered = await manager.broadcast("group", range(1, 41))
+            assert sorted(delivered) == list(range(1, 21))
+            assert pipelines == [["ZRANGEBYSCORE"] * 41, ["PUBLISH"]]
+        finally:
+            await manager.stop()
+            await receiver.backplane.stop()
+    with_server(scenario)
@@ -0,0 +1,49 @@
+import asyncio
+
+from conftest import FakeWebSocket, run
+
+from utils.connection_manager import POLICY_DISCONNECT, ConnectionManager
+from utils.heartbeat import HeartbeatMonitor
+
+
+def test_slow_consumer_disconnect_task_is_kept_until_done():
+    async def scenario():
+        manager = ConnectionManager(slow_consumer_policy=POLICY_DISCONNECT, queue_size=1)
+        websocket = FakeWebSocket(gate=asyncio.Event())
+        connection = await manager.connect(1, websocket)
+        # Клиент не читает: очередь переполняется, и отключение уходит в фоновую задачу
+        while manager.offer(connection, '{"action": "pong"}'):
+            await asyncio.sleep(0)
+        assert len(manager.tasks) == 1
+        await asyncio.gather(*manager.tasks)
+        assert not manager.tasks
+        assert websocket.closed
+        assert manager.get_connections(1) == ()
+        assert manager.slow_disconnects_total == 1
+    run(scenario())
+
+
+def test_silent_connection_is_pinged_then_reaped():
+    async def scenario():
+        manager = ConnectionManager()
+        manager.heartbeat = HeartbeatMonitor(offer=manager.offer, reap=manager.reap, interval=0.05, timeout=0.15, tick=0.01)
+        await manager.start()
+        silent_socket, active_socket = FakeWebSocket(), FakeWebSocket()
+        silent = await manager.connect(1, silent_socket)
+        active = await manager.connect(2, active_socket)
+        try:
+            # Активный клиент присылает кадры чаще интервала и не получает ping
+            for _ in range(15):
+                await asyncio.sleep(0.02)
+                active.touch()
+            assert manager.get_connections(1) == ()
+            assert silent_socket.closed
+            assert silent_socket.frames == [{"action": "ping"}]
+            assert manager.get_connections(2) == (active,)
+            assert active_socket.frames == []
+            assert manager.heartbeat.stats() == {"tracked": 1, "pings_total": 1, "reaped_total": 1}
+        finally:
+            await manager.stop()
+            await manager.disconnect(2, active)
+        assert silent.heartbeat_slot is None
+    run(scenario())
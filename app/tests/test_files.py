@@ -0,0 +1,123 @@
+import hashlib
+import io
+import os
+
+import pytest
+from fastapi import UploadFile
+
+from conftest import api_client, run
+
+from utils import file_storage
+from utils.file_response import RangeNotSatisfiable, parse_range
+from utils.file_storage import UploadTooLarge, blob_path, store_upload
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-", 100) == (90, 99)
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=50-500", 100) == (50, 99)
+    # Несколько диапазонов и чужие единицы игнорируются: отдается файл целиком
+    assert parse_range("bytes=0-1,5-6", 100) is None
+    assert parse_range("items=0-1", 100) is None
+    for header in ("bytes=100-", "bytes=5-4", "bytes=-0"):
+        with pytest.raises(RangeNotSatisfiable):
+            parse_range(header, 100)
+
+
+async def upload(client, filename: str, body: bytes, content_type: str) -> int:
+    response = await client.post("/upload", files={"file": (filename, body, content_type)})
+    assert response.status_code == 200
+    return response.json()["file_id"]
+
+
+def test_download_ranges_and_etag():
+    async def scenario():
+        body = bytes(range(256)) * 4
+        async with api_client(1) as client:
+            file_id = await upload(client, "clip.mp4", body, "video/mp4")
+
+            response = await client.get(f"/files/{file_id}")
+            assert response.status_code == 200
+            assert response.content == body
+            etag = response.headers["etag"]
+
+            response = await client.get(f"/files/{file_id}", headers={"Range": "bytes=10-19"})
+            assert response.status_code == 206
+            assert response.content == body[10:20]
+            assert response.headers["content-range"] == f"bytes 10-19/{len(body)}"
+
+            response = await client.get(f"/files/{file_id}", headers={"Range": f"bytes={len(body)}-"})
+            assert response.status_code == 416
+            assert response.headers["content-range"] == f"bytes */{len(body)}"
+
+            response = await client.get(f"/files/{file_id}", headers={"If-None-Match": etag})
+            assert response.status_code == 304
+            assert response.content == b""
+
+            # If-Range с чужим ETag: диапазон не применяется
+            response = await client.get(f"/files/{file_id}", headers={"Range": "bytes=0-0", "If-Range": '"stale"'})
+            assert response.status_code == 200
+            assert len(response.content) == len(body)
+
+            response = await client.head(f"/files/{file_id}")
+            assert response.status_code == 200
+            assert response.headers["content-length"] == str(len(body))
+            assert response.content == b""
+
+        async with api_client(2) as client:
+            # Файл не отправлялся в переписке с пользователем 2
+            assert (await client.get(f"/files/{file_id}")).status_code == 404
+    run(scenario())
+
+
+def test_only_media_is_served_inline():
+    async def scenario():
+        async with api_client(1) as client:
+            cases = [
+                ("photo.png", b"\x89PNG", "image/png", "image/png", "inline"),
+                ("a.html", b"<script>alert(1)</script>", "text/html", "text/html; charset=utf-8", "attachment"),
+                ("a.svg", b"<svg onload='alert(1)'/>", "image/svg+xml", "image/svg+xml", "attachment"),
+                # Тип берется из загрузки, а не из имени файла
+                ("a.png", b"<script>alert(1)</script>", "text/html", "text/html; charset=utf-8", "attachment"),
+                ("notes", b"plain", "", "application/octet-stream", "attachment"),
+            ]
+            for filename, body, declared, served, disposition in cases:
+                file_id = await upload(client, filename, body, declared)
+                response = await client.get(f"/files/{file_id}")
+                assert response.headers["content-type"] == served
+                assert response.headers["content-disposition"].startswith(disposition + ";")
+                assert response.headers["x-content-type-options"] == "nosniff"
+    run(scenario())
+
+
+def stored_blobs() -> set:
+    return {name for _, _, names in os.walk(os.path.join(file_storage.MEDIA_ROOT, "blobs")) for name in names}
+
+
+def test_identical_uploads_share_one_blob(monkeypatch):
+    async def scenario():
+        before = stored_blobs()
+        # Маленькие куски: хэш и файл собираются из многих чтений
+        monkeypatch.setattr(file_storage, "UPLOAD_CHUNK_SIZE", 7)
+        body = b"same bytes " * 50
+        content_hash = hashlib.sha256(body).hexdigest()
+        file_ids = []
+        for user_id in (1, 2):
+            async with api_client(user_id) as client:
+                response = await client.post("/upload", files={"file": (f"copy{user_id}.txt", body, "text/plain")})
+                assert response.status_code == 200
+                assert response.json()["file_url"] == blob_path(content_hash)
+                file_ids.append(response.json()["file_id"])
+                response = await client.get(f"/files/{file_ids[-1]}")
+                assert response.content == body
+                assert response.headers["etag"] == f'"{content_hash}"'
+        assert file_ids[0] != file_ids[1]
+        assert stored_blobs() - before == {content_hash}
+
+        with pytest.raises(UploadTooLarge):
+            await store_upload(UploadFile(io.BytesIO(body), filename="big.txt"), max_size=len(body) - 1)
+        # Оборванная загрузка не оставляет временных файлов
+        assert os.listdir(os.path.join(file_storage.MEDIA_ROOT, "tmp")) == []
+    run(scenario())
@@ -0,0 +1,177 @@
+import asyncio
+from datetime import datetime
+
+from conftest import FakeWebSocket, create_chat, delivered_cursor, drain, run, send_group_message
+
+import main
+from database import AsyncSessionLocal
+from models import ContentType, Message, MessageStatus
+from utils import backlog, metrics
+from utils.backlog import replay_backlog, save_device_cursor
+from utils.connection_manager import POLICY_SPILL, ConnectionManager
+
+
+def test_live_message_does_not_skip_offline_backlog():
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        # Пользователь 2 офлайн: первое сообщение остается за курсором
+        first = await send_group_message(1, chat_id, "offline")
+        websocket = FakeWebSocket()
+        connection = await main.manager.connect(2, websocket)
+        try:
+            second = await send_group_message(1, chat_id, "live")
+            # Живая доставка второго сообщения не перескакивает недоставленное первое
+            assert await delivered_cursor(chat_id, 2) == 0
+
+            await replay_backlog(connection)
+            await drain(connection)
+            assert first.id in websocket.message_ids()
+            assert await delivered_cursor(chat_id, 2) == second.id
+        finally:
+            await main.manager.disconnect(2, connection)
+    run(scenario())
+
+
+def test_live_delivery_advances_caught_up_cursor():
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        websocket = FakeWebSocket()
+        connection = await main.manager.connect(2, websocket)
+        try:
+            first = await send_group_message(1, chat_id, "one")
+            second = await send_group_message(1, chat_id, "two")
+            assert await delivered_cursor(chat_id, 2) == second.id
+            # Курсор отправителя тоже проходит его сообщения
+            assert await delivered_cursor(chat_id, 1) == second.id
+            await drain(connection)
+            assert websocket.message_ids() == [first.id, second.id]
+        finally:
+            await main.manager.disconnect(2, connection)
+    run(scenario())
+
+
+def test_live_message_during_replay_keeps_remaining_backlog(monkeypatch):
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        offline = [await send_group_message(1, chat_id, f"offline {index}") for index in range(5)]
+        websocket = FakeWebSocket()
+        connection = await main.manager.connect(2, websocket)
+
+        # Живое сообщение приходит между пачками досылки
+        live = []
+        send_chunk = backlog.send_chunk
+
+        async def send_chunk_then_live(*args):
+            await send_chunk(*args)
+            if not live:
+                live.append(await send_group_message(1, chat_id, "live"))
+
+        monkeypatch.setattr(backlog, "BACKLOG_CHUNK_SIZE", 2)
+        monkeypatch.setattr(backlog, "send_chunk", send_chunk_then_live)
+        try:
+            await replay_backlog(connection)
+            await drain(connection)
+            received = websocket.message_ids()
+            assert all(message.id in received for message in offline)
+            assert live[0].id in received
+            assert await delivered_cursor(chat_id, 2) >= offline[-1].id
+        finally:
+            await main.manager.disconnect(2, connection)
+    run(scenario())
+
+
+def test_spilled_message_is_replayed_and_holds_cursor(monkeypatch):
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        manager = ConnectionManager(slow_consumer_policy=POLICY_SPILL, replay=replay_backlog, queue_size=1)
+        monkeypatch.setattr(main, "manager", manager)
+        spilled_before = metrics.frames_spilled.value
+        gate = asyncio.Event()
+        websocket = FakeWebSocket(gate)
+        connection = await manager.connect(2, websocket)
+        try:
+            # Первое сообщение зависает в отправке, второе занимает очередь, остальные не помещаются
+            messages = [await send_group_message(1, chat_id, f"message {index}") for index in range(4)]
+            assert manager.spilled_total == 2
+            assert metrics.frames_spilled.value - spilled_before == 2
+            assert await delivered_cursor(chat_id, 2) == messages[1].id
+
+            gate.set()
+            await connection.replay_task
+            await drain(connection)
+            assert [message.id for message in messages] == sorted(set(websocket.message_ids()))
+            assert await delivered_cursor(chat_id, 2) == messages[-1].id
+        finally:
+            await manager.disconnect(2, connection)
+    run(scenario())
+
+
+def test_message_spilled_on_one_device_is_not_delivered(monkeypatch):
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        manager = ConnectionManager(slow_consumer_policy=POLICY_SPILL, replay=replay_backlog, queue_size=1)
+        monkeypatch.setattr(main, "manager", manager)
+        gate = asyncio.Event()
+        fast, slow = FakeWebSocket(), FakeWebSocket(gate)
+        fast_connection = await manager.connect(2, fast)
+        slow_connection = await manager.connect(2, slow)
+        try:
+            messages = [await send_group_message(1, chat_id, f"message {index}") for index in range(3)]
+            # Третье сообщение принял только быстрый клиент: курсор его не проходит
+            assert await delivered_cursor(chat_id, 2) == messages[1].id
+
+            gate.set()
+            await slow_connection.replay_task
+            await drain(fast_connection)
+            await drain(slow_connection)
+            assert messages[2].id in slow.message_ids()
+            assert await delivered_cursor(chat_id, 2) == messages[2].id
+        finally:
+            await manager.disconnect(2, fast_connection)
+            await manager.disconnect(2, slow_connection)
+    run(scenario())
+
+
+def test_device_cursor_replays_what_another_device_took():
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+
+        async def session(device_id: str):
+            websocket = FakeWebSocket()
+            connection = await main.manager.connect(2, websocket, device_id=device_id)
+            await replay_backlog(connection)
+            await drain(connection)
+            return websocket, connection
+
+        async def close(connection):
+            await main.manager.disconnect(2, connection)
+            await save_device_cursor(connection)
+
+        # Оба устройства уже подключались: у каждого есть свой курсор
+        for device_id in ("phone", "laptop"):
+            _, connection = await session(device_id)
+            await close(connection)
+
+        phone, connection = await session("phone")
+        group = await send_group_message(1, chat_id, "group")
+        async with AsyncSessionLocal() as db:
+            direct = Message(
+                sender_id=1, receiver_id=2, content="direct", content_type=ContentType.TEXT,
+                timestamp=datetime.utcnow(), status=MessageStatus.SENT
+            )
+            await main.save_message(db, direct)
+            await main.send_message_to_user(direct, db)
+        await drain(connection)
+        await close(connection)
+        assert phone.message_ids() == [group.id, direct.id]
+        assert await delivered_cursor(chat_id, 2) == group.id
+
+        # Ноутбук не был в сети: досылка по курсору устройства, хотя пользователю все уже доставлено
+        laptop, connection = await session("laptop")
+        await close(connection)
+        assert laptop.message_ids() == [group.id, direct.id]
+
+        phone, connection = await session("phone")
+        await close(connection)
+        assert phone.message_ids() == []
+    run(scenario())
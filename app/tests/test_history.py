@@ -0,0 +1,44 @@
+import json
+from datetime import datetime
+
+from conftest import run
+
+from database import AsyncSessionLocal
+from models import ContentType, Message, MessageStatus, direct_conversation_key
+from sqlalchemy import select
+from utils.history import fetch_history_page, stream_history
+
+
+CONVERSATION = direct_conversation_key(1, 2)
+
+
+async def add_direct_messages(count: int):
+    async with AsyncSessionLocal() as db:
+        db.add_all([
+            Message(
+                sender_id=1,
+                receiver_id=2,
+                content=f"message {index}",
+                content_type=ContentType.TEXT,
+                timestamp=datetime.utcnow(),
+                status=MessageStatus.SENT
+            )
+            for index in range(count)
+        ])
+        await db.commit()
+
+
+async def streamed_ids(response) -> list:
+    return [json.loads(line)["id"] async for line in response.body_iterator]
+
+
+def test_stream_with_before_id_and_limit_matches_page():
+    async def scenario():
+        await add_direct_messages(10)
+        query = select(Message).filter(Message.conversation_key == CONVERSATION)
+        for before_id, after_id, limit in ((8, None, 3), (None, None, 4), (None, 2, 3), (3, None, 5)):
+            async with AsyncSessionLocal() as db:
+                page = [record["id"] for record in await fetch_history_page(db, query, before_id, after_id, limit)]
+            assert await streamed_ids(stream_history(query, before_id, after_id, limit)) == page
+        assert await streamed_ids(stream_history(query, 8, None, 3)) == [5, 6, 7]
+    run(scenario())
@@ -0,0 +1,59 @@
+import json
+
+from conftest import api_client, create_chat, run, send_direct_message, send_group_message
+
+from utils.ack_buffer import AckBuffer
+
+
+async def inbox(user_id: int) -> dict:
+    async with api_client(user_id) as client:
+        response = await client.get("/inbox")
+        assert response.status_code == 200
+        return {(row["kind"], row["peer_id"] or row["chat_id"]): row for row in response.json()}
+
+
+def test_unread_counters_follow_acks_and_read_cursor():
+    async def scenario():
+        chat_id = await create_chat([1, 2, 3])
+        direct = [await send_direct_message(1, 2, f"direct {index}") for index in range(3)]
+        first = await send_group_message(1, chat_id, "group 0")
+        second = await send_group_message(1, chat_id, "group 1")
+        last = await send_group_message(3, chat_id, "group 2")
+
+        rows = await inbox(2)
+        assert list(rows) == [("chat", chat_id), ("direct", 1)]
+        assert rows[("direct", 1)]["unread_count"] == 3
+        assert rows[("direct", 1)]["preview"] == "direct 2"
+        assert rows[("chat", chat_id)]["unread_count"] == 3
+        assert rows[("chat", chat_id)]["last_message_id"] == last.id
+        # Свои сообщения в счетчик не попадают
+        assert (await inbox(1))[("direct", 2)]["unread_count"] == 0
+        assert (await inbox(1))[("chat", chat_id)]["unread_count"] == 1
+
+        receipts = []
+
+        async def notify(frame: str, user_id: int) -> bool:
+            receipts.append((user_id, json.loads(frame)))
+            return True
+
+        ack_buffer = AckBuffer(2, notify)
+        ack_buffer.add([direct[0].id, direct[1].id])
+        ack_buffer.add_read_up_to(chat_id, second.id)
+        await ack_buffer.close()
+        rows = await inbox(2)
+        assert rows[("direct", 1)]["unread_count"] == 1
+        assert rows[("chat", chat_id)]["unread_count"] == 1
+        assert receipts == [(1, {"action": "read_receipt", "reader_id": 2, "message_ids": [direct[0].id, direct[1].id]})]
+
+        # Повторное подтверждение и курсор назад счетчики не меняют; подтверждение группового id двигает курсор
+        ack_buffer.add([direct[0].id])
+        ack_buffer.add_read_up_to(chat_id, first.id)
+        await ack_buffer.close()
+        assert (await inbox(2))[("direct", 1)]["unread_count"] == 1
+        assert (await inbox(2))[("chat", chat_id)]["unread_count"] == 1
+        ack_buffer.add([direct[2].id, last.id])
+        await ack_buffer.close()
+        rows = await inbox(2)
+        assert rows[("direct", 1)]["unread_count"] == 0
+        assert rows[("chat", chat_id)]["unread_count"] == 0
+    run(scenario())
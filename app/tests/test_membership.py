@@ -0,0 +1,39 @@
+from conftest import create_chat, run
+
+from database import AsyncSessionLocal
+from models import ChatParticipant
+from utils.membership import EVENT_MEMBERSHIP, MembershipIndex, bump_membership_version
+
+
+def test_membership_version_invalidates_other_nodes():
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        writer, reader = MembershipIndex(), MembershipIndex()
+        assert await reader.participants(chat_id) == {1, 2}
+        assert await reader.chats_of(3) == frozenset()
+        assert await reader.participants(chat_id + 1) is None
+
+        async with AsyncSessionLocal() as db:
+            db.add(ChatParticipant(chat_id=chat_id, user_id=3))
+            version = await bump_membership_version(db, chat_id)
+            await db.commit()
+        await writer.chat_changed(chat_id, version, [1, 2, 3], [3])
+        assert await writer.participants(chat_id) == {1, 2, 3}
+        # Без события другой узел отвечает из кэша
+        assert await reader.participants(chat_id) == {1, 2}
+
+        event = {"type": EVENT_MEMBERSHIP, "chat_id": chat_id, "version": version, "user_ids": [3]}
+        await reader.handle_event(event)
+        assert reader.chats.peek(chat_id) is None
+        assert await reader.participants(chat_id) == {1, 2, 3}
+        assert await reader.chats_of(3) == {chat_id}
+
+        # Запоздавшее событие со старой версией не сбрасывает свежую запись
+        await reader.handle_event({**event, "version": version - 1})
+        assert reader.chats.peek(chat_id) == (version, {1, 2, 3})
+
+        # Загрузка, начатая до изменения с большей версией, отвечает, но в кэш не попадает
+        reader.apply_change(chat_id, version + 1, [])
+        assert await reader.participants(chat_id) == {1, 2, 3}
+        assert reader.chats.peek(chat_id) is None
+    run(scenario())
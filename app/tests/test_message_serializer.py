@@ -0,0 +1,53 @@
+import json
+from datetime import datetime
+
+import pytest
+
+from models import ContentType, Message
+from utils import message_serializer
+from utils.message_serializer import ENCODING_MSGPACK, MessagePayload, negotiate_encoding, serialize_message
+
+
+def group_message() -> Message:
+    return Message(
+        id=5,
+        sender_id=1,
+        chat_id=3,
+        # Текст, похожий на поле receiver_id, не должен подменяться
+        content='Привет "receiver_id":null',
+        content_type=ContentType.TEXT,
+        timestamp=datetime(2024, 5, 1, 12, 30),
+    )
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_payload_is_encoded_once_per_fanout(monkeypatch, fast):
+    if not fast:
+        monkeypatch.setattr(message_serializer, "orjson", None)
+    payload = MessagePayload.from_message(group_message())
+    expected = {
+        "action": "new_message",
+        "message_id": 5,
+        "sender_id": 1,
+        "receiver_id": None,
+        "chat_id": 3,
+        "content": 'Привет "receiver_id":null',
+        "content_type": "text",
+        "timestamp": "2024-05-01T12:30:00",
+        "file_url": None,
+    }
+    assert json.loads(payload.json()) == expected
+    parts = payload.json_parts
+    for receiver_id in (2, 4):
+        assert json.loads(payload.json(receiver_id)) == dict(expected, receiver_id=receiver_id)
+    assert payload.json_parts is parts
+    assert json.loads(serialize_message(group_message(), 7)) == dict(expected, receiver_id=7)
+
+
+def test_msgpack_payload_per_receiver():
+    msgpack = pytest.importorskip("msgpack")
+    payload = MessagePayload.from_message(group_message())
+    assert negotiate_encoding(ENCODING_MSGPACK) == ENCODING_MSGPACK
+    assert payload.encode(ENCODING_MSGPACK) is payload.encode(ENCODING_MSGPACK)
+    assert msgpack.unpackb(payload.encode(ENCODING_MSGPACK, receiver_id=2)) == payload.as_dict(2)
+    assert msgpack.unpackb(payload.encode(ENCODING_MSGPACK))["receiver_id"] is None
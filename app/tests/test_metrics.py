@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import api_client, create_chat, run, send_group_message
+
+from utils import metrics
+from utils.metrics import Registry
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    counter = registry.counter("jobs_total", "Jobs done", ["kind"])
+    registry.gauge("queue_depth", "Queued jobs", lambda: 3)
+    histogram = registry.histogram("job_seconds", "Job duration", buckets=(1, 5))
+    counter.labels("fast").inc()
+    counter.labels("slow").inc(2)
+    for value in (0.5, 1, 7):
+        histogram.observe(value)
+    with pytest.raises(ValueError):
+        registry.counter("jobs_total", "Duplicate")
+
+    assert registry.render() == "\n".join([
+        "# HELP jobs_total Jobs done",
+        "# TYPE jobs_total counter",
+        'jobs_total{kind="fast"} 1',
+        'jobs_total{kind="slow"} 2',
+        "# HELP queue_depth Queued jobs",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+        "# HELP job_seconds Job duration",
+        "# TYPE job_seconds histogram",
+        'job_seconds_bucket{le="1"} 2',
+        'job_seconds_bucket{le="5"} 2',
+        'job_seconds_bucket{le="+Inf"} 3',
+        "job_seconds_sum 8.5",
+        "job_seconds_count 3",
+    ]) + "\n"
+
+
+def test_metrics_endpoint_counts_message_path():
+    async def scenario():
+        chat_id = await create_chat([1, 2, 3])
+        commits = metrics.db_commit_seconds.labels("send").count
+        fanouts = metrics.fanout_size.count
+        await send_group_message(1, chat_id, "hello")
+
+        async with api_client(1) as client:
+            response = await client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        assert f'chat_db_commit_seconds_count{{path="send"}} {commits + 1}' in response.text
+        assert f"chat_fanout_size_count {fanouts + 1}" in response.text
+        assert "# TYPE chat_active_connections gauge" in response.text
+    run(scenario())
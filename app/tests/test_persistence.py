@@ -0,0 +1,124 @@
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+from conftest import FakeWebSocket, create_chat, run
+
+import main
+from database import AsyncSessionLocal
+from models import ChatParticipant, ContentType, ConversationSummary, Message, MessageStatus
+from utils.ack_buffer import AckBuffer
+from utils.persistence import PersistencePipeline
+
+
+def new_message(**fields) -> Message:
+    return Message(
+        sender_id=1,
+        content="hello",
+        content_type=ContentType.TEXT,
+        timestamp=datetime.utcnow(),
+        status=MessageStatus.SENT,
+        **fields
+    )
+
+
+def test_failed_row_does_not_fail_the_batch():
+    async def scenario():
+        frames = []
+
+        async def notify(frame, user_id):
+            frames.append(json.loads(frame))
+            return True
+
+        async def on_committed(messages):
+            pass
+
+        pipeline = PersistencePipeline(notify=notify, on_committed=on_committed, window_ms=50)
+        pipeline.start()
+        try:
+            taken = await pipeline.allocate_id()
+            async with AsyncSessionLocal() as db:
+                db.add(new_message(id=taken, receiver_id=2))
+                await db.commit()
+
+            # Первая строка повторяет занятый id и не пишется, вторая должна записаться
+            duplicate = pipeline.submit(new_message(id=taken, receiver_id=2), notify_sender=True)
+            good_message = new_message(id=await pipeline.allocate_id(), receiver_id=2)
+            good = pipeline.submit(good_message, notify_sender=True)
+            assert await good == good_message.id
+            with pytest.raises(Exception):
+                await duplicate
+        finally:
+            await pipeline.stop()
+
+        assert pipeline.failed_total == 1
+        assert pipeline.messages_total == 1
+        assert {frame["action"] for frame in frames} == {"persisted", "persist_failed"}
+        async with AsyncSessionLocal() as db:
+            ids = (await db.execute(select(Message.id))).scalars().all()
+        assert sorted(ids) == [taken, good_message.id]
+    run(scenario())
+
+
+def test_write_behind_rejects_unknown_chat(monkeypatch):
+    async def scenario():
+        pipeline = PersistencePipeline(notify=main.manager.send_personal_message, on_committed=main.on_messages_committed)
+        monkeypatch.setattr(main, "persistence", pipeline)
+        pipeline.start()
+        try:
+            chat_id = await create_chat([1, 2])
+            assert await main.send_message_write_behind(new_message(chat_id=chat_id + 1)) is None
+            assert pipeline.queue == []
+            persisted = await main.send_message_write_behind(new_message(chat_id=chat_id))
+            assert await persisted is not None
+        finally:
+            await pipeline.stop()
+    run(scenario())
+
+
+def test_ack_before_commit_is_applied_after_it(monkeypatch):
+    async def scenario():
+        pipeline = PersistencePipeline(
+            notify=main.manager.send_personal_message, on_committed=main.on_messages_committed, window_ms=200
+        )
+        monkeypatch.setattr(main, "persistence", pipeline)
+        pipeline.start()
+        receipts = []
+
+        async def notify(frame, user_id):
+            receipts.append((user_id, json.loads(frame)))
+            return True
+
+        connection = await main.manager.connect(2, FakeWebSocket())
+        try:
+            chat_id = await create_chat([1, 2])
+            direct = new_message(receiver_id=2)
+            group = new_message(chat_id=chat_id)
+            persisted = [
+                await main.send_message_write_behind(direct),
+                await main.send_message_write_behind(group),
+            ]
+            # Получатель подтверждает сообщения раньше, чем пачка записана
+            ack_buffer = AckBuffer(2, notify, wait_persisted=pipeline.wait_persisted)
+            ack_buffer.add([direct.id, group.id])
+            await ack_buffer.flush()
+            assert all(future.done() for future in persisted)
+        finally:
+            await pipeline.stop()
+            await main.manager.disconnect(2, connection)
+
+        async with AsyncSessionLocal() as db:
+            assert (await db.get(Message, direct.id)).status == MessageStatus.READ
+            summary = (await db.execute(select(ConversationSummary).filter(
+                ConversationSummary.user_id == 2, ConversationSummary.peer_id == 1
+            ))).scalar_one()
+            assert summary.unread_count == 0
+            participant = (await db.execute(select(ChatParticipant).filter(
+                ChatParticipant.chat_id == chat_id, ChatParticipant.user_id == 2
+            ))).scalar_one()
+            assert participant.last_read_message_id == group.id
+            assert participant.unread_count == 0
+        assert receipts == [(1, {"action": "read_receipt", "reader_id": 2, "message_ids": [direct.id]})]
+    run(scenario())
@@ -0,0 +1,38 @@
+import pytest
+
+from conftest import api_client, create_chat, run, send_direct_message, send_group_message
+
+import main
+from utils.search import BACKEND_MEMORY, SearchIndex
+
+
+async def search(user_id: int, q: str) -> list:
+    async with api_client(user_id) as client:
+        response = await client.get("/search", params={"q": q})
+        assert response.status_code == 200
+        return [record["id"] for record in response.json()]
+
+
+@pytest.mark.parametrize("backend", [None, BACKEND_MEMORY])
+def test_search_is_scoped_to_own_conversations(monkeypatch, backend):
+    async def scenario():
+        chat_id = await create_chat([1, 2])
+        other_chat_id = await create_chat([3, 4])
+        # Индекс в памяти строится по уже записанным сообщениям и пополняется после коммита новых
+        draft = await send_direct_message(1, 3, "Quarterly report draft")
+        index = SearchIndex()
+        await index.start(backend=backend)
+        monkeypatch.setattr(main, "search_index", index)
+        assert index.backend == (backend or "fts5")
+
+        shared = await send_group_message(1, chat_id, "The report is ready")
+        await send_group_message(3, other_chat_id, "Secret report")
+        await send_direct_message(1, 2, "lunch?")
+
+        assert await search(2, "REPORT") == [shared.id]
+        assert sorted(await search(1, "report")) == [draft.id, shared.id]
+        # Все термы запроса обязательны, разметка FTS5 из запроса не разбирается
+        assert await search(1, "report draft") == [draft.id]
+        assert await search(3, 'draft" OR "secret') == []
+        assert await search(2, "...") == []
+    run(scenario())
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from sqlalchemy import select, update
+
+from database import AsyncSessionLocal
+from models import ChatParticipant, Message, MessageStatus
+from utils import metrics
+from utils.inbox import chat_unread_after, mark_direct_read
+
+
+logger = logging.getLogger(__name__)
+
+ACK_FLUSH_INTERVAL = float(os.getenv("ACK_FLUSH_INTERVAL", "0.2"))
+ACK_FLUSH_SIZE = int(os.getenv("ACK_FLUSH_SIZE", "100"))
+
+
+class AckBuffer:
+    """
+    Подтверждения прочтения одного соединения. Накапливаются и записываются
+    одним UPDATE раз в ACK_FLUSH_INTERVAL секунд или при ACK_FLUSH_SIZE подтверждениях,
+    уведомления отправителям уходят одним кадром на отправителя за сброс.
+    """
+
+    def __init__(
+            self,
+            user_id: int,
+            notify: Callable[[str, int], Awaitable[bool]],
+            interval: float = ACK_FLUSH_INTERVAL,
+            size: int = ACK_FLUSH_SIZE,
+            wait_persisted: Optional[Callable[[Iterable[int]], Awaitable[None]]] = None
+    ):
+        self.user_id = user_id
+        self.notify = notify
+        # При отложенной записи сообщение доставляется до коммита: подтверждения ждут его записи
+        self.wait_persisted = wait_persisted
+        self.interval = interval
+        self.size = size
+        self.message_ids: Set[int] = set()
+        self.read_up_to: Dict[int, int] = {}
+        self.full = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.message_ids) + len(self.read_up_to)
+
+    def add(self, message_ids: Iterable[int]):
+        self.message_ids.update(int(message_id) for message_id in message_ids)
+        self.schedule()
+
+    def add_read_up_to(self, chat_id: int, message_id: int):
+        self.read_up_to[chat_id] = max(self.read_up_to.get(chat_id, 0), int(message_id))
+        self.schedule()
+
+    def schedule(self):
+        if len(self) >= self.size:
+            self.full.set()
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        try:
+            await asyncio.wait_for(self.full.wait(), self.interval)
+        except asyncio.TimeoutError:
+            pass
+        self.full.clear()
+        self.flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing acknowledgements for user {self.user_id}: {e}")
+
+    async def close(self):
+        flush_task = self.flush_task
+        if flush_task:
+            self.full.set()
+            await flush_task
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Error flushing acknowledgements for user {self.user_id}: {e}")
+
+    async def flush(self):
+        async with self.lock:
+            message_ids, self.message_ids = self.message_ids, set()
+            read_up_to, self.read_up_to = self.read_up_to, {}
+            if not message_ids and not read_up_to:
+                return
+            if self.wait_persisted and message_ids:
+                await self.wait_persisted(message_ids)
+
+            receipts: Dict[int, list] = {}
+            async with AsyncSessionLocal() as db:
+                if message_ids:
+                    result = await db.execute(
+                        update(Message).filter(
+                            Message.id.in_(message_ids),
+                            Message.receiver_id == self.user_id,
+                            Message.chat_id == None,
+                            Message.status != MessageStatus.READ
+                        ).values(status=MessageStatus.READ)
+                        .returning(Message.id, Message.sender_id)
+                        .execution_options(synchronize_session=False)
+                    )
+                    for message_id, sender_id in result.all():
+                        receipts.setdefault(sender_id, []).append(message_id)
+                        message_ids.discard(message_id)
+                    await mark_direct_read(db, self.user_id, {
+                        sender_id: len(read_ids) for sender_id, read_ids in receipts.items()
+                    })
+
+                # Оставшиеся id могут быть групповыми: подтверждение двигает курсор участника
+                if message_ids:
+                    result = await db.execute(select(Message.id, Message.chat_id).filter(
+                        Message.id.in_(message_ids),
+                        Message.chat_id != None
+                    ))
+                    for message_id, chat_id in result.all():
+                        read_up_to[chat_id] = max(read_up_to.get(chat_id, 0), message_id)
+
+                for chat_id, message_id in read_up_to.items():
+                    await db.execute(update(ChatParticipant).filter(
+                        ChatParticipant.chat_id == chat_id,
+                        ChatParticipant.user_id == self.user_id,
+                        ChatParticipant.last_read_message_id < message_id
+                    ).values(
+                        last_read_message_id=message_id,
+                        unread_count=chat_unread_after(chat_id, self.user_id, message_id)
+                    ))
+                with metrics.db_commit_seconds.labels("acks").time():
+                    await db.commit()
+
+        for sender_id, read_ids in receipts.items():
+            await self.notify(json.dumps({
+                "action": "read_receipt",
+                "reader_id": self.user_id,
+                "message_ids": sorted(read_ids),
+            }), sender_id)
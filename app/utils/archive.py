@@ -0,0 +1,341 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import tempfile
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from database import AsyncSessionLocal
+from models import ArchiveSegment, ChatParticipant, Message, MessageStatus
+from utils.message_serializer import message_to_dict
+from utils.ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "0").lower() in ("1", "true", "yes")
+ARCHIVE_ROOT = os.getenv("ARCHIVE_ROOT", "archive")
+# Возраст сообщения, после которого оно уходит в холодное хранилище
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", "6"))
+ARCHIVE_CACHE_SEGMENTS = int(os.getenv("ARCHIVE_CACHE_SEGMENTS", "64"))
+ARCHIVE_CACHE_TTL = float(os.getenv("ARCHIVE_CACHE_TTL", "300"))
+
+
+class ColdScope(NamedTuple):
+    """Переписка, историю которой читают из архива: личная (conversation_key) или чат."""
+
+    conversation_key: Optional[int] = None
+    chat_id: Optional[int] = None
+
+
+def window_of(timestamp: datetime) -> datetime:
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def segment_path(scope: ColdScope, window_start: datetime, min_id: int, max_id: int, run_id: str) -> str:
+    if scope.chat_id is not None:
+        directory = os.path.join("chats", str(scope.chat_id))
+    else:
+        directory = os.path.join("direct", str(scope.conversation_key))
+    # run_id различает файлы параллельных запусков: проигравший откат удаляет только свои
+    return os.path.join(directory, f"{window_start:%Y-%m}-{min_id}-{max_id}-{run_id}.ndjson.z")
+
+
+def encode_segment(records: List[dict]) -> bytes:
+    lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+    return zlib.compress(lines.encode("utf-8"), ARCHIVE_COMPRESSION_LEVEL)
+
+
+def decode_segment(data: bytes) -> List[dict]:
+    return [json.loads(line) for line in zlib.decompress(data).decode("utf-8").splitlines()]
+
+
+def write_file(path: str, data: bytes):
+    # Файл появляется под своим именем только целиком
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as handle:
+        return handle.read()
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ArchiveConflict(Exception):
+    pass
+
+
+class ArchiveStore:
+    """
+    Чтение и запись сегментов холодной истории. Сегмент — NDJSON в формате message_to_dict,
+    сжатый zlib; распакованные сегменты держатся в небольшом LRU-кэше.
+    """
+
+    def __init__(self, root: str = ARCHIVE_ROOT, cache_size: int = ARCHIVE_CACHE_SEGMENTS, cache_ttl: float = ARCHIVE_CACHE_TTL):
+        self.root = root
+        self.segments = TTLCache(cache_size, cache_ttl)
+
+    def full_path(self, path: str) -> str:
+        return os.path.join(self.root, path)
+
+    async def write(self, path: str, records: List[dict]) -> int:
+        data = encode_segment(records)
+        await run_in_threadpool(write_file, self.full_path(path), data)
+        return len(data)
+
+    async def remove(self, path: str):
+        self.segments.pop(path)
+        await run_in_threadpool(remove_file, self.full_path(path))
+
+    async def load(self, path: str) -> List[dict]:
+        records = self.segments.get(path)
+        if records is None:
+            data = await run_in_threadpool(read_file, self.full_path(path))
+            records = await run_in_threadpool(decode_segment, data)
+            self.segments.set(path, records)
+        return records
+
+    @staticmethod
+    def segments_query(scope: ColdScope, low: Optional[int], high: Optional[int]):
+        if scope.chat_id is not None:
+            query = select(ArchiveSegment).filter(ArchiveSegment.chat_id == scope.chat_id)
+        else:
+            query = select(ArchiveSegment).filter(ArchiveSegment.conversation_key == scope.conversation_key)
+        if low is not None:
+            query = query.filter(ArchiveSegment.max_message_id > low)
+        if high is not None:
+            query = query.filter(ArchiveSegment.min_message_id < high)
+        return query
+
+    async def read_range(
+            self,
+            db: AsyncSession,
+            scope: ColdScope,
+            low: Optional[int],
+            high: Optional[int],
+            limit: int,
+            descending: bool
+    ) -> List[dict]:
+        """
+        До limit архивных сообщений с low < id < high, ближайших к high (descending)
+        или к low. Результат по возрастанию id.
+        """
+        query = self.segments_query(scope, low, high)
+        if descending:
+            query = query.order_by(ArchiveSegment.max_message_id.desc())
+        else:
+            query = query.order_by(ArchiveSegment.min_message_id.asc())
+        segments = (await db.execute(query)).scalars().all()
+
+        collected: List[dict] = []
+        for segment in segments:
+            if len(collected) >= limit:
+                # Сегменты упорядочены по границе, дальше лучших кандидатов уже не будет
+                ids = [record["id"] for record in collected]
+                if descending and segment.max_message_id < heapq.nlargest(limit, ids)[-1]:
+                    break
+                if not descending and segment.min_message_id > heapq.nsmallest(limit, ids)[-1]:
+                    break
+            for record in await self.load(segment.path):
+                if (low is None or record["id"] > low) and (high is None or record["id"] < high):
+                    collected.append(record)
+
+        collected.sort(key=lambda record: record["id"])
+        return collected[-limit:] if descending else collected[:limit]
+
+    async def iterate(self, scope: ColdScope, low: Optional[int], high: Optional[int]) -> AsyncIterator[dict]:
+        """Все архивные сообщения переписки в границах по возрастанию id, сегменты читаются по одному."""
+        async with AsyncSessionLocal() as db:
+            query = self.segments_query(scope, low, high).order_by(ArchiveSegment.min_message_id.asc())
+            segments = (await db.execute(query)).scalars().all()
+
+        pending: List[Tuple[int, dict]] = []
+        for index, segment in enumerate(segments):
+            for record in await self.load(segment.path):
+                if (low is None or record["id"] > low) and (high is None or record["id"] < high):
+                    heapq.heappush(pending, (record["id"], record))
+            # Следующие сегменты начинаются не раньше своего min_message_id: все, что меньше, можно отдавать
+            next_min = segments[index + 1].min_message_id if index + 1 < len(segments) else None
+            while pending and (next_min is None or pending[0][0] < next_min):
+                yield heapq.heappop(pending)[1]
+
+
+archive_store = ArchiveStore()
+
+
+class ArchiveJob:
+    """
+    Фоновый перенос старой истории в холодное хранилище. Переносятся сообщения старше
+    ARCHIVE_AFTER_DAYS: личные — доставленные или прочитанные, групповые — не новее
+    курсора доставки самого отстающего участника. Сообщения с вложениями остаются в messages:
+    по ним проверяется доступ к файлам. Сегменты режутся по переписке и календарному месяцу.
+    Параллельные запуски (несколько процессов) безопасны: пачка, часть которой уже удалил
+    другой запуск, откатывается вместе со своими сегментами.
+    """
+
+    def __init__(
+            self,
+            store: ArchiveStore = archive_store,
+            after_days: float = ARCHIVE_AFTER_DAYS,
+            interval: float = ARCHIVE_INTERVAL,
+            batch_size: int = ARCHIVE_BATCH_SIZE
+    ):
+        self.store = store
+        self.after_days = after_days
+        self.interval = interval
+        self.batch_size = batch_size
+        self.task: Optional[asyncio.Task] = None
+
+        self.runs_total = 0
+        self.archived_total = 0
+        self.segments_total = 0
+        self.conflicts_total = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                archived = await self.run_once()
+            except Exception as e:
+                logger.error(f"Error archiving messages: {e}")
+                archived = 0
+            # Полная пачка — вероятно, есть еще: продолжаем без паузы
+            if archived < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    def candidate_queries(self, cutoff: datetime):
+        base = (
+            Message.timestamp < cutoff,
+            Message.file_url.is_(None),
+        )
+        direct = select(Message).filter(
+            *base,
+            Message.chat_id.is_(None),
+            Message.conversation_key.isnot(None),
+            Message.status.in_((MessageStatus.DELIVERED, MessageStatus.READ))
+        )
+        cursors = select(
+            ChatParticipant.chat_id,
+            func.min(ChatParticipant.last_delivered_message_id).label("delivered_up_to")
+        ).group_by(ChatParticipant.chat_id).subquery()
+        group = select(Message).join(cursors, cursors.c.chat_id == Message.chat_id).filter(
+            *base,
+            Message.receiver_id.is_(None),
+            Message.id <= cursors.c.delivered_up_to
+        )
+        return direct, group
+
+    async def run_once(self) -> int:
+        self.runs_total += 1
+        cutoff = datetime.utcnow() - timedelta(days=self.after_days)
+        archived = 0
+        for query in self.candidate_queries(cutoff):
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(query.order_by(Message.id).limit(self.batch_size))
+                messages = result.scalars().all()
+                if not messages:
+                    continue
+                try:
+                    archived += await self.archive(db, messages)
+                except ArchiveConflict as e:
+                    # Пачку целиком перенесет следующий запуск, уже без чужих сообщений
+                    self.conflicts_total += 1
+                    logger.warning(f"Archive batch rolled back: {e}")
+        if archived:
+            logger.info(f"Archived {archived} messages older than {cutoff:%Y-%m-%d}")
+        return archived
+
+    async def archive(self, db: AsyncSession, messages: List[Message]) -> int:
+        groups: Dict[Tuple[ColdScope, datetime], List[Message]] = {}
+        for message in messages:
+            if message.chat_id is not None:
+                scope = ColdScope(chat_id=message.chat_id)
+            else:
+                scope = ColdScope(conversation_key=message.conversation_key)
+            groups.setdefault((scope, window_of(message.timestamp)), []).append(message)
+
+        run_id = uuid.uuid4().hex[:12]
+        written: List[str] = []
+        try:
+            for (scope, window_start), group in groups.items():
+                records = [message_to_dict(message) for message in group]
+                min_id, max_id = group[0].id, group[-1].id
+                path = segment_path(scope, window_start, min_id, max_id, run_id)
+                size = await self.store.write(path, records)
+                written.append(path)
+                db.add(ArchiveSegment(
+                    conversation_key=scope.conversation_key,
+                    chat_id=scope.chat_id,
+                    window_start=window_start,
+                    min_message_id=min_id,
+                    max_message_id=max_id,
+                    message_count=len(group),
+                    path=path,
+                    size=size,
+                ))
+            # Сегменты и удаление из горячей таблицы — одной транзакцией: сообщение всегда ровно в одном уровне
+            result = await db.execute(
+                delete(Message).filter(Message.id.in_([message.id for message in messages]))
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != len(messages):
+                # Часть сообщений уже перенес параллельный запуск (другой процесс или узел):
+                # сегменты этой пачки дублировали бы его сегменты
+                raise ArchiveConflict(f"{len(messages) - result.rowcount} of {len(messages)} messages were archived concurrently")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            for path in written:
+                await self.store.remove(path)
+            raise
+
+        self.archived_total += len(messages)
+        self.segments_total += len(groups)
+        return len(messages)
+
+    def stats(self) -> dict:
+        return {
+            "runs_total": self.runs_total,
+            "archived_total": self.archived_total,
+            "segments_total": self.segments_total,
+            "conflicts_total": self.conflicts_total,
+        }
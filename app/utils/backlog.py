@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Iterable, List, Optional, Union
+
+from sqlalchemy import case, func, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.websockets import WebSocketDisconnect
+
+from database import AsyncSessionLocal, async_engine
+from models import ChatParticipant, DeviceCursor, Message, MessageStatus
+from utils.connection_manager import Connection
+from utils.message_serializer import ENCODING_MSGPACK, MessagePayload
+from utils import metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+logger = logging.getLogger(__name__)
+
+BACKLOG_CHUNK_SIZE = int(os.getenv("BACKLOG_CHUNK_SIZE", "200"))
+BACKLOG_FRAME_MAX_MESSAGES = int(os.getenv("BACKLOG_FRAME_MAX_MESSAGES", "50"))
+BACKLOG_FRAME_MAX_BYTES = int(os.getenv("BACKLOG_FRAME_MAX_BYTES", str(64 * 1024)))
+# Бюджет отправки на одно соединение, байт в секунду
+BACKLOG_SEND_BUDGET = int(os.getenv("BACKLOG_SEND_BUDGET", str(1024 * 1024)))
+
+
+async def advance_delivery_cursors(db: AsyncSession, chat_id: int, message_id: int, user_ids: Iterable[int]):
+    """
+    Живая доставка двигает курсор участника на message_id, только если он уже стоит
+    не ниже предыдущего сообщения чата: курсор означает «доставлено все до N», и пропущенное
+    сообщение (участник был офлайн или очередь переполнилась) остается в досылке.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    previous_id = select(func.coalesce(func.max(Message.id), 0)).filter(
+        Message.chat_id == chat_id,
+        Message.receiver_id == None,
+        Message.id < message_id
+    ).scalar_subquery()
+    await db.execute(update(ChatParticipant).filter(
+        ChatParticipant.chat_id == chat_id,
+        ChatParticipant.user_id.in_(user_ids),
+        ChatParticipant.last_delivered_message_id < message_id,
+        ChatParticipant.last_delivered_message_id >= previous_id
+    ).values(last_delivered_message_id=message_id).execution_options(synchronize_session=False))
+
+
+async def load_device_cursor(db: AsyncSession, user_id: int, device_id: str) -> Optional[int]:
+    result = await db.execute(select(DeviceCursor.last_message_id).filter(
+        DeviceCursor.user_id == user_id,
+        DeviceCursor.device_id == device_id
+    ))
+    return result.scalar()
+
+
+async def store_device_cursor(db: AsyncSession, user_id: int, device_id: str, message_id: int):
+    # Курсор только растет: параллельные соединения одного устройства не откатывают его назад
+    dialect = postgresql if async_engine.dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(DeviceCursor).values(user_id=user_id, device_id=device_id, last_message_id=message_id)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[DeviceCursor.user_id, DeviceCursor.device_id],
+        set_={"last_message_id": case(
+            (statement.excluded.last_message_id > DeviceCursor.last_message_id, statement.excluded.last_message_id),
+            else_=DeviceCursor.last_message_id
+        )}
+    ))
+
+
+async def save_device_cursor(connection: Connection):
+    """
+    Сохраняет курсор устройства при отключении. Живая доставка двигает его дальше границы
+    досылки, только если после нее ни один кадр не пропал из очереди (spill или drop):
+    иначе пропущенное уйдет этому устройству следующей досылкой.
+    """
+    if connection.device_id is None or connection.replayed_up_to is None:
+        return
+    message_id = connection.replayed_up_to
+    if connection.dropped_total == 0 and connection.spilled_message_id <= connection.replayed_up_to:
+        message_id = max(message_id, connection.accepted_up_to)
+    try:
+        async with AsyncSessionLocal() as db:
+            await store_device_cursor(db, connection.user_id, connection.device_id, message_id)
+            await db.commit()
+    except Exception as e:
+        logger.error(f"Error saving delivery cursor of device {connection.device_id} of user {connection.user_id}: {e}")
+
+
+class SendBudget:
+    def __init__(self, rate: int, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+
+    async def consume(self, amount: int):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < amount:
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+            self.tokens = amount
+            self.updated_at = time.monotonic()
+        self.tokens -= amount
+
+
+def pack_frames(payloads: List[MessagePayload], receiver_id: int, encoding: str) -> List[Union[str, bytes]]:
+    # Одиночное сообщение уходит в прежнем формате, несколько — одним кадром new_messages
+    encoded = [payload.encode(encoding, receiver_id) for payload in payloads]
+    frames, batch, batch_size = [], [], 0
+    for index, item in enumerate(encoded):
+        if batch and (len(batch) >= BACKLOG_FRAME_MAX_MESSAGES or batch_size + len(item) > BACKLOG_FRAME_MAX_BYTES):
+            frames.append(batch)
+            batch, batch_size = [], 0
+        batch.append(index)
+        batch_size += len(item) + 1
+    if batch:
+        frames.append(batch)
+    packed = []
+    for batch in frames:
+        if len(batch) == 1:
+            packed.append(encoded[batch[0]])
+        elif encoding == ENCODING_MSGPACK:
+            packed.append(msgpack.packb({
+                "action": "new_messages",
+                "messages": [payloads[index].as_dict(receiver_id) for index in batch],
+            }))
+        else:
+            packed.append('{"action":"new_messages","messages":[' + ",".join(encoded[index] for index in batch) + "]}")
+    return packed
+
+
+async def send_chunk(connection: Connection, payloads: List[MessagePayload], budget: SendBudget):
+    # Кадры идут через очередь соединения: порядок с живой доставкой сохраняется,
+    # а заполненная очередь притормаживает досылку
+    for frame in pack_frames(payloads, connection.user_id, connection.encoding):
+        await budget.consume(len(frame))
+        await connection.put(frame)
+
+
+async def replay_personal_backlog(connection: Connection, budget: SendBudget, upper_id: int) -> int:
+    user_id = connection.user_id
+    last_id, replayed = 0, 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Message).filter(
+                Message.receiver_id == user_id,
+                Message.status == MessageStatus.SENT,
+                Message.chat_id == None,
+                Message.id > last_id,
+                Message.id <= upper_id
+            ).order_by(Message.id.asc()).limit(BACKLOG_CHUNK_SIZE))
+            messages = result.scalars().all()
+            if not messages:
+                return replayed
+
+            await send_chunk(connection, [MessagePayload.from_message(message) for message in messages], budget)
+
+            # Контрольная точка на каждую пачку: при обрыве повторно уйдет только текущая
+            await db.execute(update(Message).filter(
+                Message.id.in_([message.id for message in messages]),
+                Message.status == MessageStatus.SENT
+            ).values(status=MessageStatus.DELIVERED))
+            with metrics.db_commit_seconds.labels("backlog").time():
+                await db.commit()
+
+        last_id = messages[-1].id
+        replayed += len(messages)
+        if len(messages) < BACKLOG_CHUNK_SIZE:
+            return replayed
+
+
+async def replay_group_backlog(connection: Connection, budget: SendBudget, upper_id: int) -> int:
+    user_id = connection.user_id
+    last_id, replayed = 0, 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Message).join(
+                ChatParticipant, ChatParticipant.chat_id == Message.chat_id
+            ).filter(
+                ChatParticipant.user_id == user_id,
+                Message.receiver_id == None,
+                Message.id > ChatParticipant.last_delivered_message_id,
+                Message.id > last_id,
+                Message.id <= upper_id
+            ).order_by(Message.id.asc()).limit(BACKLOG_CHUNK_SIZE))
+            messages = result.scalars().all()
+            if not messages:
+                return replayed
+
+            # Свои сообщения не отправляются, но курсор проходит и по ним: иначе живая доставка
+            # упиралась бы в них и не двигала курсор дальше
+            incoming = [message for message in messages if message.sender_id != user_id]
+            if incoming:
+                await send_chunk(connection, [MessagePayload.from_message(message) for message in incoming], budget)
+
+            cursors = {}
+            for message in messages:
+                cursors[message.chat_id] = message.id
+            for chat_id, message_id in cursors.items():
+                await db.execute(update(ChatParticipant).filter(
+                    ChatParticipant.chat_id == chat_id,
+                    ChatParticipant.user_id == user_id,
+                    ChatParticipant.last_delivered_message_id < message_id
+                ).values(last_delivered_message_id=message_id))
+            with metrics.db_commit_seconds.labels("backlog").time():
+                await db.commit()
+
+        last_id = messages[-1].id
+        replayed += len(incoming)
+        if len(messages) < BACKLOG_CHUNK_SIZE:
+            return replayed
+
+
+async def replay_device_backlog(connection: Connection, budget: SendBudget, after_id: int, upper_id: int) -> int:
+    """
+    Досылка устройству со своим курсором: все адресованное пользователю после курсора одним
+    потоком по id, даже если другое устройство уже приняло сообщение. Статусы и курсоры
+    пользователя обновляются так же, как при обычной досылке.
+    """
+    user_id, device_id = connection.user_id, connection.device_id
+    last_id, replayed = after_id, 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Message).filter(
+                or_(
+                    (Message.receiver_id == user_id) & (Message.chat_id == None),
+                    (Message.receiver_id == None) & Message.chat_id.in_(
+                        select(ChatParticipant.chat_id).filter(ChatParticipant.user_id == user_id)
+                    )
+                ),
+                Message.id > last_id,
+                Message.id <= upper_id
+            ).order_by(Message.id.asc()).limit(BACKLOG_CHUNK_SIZE))
+            messages = result.scalars().all()
+            if not messages:
+                return replayed
+
+            incoming = [message for message in messages if message.chat_id is None or message.sender_id != user_id]
+            if incoming:
+                await send_chunk(connection, [MessagePayload.from_message(message) for message in incoming], budget)
+
+            direct_ids = [message.id for message in messages if message.chat_id is None]
+            if direct_ids:
+                await db.execute(update(Message).filter(
+                    Message.id.in_(direct_ids),
+                    Message.status == MessageStatus.SENT
+                ).values(status=MessageStatus.DELIVERED))
+            for message in messages:
+                if message.chat_id is not None:
+                    await advance_delivery_cursors(db, message.chat_id, message.id, (user_id,))
+            await store_device_cursor(db, user_id, device_id, messages[-1].id)
+            with metrics.db_commit_seconds.labels("backlog").time():
+                await db.commit()
+
+        last_id = messages[-1].id
+        replayed += len(incoming)
+        if len(messages) < BACKLOG_CHUNK_SIZE:
+            return replayed
+
+
+async def replay_backlog(connection: Connection) -> Optional[int]:
+    """Досылает накопленное и возвращает id, до которого досылка прошла, или None при ошибке."""
+    user_id = connection.user_id
+    budget = SendBudget(BACKLOG_SEND_BUDGET)
+    started_at = time.perf_counter()
+    try:
+        # Граница досылки фиксируется после регистрации соединения: все новее приходит живой
+        # доставкой, и досылка не гонится за ней и не перечитывает то, что уже ушло в очередь
+        async with AsyncSessionLocal() as db:
+            upper_id = (await db.execute(select(func.max(Message.id)))).scalar() or 0
+            device_cursor = None
+            if connection.device_id is not None:
+                device_cursor = await load_device_cursor(db, user_id, connection.device_id)
+        if device_cursor is not None:
+            replayed = await replay_device_backlog(connection, budget, device_cursor, upper_id)
+            if replayed:
+                logger.info(f"Replayed {replayed} messages to device {connection.device_id} of user {user_id}")
+        else:
+            # Новое устройство начинает с того, что не получило ни одно устройство пользователя
+            personal = await replay_personal_backlog(connection, budget, upper_id)
+            group = await replay_group_backlog(connection, budget, upper_id)
+            replayed = personal + group
+            if replayed:
+                logger.info(f"Replayed {personal} personal and {group} group messages to user {user_id}")
+            if connection.device_id is not None:
+                async with AsyncSessionLocal() as db:
+                    await store_device_cursor(db, user_id, connection.device_id, upper_id)
+                    await db.commit()
+        metrics.backlog_replay_seconds.observe(time.perf_counter() - started_at)
+        metrics.backlog_replayed.inc(replayed)
+        connection.replayed_up_to = max(connection.replayed_up_to or 0, upper_id)
+        return upper_id
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket disconnected while replaying backlog to user {user_id}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while replaying backlog to user {user_id}: {e}")
@@ -0,0 +1,590 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Set, Union
+from urllib.parse import urlparse
+
+from utils.message_serializer import MessagePayload
+
+
+logger = logging.getLogger(__name__)
+
+DeliverCallback = Callable[[int, Union[str, MessagePayload]], Awaitable[bool]]
+EventHandler = Callable[[dict], Awaitable[None]]
+
+
+NO_NODES: Set[str] = frozenset()
+EVENT_PRESENCE = "presence"
+
+# Сколько ждать подтверждения доставки от других узлов, секунд
+BACKPLANE_ACK_TIMEOUT = float(os.getenv("BACKPLANE_ACK_TIMEOUT", "2"))
+# Запись о присутствии живет столько секунд и обновляется каждую треть срока
+BACKPLANE_PRESENCE_TTL = float(os.getenv("BACKPLANE_PRESENCE_TTL", "60"))
+# Наибольшая пауза между попытками переподключения к Redis, секунд
+BACKPLANE_RECONNECT_MAX = float(os.getenv("BACKPLANE_RECONNECT_MAX", "30"))
+BACKPLANE_PIPELINE_SIZE = int(os.getenv("BACKPLANE_PIPELINE_SIZE", "1000"))
+
+
+class BackplaneError(Exception):
+    pass
+
+
+class RespError(BackplaneError):
+    """Ошибка, которую вернул сервер; соединение при этом остается исправным."""
+
+
+class Backplane(ABC):
+    """
+    Маршрутизация сообщений между процессами: каждый процесс регистрирует
+    пользователей, чьи сокеты он держит, и принимает сообщения для них.
+    Устройства одного пользователя могут быть открыты на нескольких узлах.
+    """
+
+    def __init__(self, node_id: Optional[str] = None):
+        self.node_id = node_id or uuid.uuid4().hex
+        self.deliver: Optional[DeliverCallback] = None
+        self.event_handlers: List[EventHandler] = []
+
+    async def start(self, deliver: DeliverCallback):
+        self.deliver = deliver
+
+    async def stop(self):
+        self.deliver = None
+
+    @abstractmethod
+    async def register(self, user_id: int):
+        pass
+
+    @abstractmethod
+    async def unregister(self, user_id: int):
+        pass
+
+    @abstractmethod
+    async def publish(self, user_id: int, message: Union[str, MessagePayload]) -> bool:
+        """True, только если сообщение приняли все другие узлы с устройствами пользователя."""
+
+    async def publish_many(self, user_ids: Iterable[int], message: Union[str, MessagePayload]) -> Set[int]:
+        # Пользователи, которым сообщение доставлено; реализации могут объединять публикации
+        user_ids = list(user_ids)
+        results = await asyncio.gather(*(self.publish(user_id, message) for user_id in user_ids))
+        return {user_id for user_id, delivered in zip(user_ids, results) if delivered}
+
+    async def offline_users(self, user_ids: Iterable[int]) -> Set[int]:
+        # Пользователи без устройств на других узлах; по умолчанию присутствие неизвестно
+        return set()
+
+    def other_nodes(self, user_id: int) -> Set[str]:
+        # Другие узлы, где открыты устройства пользователя, у которого есть устройство и на этом узле
+        return NO_NODES
+
+    def add_event_handler(self, handler: EventHandler):
+        self.event_handlers.append(handler)
+
+    async def broadcast(self, event: dict):
+        # Служебное событие всем остальным узлам; свой узел обновляет состояние сам
+        pass
+
+    async def dispatch_event(self, event: dict):
+        for handler in self.event_handlers:
+            try:
+                await handler(event)
+            except Exception as e:
+                logger.error(f"Error handling backplane event {event.get('type')} on node {self.node_id}: {e}")
+
+
+class InMemoryHub:
+    def __init__(self):
+        self.nodes: Dict[str, "InMemoryBackplane"] = {}
+        self.presence: Dict[int, Set[str]] = {}
+
+
+default_hub = InMemoryHub()
+
+
+class InMemoryBackplane(Backplane):
+    """Узлы в пределах одного процесса, например несколько менеджеров в тестах."""
+
+    def __init__(self, hub: InMemoryHub = default_hub, node_id: Optional[str] = None):
+        super().__init__(node_id)
+        self.hub = hub
+
+    async def start(self, deliver: DeliverCallback):
+        await super().start(deliver)
+        self.hub.nodes[self.node_id] = self
+
+    async def stop(self):
+        self.hub.nodes.pop(self.node_id, None)
+        for user_id in list(self.hub.presence):
+            await self.unregister(user_id)
+        await super().stop()
+
+    async def register(self, user_id: int):
+        self.hub.presence.setdefault(user_id, set()).add(self.node_id)
+
+    async def unregister(self, user_id: int):
+        nodes = self.hub.presence.get(user_id)
+        if nodes is not None:
+            nodes.discard(self.node_id)
+            if not nodes:
+                del self.hub.presence[user_id]
+
+    async def publish(self, user_id: int, message: Union[str, MessagePayload]) -> bool:
+        nodes = self.other_nodes(user_id)
+        if not nodes:
+            return False
+        delivered = True
+        for node_id in nodes:
+            node = self.hub.nodes.get(node_id)
+            if node is None or node.deliver is None or not await node.deliver(user_id, message):
+                delivered = False
+        return delivered
+
+    async def offline_users(self, user_ids: Iterable[int]) -> Set[int]:
+        return {user_id for user_id in user_ids if user_id not in self.hub.presence}
+
+    def other_nodes(self, user_id: int) -> Set[str]:
+        nodes = self.hub.presence.get(user_id)
+        if not nodes or (len(nodes) == 1 and self.node_id in nodes):
+            return NO_NODES
+        return nodes - {self.node_id}
+
+    async def broadcast(self, event: dict):
+        for node_id, node in list(self.hub.nodes.items()):
+            if node_id != self.node_id:
+                await node.dispatch_event(event)
+
+
+class RespConnection:
+    """Минимальный клиент протокола Redis (RESP2) поверх asyncio streams."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, url: str) -> "RespConnection":
+        parsed = urlparse(url)
+        if parsed.scheme == "unix":
+            reader, writer = await asyncio.open_unix_connection(parsed.path)
+        else:
+            reader, writer = await asyncio.open_connection(parsed.hostname or "localhost", parsed.port or 6379)
+        connection = cls(reader, writer)
+        if parsed.password:
+            if parsed.username:
+                await connection.execute("AUTH", parsed.username, parsed.password)
+            else:
+                await connection.execute("AUTH", parsed.password)
+        database = parsed.path.lstrip("/") if parsed.scheme != "unix" else ""
+        if database:
+            await connection.execute("SELECT", database)
+        return connection
+
+    def send(self, *args):
+        self.writer.write(self.encode(args))
+
+    @staticmethod
+    def encode(args: Sequence) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def read_reply(self):
+        line = await self.reader.readline()
+        if not line:
+            raise BackplaneError("Connection closed by server")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode()
+        if prefix == b"-":
+            raise RespError(payload.decode())
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+        raise BackplaneError(f"Unexpected reply: {line!r}")
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands: Sequence[Sequence]) -> list:
+        # Все команды уходят одной записью, ответы читаются подряд: один круг до Redis на пачку
+        async with self.lock:
+            self.writer.write(b"".join(self.encode(args) for args in commands))
+            await self.writer.drain()
+            replies, error = [], None
+            for _ in commands:
+                try:
+                    replies.append(await self.read_reply())
+                except RespError as e:
+                    # Остальные ответы все равно дочитываются, иначе они достанутся следующей команде
+                    replies.append(None)
+                    error = error or e
+            if error:
+                raise error
+            return replies
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+
+class PendingDelivery:
+    """Ожидание подтверждений от узлов, которым опубликовано сообщение."""
+
+    __slots__ = ("expected", "confirmed", "waiting", "done")
+
+    def __init__(self, targets: Dict[str, List[int]]):
+        # Пользователь доставлен, если подтвердили все узлы, куда ушло его сообщение
+        self.expected: Dict[int, int] = {}
+        for user_ids in targets.values():
+            for user_id in user_ids:
+                self.expected[user_id] = self.expected.get(user_id, 0) + 1
+        self.confirmed: Dict[int, int] = {}
+        self.waiting = set(targets)
+        self.done = asyncio.Event()
+
+    def ack(self, node_id: str, delivered: Iterable[int]):
+        if node_id not in self.waiting:
+            return
+        self.waiting.discard(node_id)
+        for user_id in delivered:
+            self.confirmed[user_id] = self.confirmed.get(user_id, 0) + 1
+        if not self.waiting:
+            self.done.set()
+
+    def delivered(self) -> Set[int]:
+        return {user_id for user_id, count in self.confirmed.items() if count == self.expected.get(user_id)}
+
+
+class RedisBackplane(Backplane):
+    """
+    Присутствие хранится в упорядоченных множествах chat:online:<user_id>: узел с устройствами
+    пользователя и срок записи, который узел продлевает, пока жив; срок самого узла —
+    в chat:nodes. Каждый узел подписан на свой канал chat:node:<node_id> и общий канал
+    событий chat:events. Публикация определяет узлы всех получателей одним конвейером
+    запросов, объединяет получателей по узлам и ждет от каждого узла подтверждения
+    с пользователями, которым сообщение поставлено в очередь. Узел, не ответивший за
+    ack_timeout, пропускается, пока не продлит свой срок: упавший узел задерживает
+    рассылку один раз, а не на каждом сообщении до истечения его записей.
+    Пользователи с устройствами на нескольких узлах рассылаются событием presence, чтобы
+    доставка локальному пользователю не требовала запроса к Redis.
+    """
+
+    PRESENCE_PREFIX = "chat:online:"
+    NODES_KEY = "chat:nodes"
+    CHANNEL_PREFIX = "chat:node:"
+    EVENTS_CHANNEL = "chat:events"
+
+    def __init__(
+            self,
+            url: str,
+            node_id: Optional[str] = None,
+            ack_timeout: float = BACKPLANE_ACK_TIMEOUT,
+            presence_ttl: float = BACKPLANE_PRESENCE_TTL,
+            reconnect_max: float = BACKPLANE_RECONNECT_MAX
+    ):
+        super().__init__(node_id)
+        self.url = url
+        self.ack_timeout = ack_timeout
+        self.presence_ttl = presence_ttl
+        self.reconnect_max = reconnect_max
+        self.commands: Optional[RespConnection] = None
+        self.commands_lock = asyncio.Lock()
+        self.subscriber: Optional[RespConnection] = None
+        self.listener: Optional[asyncio.Task] = None
+        self.refresher: Optional[asyncio.Task] = None
+        self.local_users: Set[int] = set()
+        self.shared: Dict[int, Set[str]] = {}
+        self.pending: Dict[str, PendingDelivery] = {}
+        # Срок записи других узлов из последнего запроса присутствия
+        self.node_expiry: Dict[str, float] = {}
+        # Узлы, не подтвердившие доставку, и их срок на тот момент
+        self.unresponsive: Dict[str, float] = {}
+        self.add_event_handler(self.handle_presence)
+
+    @property
+    def channel(self) -> str:
+        return f"{self.CHANNEL_PREFIX}{self.node_id}"
+
+    def presence_key(self, user_id: int) -> str:
+        return f"{self.PRESENCE_PREFIX}{user_id}"
+
+    async def start(self, deliver: DeliverCallback):
+        await super().start(deliver)
+        await self.refresh_presence()
+        await self.subscribe()
+        self.listener = asyncio.create_task(self.listen())
+        self.refresher = asyncio.create_task(self.refresh_loop())
+        logger.info(f"Backplane node {self.node_id} subscribed to {self.channel}")
+
+    async def stop(self):
+        for task in (self.refresher, self.listener):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        if self.commands:
+            # Другие узлы не должны ждать подтверждений от остановленного узла до истечения записей
+            try:
+                await self.pipeline([
+                    ("ZREM", self.NODES_KEY, self.node_id),
+                    *(("ZREM", self.presence_key(user_id), self.node_id) for user_id in self.local_users),
+                ])
+            except (BackplaneError, OSError) as e:
+                logger.error(f"Error removing presence of node {self.node_id}: {e}")
+        for connection in (self.subscriber, self.commands):
+            if connection:
+                await connection.close()
+        self.listener = self.refresher = self.subscriber = self.commands = None
+        self.local_users.clear()
+        self.shared.clear()
+        self.node_expiry.clear()
+        self.unresponsive.clear()
+        await super().stop()
+
+    async def connection(self) -> RespConnection:
+        # Соединение для команд открывается заново после обрыва при следующем обращении
+        async with self.commands_lock:
+            if self.commands is None:
+                self.commands = await RespConnection.open(self.url)
+            return self.commands
+
+    async def pipeline(self, commands: Sequence[Sequence]) -> list:
+        replies = []
+        for start in range(0, len(commands), BACKPLANE_PIPELINE_SIZE):
+            connection = await self.connection()
+            try:
+                replies.extend(await connection.pipeline(commands[start:start + BACKPLANE_PIPELINE_SIZE]))
+            except RespError:
+                raise
+            except (BackplaneError, OSError, asyncio.IncompleteReadError) as e:
+                if self.commands is connection:
+                    self.commands = None
+                await connection.close()
+                raise BackplaneError(f"Redis connection lost: {e}") from e
+        return replies
+
+    async def execute(self, *args):
+        return (await self.pipeline([args]))[0]
+
+    async def subscribe(self):
+        self.subscriber = await RespConnection.open(self.url)
+        # Подтверждение второй подписки придет в listen и будет пропущено
+        await self.subscriber.execute("SUBSCRIBE", self.channel, self.EVENTS_CHANNEL)
+
+    async def listen(self):
+        delay = 0.1
+        while True:
+            try:
+                if self.subscriber is None:
+                    await self.subscribe()
+                    # Пока подписки не было, записи о присутствии могли истечь
+                    await self.refresh_presence()
+                    logger.info(f"Backplane node {self.node_id} resubscribed to {self.channel}")
+                    delay = 0.1
+                reply = await self.subscriber.read_reply()
+            except (BackplaneError, OSError, asyncio.IncompleteReadError) as e:
+                logger.error(f"Backplane subscription for node {self.node_id} lost: {e}, reconnecting in {delay:.1f}s")
+                if self.subscriber:
+                    await self.subscriber.close()
+                    self.subscriber = None
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max)
+                continue
+            if not isinstance(reply, list) or len(reply) != 3 or reply[0] != b"message":
+                continue
+            try:
+                envelope = json.loads(reply[2])
+                if reply[1] == self.EVENTS_CHANNEL.encode():
+                    if envelope["origin"] != self.node_id:
+                        await self.dispatch_event(envelope["event"])
+                    continue
+                if "ack" in envelope:
+                    pending = self.pending.get(envelope["ack"])
+                    if pending is not None:
+                        pending.ack(envelope["node"], envelope["delivered"])
+                    continue
+                await self.deliver_envelope(envelope)
+            except Exception as e:
+                logger.error(f"Error delivering backplane message on node {self.node_id}: {e}")
+
+    async def deliver_envelope(self, envelope: dict):
+        if "payload" in envelope:
+            message = MessagePayload(envelope["payload"])
+        else:
+            message = envelope["message"]
+        delivered = [user_id for user_id in envelope["user_ids"] if await self.deliver(user_id, message)]
+        await self.execute("PUBLISH", f"{self.CHANNEL_PREFIX}{envelope['origin']}", json.dumps({
+            "ack": envelope["request"], "node": self.node_id, "delivered": delivered
+        }))
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.presence_ttl / 3)
+            try:
+                await self.refresh_presence()
+            except (BackplaneError, OSError) as e:
+                logger.error(f"Error refreshing presence of node {self.node_id}: {e}")
+
+    def presence_commands(self, user_id: int, now: float) -> List[tuple]:
+        key = self.presence_key(user_id)
+        return [
+            ("ZADD", key, f"{now + self.presence_ttl:.3f}", self.node_id),
+            ("EXPIRE", key, int(self.presence_ttl) + 1),
+        ]
+
+    async def refresh_presence(self):
+        now = time.time()
+        commands = [("ZADD", self.NODES_KEY, f"{now + self.presence_ttl:.3f}", self.node_id)]
+        for user_id in list(self.local_users):
+            commands.extend(self.presence_commands(user_id, now))
+        await self.pipeline(commands)
+
+    async def resolve_presence(self, user_ids: List[int]) -> Dict[int, Set[str]]:
+        """Другие живые узлы с устройствами каждого пользователя — одним конвейером запросов."""
+        now = f"{time.time():.3f}"
+        replies = await self.pipeline([
+            ("ZRANGEBYSCORE", self.NODES_KEY, now, "+inf", "WITHSCORES"),
+            *(("ZRANGEBYSCORE", self.presence_key(user_id), now, "+inf") for user_id in user_ids),
+        ])
+        nodes_reply = replies[0] or []
+        self.node_expiry = {
+            member.decode(): float(score) for member, score in zip(nodes_reply[::2], nodes_reply[1::2])
+        }
+        # Узел, продливший срок после пропущенного подтверждения, снова получает сообщения;
+        # истекший узел пропускается и без этой отметки
+        for node_id, expiry in list(self.unresponsive.items()):
+            if self.node_expiry.get(node_id, float("inf")) > expiry:
+                del self.unresponsive[node_id]
+        live = self.node_expiry.keys() - self.unresponsive.keys() - {self.node_id}
+        return {user_id: self.live_nodes(reply) & live for user_id, reply in zip(user_ids, replies[1:])}
+
+    async def offline_users(self, user_ids: Iterable[int]) -> Set[int]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        nodes = await self.resolve_presence(user_ids)
+        return {user_id for user_id in user_ids if not nodes[user_id]}
+
+    @staticmethod
+    def live_nodes(reply) -> Set[str]:
+        return {member.decode() for member in reply or ()}
+
+    async def register(self, user_id: int):
+        self.local_users.add(user_id)
+        now = time.time()
+        key = self.presence_key(user_id)
+        replies = await self.pipeline([
+            ("ZREMRANGEBYSCORE", key, "-inf", f"{now:.3f}"),
+            *self.presence_commands(user_id, now),
+            ("ZRANGEBYSCORE", key, f"{now:.3f}", "+inf"),
+        ])
+        nodes = self.live_nodes(replies[-1])
+        if len(nodes) > 1:
+            await self.announce_presence(user_id, nodes)
+
+    async def unregister(self, user_id: int):
+        self.local_users.discard(user_id)
+        self.shared.pop(user_id, None)
+        key = self.presence_key(user_id)
+        replies = await self.pipeline([
+            ("ZREM", key, self.node_id),
+            ("ZRANGEBYSCORE", key, f"{time.time():.3f}", "+inf"),
+        ])
+        nodes = self.live_nodes(replies[-1])
+        if nodes:
+            await self.announce_presence(user_id, nodes)
+
+    async def announce_presence(self, user_id: int, nodes: Set[str]):
+        event = {"type": EVENT_PRESENCE, "user_id": user_id, "nodes": sorted(nodes)}
+        await self.handle_presence(event)
+        await self.broadcast(event)
+
+    async def handle_presence(self, event: dict):
+        if event.get("type") != EVENT_PRESENCE:
+            return
+        user_id, nodes = event["user_id"], set(event["nodes"])
+        others = nodes - {self.node_id}
+        if self.node_id in nodes and others:
+            self.shared[user_id] = others
+        else:
+            self.shared.pop(user_id, None)
+
+    def other_nodes(self, user_id: int) -> Set[str]:
+        return self.shared.get(user_id, NO_NODES)
+
+    async def publish(self, user_id: int, message: Union[str, MessagePayload]) -> bool:
+        return user_id in await self.publish_many((user_id,), message)
+
+    async def publish_many(self, user_ids: Iterable[int], message: Union[str, MessagePayload]) -> Set[int]:
+        # Присутствие всех получателей — одним конвейером запросов, затем одна публикация на узел
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        targets: Dict[str, List[int]] = {}
+        for user_id, nodes in (await self.resolve_presence(user_ids)).items():
+            for node_id in nodes:
+                targets.setdefault(node_id, []).append(user_id)
+        if not targets:
+            return set()
+
+        request = uuid.uuid4().hex
+        envelope = {"origin": self.node_id, "request": request}
+        if isinstance(message, MessagePayload):
+            # Кодирование под формат соединения выполняет узел получателя
+            envelope["payload"] = message.data
+        else:
+            envelope["message"] = message
+        pending = self.pending[request] = PendingDelivery(targets)
+        try:
+            receivers = await self.pipeline([
+                ("PUBLISH", f"{self.CHANNEL_PREFIX}{node_id}", json.dumps({**envelope, "user_ids": node_users}))
+                for node_id, node_users in targets.items()
+            ])
+            for node_id, count in zip(targets, receivers):
+                # Узел не подписан на свой канал — ответа от него не будет
+                if not count:
+                    pending.ack(node_id, ())
+            try:
+                await asyncio.wait_for(pending.done.wait(), self.ack_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Backplane nodes {sorted(pending.waiting)} did not confirm delivery in {self.ack_timeout}s")
+                for node_id in pending.waiting:
+                    self.unresponsive[node_id] = self.node_expiry.get(node_id, 0.0)
+            return pending.delivered()
+        finally:
+            del self.pending[request]
+
+    async def broadcast(self, event: dict):
+        await self.execute(
+            "PUBLISH", self.EVENTS_CHANNEL, json.dumps({"origin": self.node_id, "event": event})
+        )
+
+
+def create_backplane(url: Optional[str]) -> Backplane:
+    if not url or url == "memory://":
+        return InMemoryBackplane()
+    if url.startswith(("redis://", "unix://")):
+        return RedisBackplane(url)
+    raise ValueError(f"Unsupported backplane URL: {url}")
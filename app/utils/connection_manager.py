@@ -1,14 +1,22 @@
-from typing import Dict
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, Tuple, Union
 
 import jwt
 from fastapi import WebSocket
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 from datetime import datetime, timedelta
-from passlib.context import CryptContext
 from starlette.websockets import WebSocketDisconnect
 
 from models import User
+from utils.backplane import Backplane, BackplaneError
+from utils.heartbeat import HeartbeatMonitor
+from utils.message_serializer import ENCODING_JSON, MessagePayload
+from utils.password_hasher import password_hasher
+from utils import metrics
 import logging
 
 
@@ -16,55 +24,424 @@ SECRET_KEY = "SECRET_KEY"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 300
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
 logger = logging.getLogger(__name__)
 
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+# Что делать с медленным клиентом при переполнении очереди: drop, disconnect или spill
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "spill")
+
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+POLICY_SPILL = "spill"
+
+
+class Connection:
+    """
+    WebSocket-соединение с ограниченной очередью исходящих кадров и своей задачей записи,
+    чтобы медленный клиент не задерживал рассылку остальным.
+    """
+
+    __slots__ = (
+        "user_id", "websocket", "encoding", "queue", "writer", "reader", "sent_total", "dropped_total",
+        "last_activity", "pinged_at", "heartbeat_slot", "replay_task", "replay_pending", "spilled_message_id",
+        "device_id", "replayed_up_to", "accepted_up_to",
+    )
+
+    def __init__(
+            self,
+            user_id: int,
+            websocket: WebSocket,
+            encoding: str = ENCODING_JSON,
+            queue_size: int = SEND_QUEUE_SIZE,
+            device_id: Optional[str] = None
+    ):
+        self.user_id = user_id
+        self.websocket = websocket
+        self.encoding = encoding
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.writer: Optional[asyncio.Task] = None
+        # Задача приема кадров: отменяется, если соединение закрывает сервер
+        self.reader: Optional[asyncio.Task] = None
+        self.sent_total = 0
+        self.dropped_total = 0
+        # Время последнего входящего кадра и последнего ping (time.monotonic)
+        self.last_activity = time.monotonic()
+        self.pinged_at = 0.0
+        self.heartbeat_slot: Optional[int] = None
+        # Досылка пропущенного: при подключении и после переполнения очереди (spill)
+        self.replay_task: Optional[asyncio.Task] = None
+        self.replay_pending = False
+        # Наибольший id сообщения, не поместившегося в очередь
+        self.spilled_message_id = 0
+        # Устройство со своим курсором доставки (models.DeviceCursor), None — только курсоры пользователя
+        self.device_id = device_id
+        # Граница последней завершенной досылки и наибольший id, принятый очередью живой доставкой
+        self.replayed_up_to: Optional[int] = None
+        self.accepted_up_to = 0
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def encode(self, message: Union[str, MessagePayload]) -> Union[str, bytes]:
+        if isinstance(message, MessagePayload):
+            # Получатель сообщения — всегда владелец соединения
+            return message.encode(self.encoding, receiver_id=self.user_id)
+        return message
+
+    def offer(self, frame: Union[str, bytes]) -> bool:
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def drop_oldest(self):
+        try:
+            self.queue.get_nowait()
+            self.dropped_total += 1
+        except asyncio.QueueEmpty:
+            pass
+
+    async def put(self, frame: Union[str, bytes]):
+        # Для досылки истории: ждем места в очереди вместо применения политики
+        await self.queue.put(frame)
+
+    async def write_loop(self):
+        while True:
+            frame = await self.queue.get()
+            if isinstance(frame, bytes):
+                await self.websocket.send_bytes(frame)
+            else:
+                await self.websocket.send_text(frame)
+            self.sent_total += 1
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+    """
+    Соединения пользователей процесса. У пользователя с одним устройством в active_connections
+    лежит само соединение, словарь (упорядоченное множество) заводится только со вторым устройством:
+    так добавление, поиск и удаление остаются O(1) без лишней памяти на типичного пользователя.
+    """
+
+    def __init__(
+            self,
+            backplane: Optional[Backplane] = None,
+            slow_consumer_policy: str = SLOW_CONSUMER_POLICY,
+            replay: Optional[Callable[[Connection], Awaitable[Optional[int]]]] = None,
+            queue_size: int = SEND_QUEUE_SIZE
+    ):
+        self.active_connections: Dict[int, Union[Connection, Dict[Connection, None]]] = {}
+        self.connection_count = 0
+        self.backplane = backplane
+        self.slow_consumer_policy = slow_consumer_policy
+        self.replay = replay
+        self.queue_size = queue_size
+        # Соединения, чье пропущенное сообщение еще не записано в БД (отложенная запись)
+        self.awaiting_commit: Dict[Connection, None] = {}
+        self.dropped_total = 0
+        self.spilled_total = 0
+        self.slow_disconnects_total = 0
+        # Фоновые отключения медленных клиентов: ссылки держатся до завершения задачи
+        self.tasks: Set[asyncio.Task] = set()
+        self.heartbeat = HeartbeatMonitor(offer=self.offer, reap=self.reap)
+
+    async def start(self):
+        if self.backplane:
+            await self.backplane.start(self.send_local_message)
+        self.heartbeat.start()
+
+    async def stop(self):
+        await self.heartbeat.stop()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.backplane:
+            await self.backplane.stop()
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self.active_connections),
+            "connections": self.connection_count,
+            "queued_frames": sum(connection.queue.qsize() for connection in self.iter_connections()),
+            "dropped_total": self.dropped_total,
+            "spilled_total": self.spilled_total,
+            "slow_disconnects_total": self.slow_disconnects_total,
+            "heartbeat": self.heartbeat.stats(),
+        }
+
+    def iter_connections(self):
+        for entry in self.active_connections.values():
+            if isinstance(entry, Connection):
+                yield entry
+            else:
+                yield from entry
+
+    def get_connections(self, user_id: int) -> Tuple[Connection, ...]:
+        entry = self.active_connections.get(user_id)
+        if entry is None:
+            return ()
+        if isinstance(entry, Connection):
+            return (entry,)
+        return tuple(entry)
+
+    def add_connection(self, user_id: int, connection: Connection) -> bool:
+        # True, если это первое устройство пользователя в процессе
+        entry = self.active_connections.get(user_id)
+        self.connection_count += 1
+        if entry is None:
+            self.active_connections[user_id] = connection
+            return True
+        if isinstance(entry, Connection):
+            self.active_connections[user_id] = {entry: None, connection: None}
+        else:
+            entry[connection] = None
+        return False
 
-    async def connect(self, user_id: int, websocket: WebSocket):
+    def remove_connection(self, user_id: int, connection: Connection) -> Tuple[bool, bool]:
+        # (соединение было зарегистрировано, это было последнее устройство)
+        entry = self.active_connections.get(user_id)
+        if entry is connection:
+            del self.active_connections[user_id]
+            self.connection_count -= 1
+            return True, True
+        if isinstance(entry, dict) and connection in entry:
+            del entry[connection]
+            self.connection_count -= 1
+            if len(entry) == 1:
+                self.active_connections[user_id] = next(iter(entry))
+            return True, False
+        return False, False
+
+    async def connect(
+            self,
+            user_id: int,
+            websocket: WebSocket,
+            encoding: str = ENCODING_JSON,
+            device_id: Optional[str] = None
+    ) -> Connection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
+        connection = Connection(user_id, websocket, encoding, self.queue_size, device_id)
+        connection.writer = asyncio.create_task(self.run_writer(connection))
+        self.heartbeat.track(connection)
+        if self.add_connection(user_id, connection) and self.backplane:
+            try:
+                await self.backplane.register(user_id)
+            except (BackplaneError, OSError) as e:
+                logger.error(f"Error registering user {user_id} in backplane: {e}")
+        return connection
 
-    async def disconnect(self, user_id: int):
-        websocket = self.active_connections.pop(user_id, None)
-        if websocket:
-            await websocket.close()
+    async def run_writer(self, connection: Connection):
+        try:
+            await connection.write_loop()
+        except asyncio.CancelledError:
+            raise
+        except WebSocketDisconnect:
+            await self.disconnect(connection.user_id, connection)
+        except Exception as e:
+            logger.error(f"Error sending message to user {connection.user_id}: {e}")
+            await self.disconnect(connection.user_id, connection)
 
-    async def send_personal_message(self, message: str, user_id: int) -> bool:
-        websocket = self.active_connections.get(user_id)
-        if websocket:
+    async def disconnect(self, user_id: int, connection: Connection):
+        removed, last = self.remove_connection(user_id, connection)
+        if not removed:
+            return
+        self.heartbeat.untrack(connection)
+        self.awaiting_commit.pop(connection, None)
+        if last and self.backplane:
             try:
-                await websocket.send_text(message)
+                await self.backplane.unregister(user_id)
+            except (BackplaneError, OSError) as e:
+                logger.error(f"Error unregistering user {user_id} from backplane: {e}")
+        current = asyncio.current_task()
+        if connection.writer and connection.writer is not current:
+            connection.writer.cancel()
+        # Ждать receive от мертвого клиента бессмысленно: прием завершается вместе с соединением
+        if connection.reader and connection.reader is not current:
+            connection.reader.cancel()
+        if connection.replay_task and connection.replay_task is not current:
+            connection.replay_task.cancel()
+        try:
+            await connection.websocket.close()
+        except Exception:
+            pass
+
+    def start_replay(self, connection: Connection):
+        # Одна досылка на соединение: запрос во время текущей повторит ее после завершения
+        if self.replay is None:
+            return
+        if connection.replay_task and not connection.replay_task.done():
+            connection.replay_pending = True
+            return
+        connection.replay_task = asyncio.create_task(self.run_replay(connection))
+
+    async def run_replay(self, connection: Connection):
+        while True:
+            connection.replay_pending = False
+            # replay возвращает наибольший id, до которого дослала, или None при ошибке
+            replayed_up_to = await self.replay(connection)
+            if connection.replay_pending:
+                continue
+            if replayed_up_to is not None and connection.spilled_message_id > replayed_up_to:
+                self.awaiting_commit[connection] = None
+            return
+
+    def replay_spilled(self, committed_up_to: int):
+        # Вызывается после коммита пачки отложенной записи: ее сообщения уже видны досылке
+        for connection in list(self.awaiting_commit):
+            if connection.spilled_message_id <= committed_up_to:
+                del self.awaiting_commit[connection]
+                self.start_replay(connection)
+
+    async def reap(self, connection: Connection):
+        await self.disconnect(connection.user_id, connection)
+
+    async def run_disconnect(self, connection: Connection):
+        try:
+            await self.disconnect(connection.user_id, connection)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error disconnecting slow consumer {connection.user_id}: {e}")
+
+    async def offline_users(self, user_ids: Iterable[int]) -> Set[int]:
+        # Пользователи без устройств и здесь, и на других узлах; при ошибке бэкплейна — неизвестно
+        remote = [user_id for user_id in user_ids if user_id not in self.active_connections]
+        if not remote or self.backplane is None:
+            return set(remote)
+        try:
+            return await self.backplane.offline_users(remote)
+        except (BackplaneError, OSError) as e:
+            logger.error(f"Error resolving presence of {len(remote)} users via backplane: {e}")
+            return set()
+
+    def has_remote_devices(self, user_id: int) -> bool:
+        return self.backplane is not None and bool(self.backplane.other_nodes(user_id))
+
+    async def publish(self, user_id: int, message: Union[str, MessagePayload]) -> bool:
+        try:
+            return await self.backplane.publish(user_id, message)
+        except (BackplaneError, OSError) as e:
+            logger.error(f"Error routing message to user {user_id} via backplane: {e}")
+            return False
+
+    async def publish_many(self, user_ids: List[int], message: Union[str, MessagePayload]) -> Set[int]:
+        try:
+            return await self.backplane.publish_many(user_ids, message)
+        except (BackplaneError, OSError) as e:
+            logger.error(f"Error routing message to {len(user_ids)} users via backplane: {e}")
+            return set()
+
+    async def send_personal_message(self, message: Union[str, MessagePayload], user_id: int) -> bool:
+        if user_id in self.active_connections:
+            delivered = self.enqueue(user_id, message)
+            # Устройства пользователя на других узлах получают копию через бэкплейн
+            if self.has_remote_devices(user_id):
+                delivered = await self.publish(user_id, message) and delivered
+            return delivered
+        if self.backplane:
+            return await self.publish(user_id, message)
+        logger.debug("No active connection for user %s", user_id)
+        return False
+
+    async def send_local_message(self, user_id: int, message: Union[str, MessagePayload]) -> bool:
+        return self.enqueue(user_id, message)
+
+    async def broadcast(self, message: Union[str, MessagePayload], user_ids: Iterable[int]) -> List[int]:
+        # Локальным получателям — постановка в очередь без ожидания, остальным — одна публикация на всех:
+        # бэкплейн определяет их присутствие одним запросом на рассылку
+        local: Dict[int, bool] = {}
+        remote = []
+        for user_id in user_ids:
+            if user_id in self.active_connections:
+                local[user_id] = self.enqueue(user_id, message)
+                if self.has_remote_devices(user_id):
+                    remote.append(user_id)
+            elif self.backplane:
+                remote.append(user_id)
+        if not remote:
+            return [user_id for user_id, accepted in local.items() if accepted]
+        # Доставлено — если приняли все устройства: и локальные, и на других узлах
+        confirmed = await self.publish_many(remote, message)
+        published = set(remote)
+        delivered = [
+            user_id for user_id, accepted in local.items()
+            if accepted and (user_id in confirmed or user_id not in published)
+        ]
+        delivered.extend(user_id for user_id in remote if user_id in confirmed and user_id not in local)
+        return delivered
+
+    def enqueue(self, user_id: int, message: Union[str, MessagePayload]) -> bool:
+        connections = self.get_connections(user_id)
+        if not connections:
+            logger.debug("No active connection for user %s", user_id)
+            return False
+        # Кадр кодируется один раз на формат и переиспользуется для всех устройств пользователя
+        frames = {}
+        # Доставлено, только если кадр принят всеми устройствами: иначе курсор и статус доставки
+        # прошли бы сообщение, и устройство с переполненной очередью его бы не получило
+        delivered = True
+        for connection in connections:
+            frame = frames.get(connection.encoding)
+            if frame is None:
+                with metrics.serialization_seconds.time():
+                    frame = frames[connection.encoding] = connection.encode(message)
+            if self.offer(connection, frame):
+                if isinstance(message, MessagePayload):
+                    connection.accepted_up_to = max(connection.accepted_up_to, message.data["message_id"])
+                continue
+            delivered = False
+            if isinstance(message, MessagePayload):
+                connection.spilled_message_id = max(connection.spilled_message_id, message.data["message_id"])
+        return delivered
+
+    def offer(self, connection: Connection, frame: Union[str, bytes]) -> bool:
+        if connection.offer(frame):
+            metrics.messages_out.inc()
+            return True
+
+        if self.slow_consumer_policy == POLICY_DROP:
+            # Теряется самый старый кадр, новый встает в очередь
+            connection.drop_oldest()
+            self.dropped_total += 1
+            metrics.frames_dropped.inc()
+            if connection.offer(frame):
+                metrics.messages_out.inc()
                 return True
-            except WebSocketDisconnect:
-                await self.disconnect(user_id)
-                return False
-            except Exception as e:
-                logger.error(f"Error sending message to user {user_id}: {e}")
-                await self.disconnect(user_id)
-                return False
-        else:
-            logger.info(f"No active connection for user {user_id}")
             return False
+        if self.slow_consumer_policy == POLICY_DISCONNECT:
+            self.slow_disconnects_total += 1
+            metrics.slow_consumer_disconnects.inc()
+            logger.warning(f"Disconnecting slow consumer {connection.user_id}: send queue is full")
+            task = asyncio.create_task(self.run_disconnect(connection))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return False
+        # spill: сообщение остается недоставленным, курсор и статус доставки его не проходят,
+        # а досылка соединения отправит его, когда в очереди появится место
+        self.spilled_total += 1
+        metrics.frames_spilled.inc()
+        self.start_replay(connection)
+        return False
 
-def get_user(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user(db: AsyncSession, username: str):
+    result = await db.execute(select(User).filter(User.username == username))
+    return result.scalars().first()
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt выполняется в пуле password_hasher; при переполнении очереди — HasherOverloaded (503)
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify(plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = get_user(db, username)
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await get_user(db, username)
+    # Соединение возвращается в пул до проверки пароля, которая может ждать в очереди
+    await db.close()
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await verify_password(password, user.hashed_password):
         return False
     return user
 
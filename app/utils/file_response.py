@@ -0,0 +1,154 @@
+import mmap
+import os
+import re
+from email.utils import formatdate
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+
+FILE_CHUNK_SIZE = int(os.getenv("FILE_CHUNK_SIZE", str(256 * 1024)))
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Открываются в браузере только медиа; SVG может содержать скрипты и отдается вложением
+INLINE_MEDIA_PREFIXES = ("image/", "audio/", "video/")
+ATTACHMENT_MEDIA_TYPES = ("image/svg+xml",)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Один диапазон bytes=a-b, bytes=a- или bytes=-n; несколько диапазонов игнорируются."""
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if first == "" and last == "":
+        return None
+    if first == "":
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def content_disposition(media_type: str, filename: str) -> str:
+    inline = media_type.startswith(INLINE_MEDIA_PREFIXES) and media_type not in ATTACHMENT_MEDIA_TYPES
+    return f"{'inline' if inline else 'attachment'}; filename*=utf-8''{quote(filename)}"
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    weak = etag[2:] if etag.startswith("W/") else etag
+    return any(candidate in (etag, weak, f"W/{weak}") for candidate in candidates)
+
+
+class MediaFileResponse(Response):
+    """
+    Отдача файла с поддержкой Range и условных запросов. Если сервер поддерживает
+    расширение ASGI http.response.zerocopysend, файл уходит через sendfile,
+    иначе читается через mmap частями по FILE_CHUNK_SIZE в пуле потоков.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            etag: str,
+            media_type: str,
+            filename: str,
+            range_header: Optional[str] = None,
+            if_none_match: Optional[str] = None,
+            if_range: Optional[str] = None
+    ):
+        self.path = path
+        self.media_type = media_type
+        self.background = None
+        self.body = b""
+
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.range = None
+        status_code = 200
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": etag,
+            "last-modified": formatdate(stat.st_mtime, usegmt=True),
+            "cache-control": "private, max-age=31536000, immutable",
+            "content-disposition": content_disposition(media_type, filename),
+            # Браузер не должен угадывать тип по содержимому: загруженный HTML не исполнится
+            "x-content-type-options": "nosniff",
+        }
+
+        if etag_matches(if_none_match, etag):
+            status_code = 304
+        else:
+            # If-Range с устаревшим ETag означает «отдай файл целиком»
+            if range_header and (if_range is None or etag_matches(if_range, etag)):
+                try:
+                    self.range = parse_range(range_header, self.size)
+                except RangeNotSatisfiable:
+                    status_code = 416
+                    headers["content-range"] = f"bytes */{self.size}"
+            if self.range is not None:
+                status_code = 206
+                start, end = self.range
+                headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+
+        self.status_code = status_code
+        if status_code in (200, 206):
+            start, end = self.range or (0, self.size - 1)
+            self.offset, self.count = start, max(0, end - start + 1)
+            headers["content-length"] = str(self.count)
+        else:
+            self.offset, self.count = 0, 0
+            if status_code == 416:
+                headers["content-length"] = "0"
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.count == 0 or scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as handle:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": handle,
+                    "offset": self.offset,
+                    "count": self.count,
+                })
+            return
+
+        handle = await run_in_threadpool(open, self.path, "rb")
+        try:
+            mapped = await run_in_threadpool(mmap.mmap, handle.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                position, end = self.offset, self.offset + self.count
+                while position < end:
+                    next_position = min(end, position + FILE_CHUNK_SIZE)
+                    chunk = await run_in_threadpool(mapped.__getitem__, slice(position, next_position))
+                    position = next_position
+                    await send({"type": "http.response.body", "body": chunk, "more_body": position < end})
+            finally:
+                mapped.close()
+        finally:
+            await run_in_threadpool(handle.close)
@@ -0,0 +1,89 @@
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from typing import NamedTuple, Optional
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(200 * 1024 * 1024)))
+
+DEFAULT_MEDIA_TYPE = "application/octet-stream"
+MEDIA_TYPE_RE = re.compile(r"^[a-z0-9][a-z0-9!#$&^_.+-]*/[a-z0-9][a-z0-9!#$&^_.+-]*$")
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class StoredBlob(NamedTuple):
+    file_url: str
+    content_hash: str
+    size: int
+    created: bool
+
+
+def blob_path(content_hash: str) -> str:
+    # Раскладка по первым двум символам хэша, чтобы не копить миллионы файлов в одной директории
+    return os.path.join(MEDIA_ROOT, "blobs", content_hash[:2], content_hash)
+
+
+def upload_media_type(filename: Optional[str], declared: Optional[str]) -> str:
+    """Тип содержимого для записи в uploaded_files: заявленный клиентом, иначе по расширению имени."""
+    for candidate in (declared, mimetypes.guess_type(filename or "")[0]):
+        media_type = (candidate or "").split(";")[0].strip().lower()
+        if MEDIA_TYPE_RE.match(media_type) and media_type != DEFAULT_MEDIA_TYPE:
+            return media_type
+    return DEFAULT_MEDIA_TYPE
+
+
+def _write_chunk(handle, hasher, chunk: bytes):
+    hasher.update(chunk)
+    handle.write(chunk)
+
+
+def _commit_blob(temp_path: str, content_hash: str) -> bool:
+    path = blob_path(content_hash)
+    if os.path.exists(path):
+        os.remove(temp_path)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+    return True
+
+
+async def store_upload(file: UploadFile, max_size: int = MAX_UPLOAD_SIZE) -> StoredBlob:
+    """
+    Потоковая запись загрузки во временный файл по UPLOAD_CHUNK_SIZE с подсчетом SHA-256,
+    затем перенос в хранилище по хэшу. Запись на диск выполняется вне цикла событий.
+    Если такой блоб уже есть, временный файл удаляется и возвращается существующий путь.
+    """
+    temp_dir = os.path.join(MEDIA_ROOT, "tmp")
+    await run_in_threadpool(os.makedirs, temp_dir, exist_ok=True)
+    handle = await run_in_threadpool(tempfile.NamedTemporaryFile, dir=temp_dir, delete=False)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise UploadTooLarge(f"Upload exceeds {max_size} bytes")
+            await run_in_threadpool(_write_chunk, handle, hasher, chunk)
+        await run_in_threadpool(handle.close)
+
+        content_hash = hasher.hexdigest()
+        created = await run_in_threadpool(_commit_blob, handle.name, content_hash)
+        return StoredBlob(blob_path(content_hash), content_hash, size, created)
+    except BaseException:
+        await run_in_threadpool(handle.close)
+        if os.path.exists(handle.name):
+            await run_in_threadpool(os.remove, handle.name)
+        raise
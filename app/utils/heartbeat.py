@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional
+
+from utils import metrics
+
+if TYPE_CHECKING:
+    from utils.connection_manager import Connection
+
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд тишины от клиента отправляется ping
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "30"))
+# Через сколько секунд тишины соединение считается мертвым и закрывается
+HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "75"))
+# Шаг колеса таймеров: точность срабатывания проверок
+HEARTBEAT_TICK = float(os.getenv("HEARTBEAT_TICK", "1"))
+
+PING_FRAME = json.dumps({"action": "ping"})
+
+
+class HeartbeatMonitor:
+    """
+    Проверка живости WebSocket-соединений одним колесом таймеров на весь процесс.
+
+    Каждое соединение лежит в одной ячейке колеса — в момент следующей проверки.
+    Входящие кадры только обновляют last_activity, соединение между ячейками при этом
+    не переносится: при срабатывании ячейки проверка переназначается от последней
+    активности. После HEARTBEAT_INTERVAL тишины клиенту уходит ping, после
+    HEARTBEAT_TIMEOUT соединение закрывается через reap.
+    """
+
+    def __init__(
+            self,
+            offer: Callable[["Connection", str], bool],
+            reap: Callable[["Connection"], Awaitable[None]],
+            interval: float = HEARTBEAT_INTERVAL,
+            timeout: float = HEARTBEAT_TIMEOUT,
+            tick: float = HEARTBEAT_TICK
+    ):
+        self.offer = offer
+        self.reap = reap
+        self.interval = interval
+        self.timeout = max(timeout, interval)
+        self.tick = tick
+        # Ячеек хватает на самый дальний срок, поэтому колесо не делает полных оборотов вхолостую
+        self.slots: List[Dict["Connection", None]] = [{} for _ in range(math.ceil(self.timeout / tick) + 2)]
+        self.current_tick = 0
+        self.task: Optional[asyncio.Task] = None
+
+        self.pings_total = 0
+        self.reaped_total = 0
+
+    def tick_of(self, moment: float) -> int:
+        return math.ceil(moment / self.tick)
+
+    def place(self, connection: "Connection", due: float):
+        # Срок не раньше следующего шага и не дальше размера колеса
+        due_tick = min(max(self.tick_of(due), self.current_tick + 1), self.current_tick + len(self.slots) - 1)
+        slot = due_tick % len(self.slots)
+        self.slots[slot][connection] = None
+        connection.heartbeat_slot = slot
+
+    def track(self, connection: "Connection"):
+        connection.touch()
+        self.place(connection, connection.last_activity + self.interval)
+
+    def untrack(self, connection: "Connection"):
+        if connection.heartbeat_slot is not None:
+            self.slots[connection.heartbeat_slot].pop(connection, None)
+        connection.heartbeat_slot = None
+
+    def start(self):
+        if self.task is None:
+            self.current_tick = self.tick_of(time.monotonic())
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(max(0.0, (self.current_tick + 1) * self.tick - time.monotonic()))
+            # После задержки цикла событий отрабатываем все пропущенные шаги
+            now_tick = self.tick_of(time.monotonic())
+            while self.current_tick < now_tick:
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % len(self.slots)]
+                if slot:
+                    due, self.slots[self.current_tick % len(self.slots)] = slot, {}
+                    await self.check(due)
+
+    async def check(self, connections: Dict["Connection", None]):
+        now = time.monotonic()
+        for connection in connections:
+            if connection.heartbeat_slot is None:
+                # Соединение закрылось, пока проверялись предыдущие
+                continue
+            connection.heartbeat_slot = None
+            idle = now - connection.last_activity
+            if idle >= self.timeout:
+                self.reaped_total += 1
+                metrics.connections_reaped.inc()
+                logger.info(f"Closing idle connection of user {connection.user_id} after {idle:.0f}s of silence")
+                try:
+                    await self.reap(connection)
+                except Exception as e:
+                    logger.error(f"Error closing idle connection of user {connection.user_id}: {e}")
+                continue
+            if idle >= self.interval:
+                # Один ping на период тишины, следующая проверка — уже на закрытие
+                if connection.pinged_at < connection.last_activity:
+                    connection.pinged_at = now
+                    self.pings_total += 1
+                    self.offer(connection, PING_FRAME)
+                self.place(connection, connection.last_activity + self.timeout)
+            else:
+                self.place(connection, connection.last_activity + self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "tracked": sum(len(slot) for slot in self.slots),
+            "pings_total": self.pings_total,
+            "reaped_total": self.reaped_total,
+        }
@@ -0,0 +1,132 @@
+import heapq
+import json
+import os
+from typing import AsyncIterator, Optional
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import Message
+from utils.archive import ColdScope, archive_store
+from utils.message_serializer import message_to_dict
+
+
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "1000"))
+HISTORY_STREAM_BATCH = int(os.getenv("HISTORY_STREAM_BATCH", "500"))
+
+
+def apply_id_bounds(query: Select, before_id: Optional[int], after_id: Optional[int]) -> Select:
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+    return query
+
+
+async def fetch_history_page(
+        db: AsyncSession,
+        query: Select,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        cold: Optional[ColdScope] = None
+) -> list:
+    """
+    Страница истории по ключу id. С after_id — первые limit сообщений после него,
+    иначе — последние limit сообщений перед before_id. Результат всегда по возрастанию id.
+    С cold страница дополняется из архива, если архивные сообщения попадают в ее диапазон.
+    """
+    limit = min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE)
+    query = apply_id_bounds(query, before_id, after_id)
+    if after_id is not None:
+        result = await db.execute(query.order_by(Message.id.asc()).limit(limit))
+        messages = result.scalars().all()
+    else:
+        result = await db.execute(query.order_by(Message.id.desc()).limit(limit))
+        messages = result.scalars().all()[::-1]
+    page = [message_to_dict(message) for message in messages]
+    if cold is None:
+        return page
+
+    # Полная горячая страница сужает диапазон, где архив еще может что-то добавить
+    low, high = after_id, before_id
+    if len(page) == limit:
+        if after_id is not None:
+            high = page[-1]["id"] if high is None else min(high, page[-1]["id"])
+        else:
+            low = page[0]["id"] if low is None else max(low, page[0]["id"])
+    archived = await archive_store.read_range(db, cold, low, high, limit, descending=after_id is None)
+    if not archived:
+        return page
+    merged = sorted(page + archived, key=lambda record: record["id"])
+    return merged[:limit] if after_id is not None else merged[-limit:]
+
+
+async def merge_by_id(first: AsyncIterator[dict], second: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    # Слияние двух потоков, упорядоченных по возрастанию id
+    left, right = await anext(first, None), await anext(second, None)
+    while left is not None or right is not None:
+        if right is None or (left is not None and left["id"] <= right["id"]):
+            yield left
+            left = await anext(first, None)
+        else:
+            yield right
+            right = await anext(second, None)
+
+
+async def tail_start(query: Select, before_id: Optional[int], limit: int, cold: Optional[ColdScope]) -> Optional[int]:
+    # id, после которого начинаются последние limit сообщений (горячих и архивных); None — отдать все
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(query.with_only_columns(Message.id).order_by(Message.id.desc()).limit(limit))
+        ids = result.scalars().all()
+        if cold is not None:
+            low = ids[-1] if len(ids) == limit else None
+            archived = await archive_store.read_range(db, cold, low, before_id, limit, descending=True)
+            ids = heapq.nlargest(limit, ids + [record["id"] for record in archived])
+    if len(ids) < limit:
+        return None
+    return min(ids) - 1
+
+
+def stream_history(
+        query: Select,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        limit: Optional[int] = None,
+        cold: Optional[ColdScope] = None
+) -> StreamingResponse:
+    """
+    История потоком NDJSON по возрастанию id. Границы те же, что у fetch_history_page:
+    с limit и без after_id — последние limit сообщений перед before_id.
+    """
+    query = apply_id_bounds(query, before_id, after_id)
+
+    async def hot_records(low: Optional[int]):
+        bounded = query if low is None else query.filter(Message.id > low)
+        bounded = bounded.order_by(Message.id.asc()).limit(limit)
+        # Сессия зависимости get_db закрывается до отправки тела ответа, поэтому своя
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(bounded.execution_options(yield_per=HISTORY_STREAM_BATCH))
+            async for message in result.scalars():
+                yield message_to_dict(message)
+
+    async def rows():
+        low = after_id
+        if limit is not None and after_id is None:
+            low = await tail_start(query, before_id, limit, cold)
+        hot = hot_records(low)
+        records = hot if cold is None else merge_by_id(hot, archive_store.iterate(cold, low, before_id))
+        sent = 0
+        try:
+            async for record in records:
+                if limit is not None and sent >= limit:
+                    break
+                sent += 1
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+        finally:
+            await hot.aclose()
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
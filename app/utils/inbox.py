@@ -0,0 +1,169 @@
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import case, func, literal_column, null, or_, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_engine
+from models import Chat, ChatParticipant, ConversationSummary, Message
+
+
+INBOX_PAGE_SIZE = int(os.getenv("INBOX_PAGE_SIZE", "50"))
+INBOX_MAX_PAGE_SIZE = int(os.getenv("INBOX_MAX_PAGE_SIZE", "500"))
+INBOX_PREVIEW_LENGTH = int(os.getenv("INBOX_PREVIEW_LENGTH", "100"))
+
+
+def preview_of(message: Message) -> Optional[str]:
+    return message.content[:INBOX_PREVIEW_LENGTH] if message.content else None
+
+
+def summary_upsert():
+    # ON CONFLICT есть у обоих диалектов, но конструкция у каждого своя
+    dialect = postgresql if async_engine.dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(ConversationSummary)
+    excluded = statement.excluded
+    newer = excluded.last_message_id > ConversationSummary.last_message_id
+
+    def latest(column):
+        return case((newer, excluded[column.key]), else_=column)
+
+    return statement.on_conflict_do_update(
+        index_elements=[ConversationSummary.user_id, ConversationSummary.peer_id],
+        set_={
+            "last_message_id": latest(ConversationSummary.last_message_id),
+            "last_sender_id": latest(ConversationSummary.last_sender_id),
+            "preview": latest(ConversationSummary.preview),
+            "last_message_at": latest(ConversationSummary.last_message_at),
+            "unread_count": ConversationSummary.unread_count + excluded.unread_count,
+        }
+    )
+
+
+async def record_messages(db: AsyncSession, messages: Iterable[Message]):
+    """
+    Обновляет сводки переписок в транзакции, записывающей сообщения (id уже должны быть известны).
+    Личное сообщение — upsert строк отправителя и получателя, групповое — последнее
+    сообщение в chats и счетчики непрочитанного участников.
+    """
+    summaries: Dict[Tuple[int, int], dict] = {}
+    chat_last: Dict[int, Message] = {}
+    # (chat_id, sender_id) -> id сообщений пачки
+    chat_unread: Dict[Tuple[int, int], List[int]] = {}
+
+    for message in sorted(messages, key=lambda message: message.id):
+        if message.chat_id is not None:
+            chat_last[message.chat_id] = message
+            chat_unread.setdefault((message.chat_id, message.sender_id), []).append(message.id)
+            continue
+        if message.receiver_id is None:
+            continue
+        for user_id, peer_id, unread in (
+                (message.sender_id, message.receiver_id, 0),
+                (message.receiver_id, message.sender_id, 1),
+        ):
+            # Сообщение самому себе дает одну строку, поэтому строки копятся по ключу
+            row = summaries.get((user_id, peer_id))
+            if row is None:
+                row = summaries[(user_id, peer_id)] = {"user_id": user_id, "peer_id": peer_id, "unread_count": 0}
+            row.update(
+                last_message_id=message.id,
+                last_sender_id=message.sender_id,
+                preview=preview_of(message),
+                last_message_at=message.timestamp,
+            )
+            row["unread_count"] += unread
+
+    if summaries:
+        await db.execute(summary_upsert(), list(summaries.values()))
+
+    for chat_id, message in chat_last.items():
+        await db.execute(update(Chat).filter(
+            Chat.id == chat_id,
+            or_(Chat.last_message_id.is_(None), Chat.last_message_id < message.id)
+        ).values(
+            last_message_id=message.id,
+            last_sender_id=message.sender_id,
+            last_preview=preview_of(message),
+            last_message_at=message.timestamp,
+        ).execution_options(synchronize_session=False))
+
+    for (chat_id, sender_id), message_ids in chat_unread.items():
+        # Участник, уже прочитавший сообщения (при отложенной записи это возможно до коммита), не получает их в счетчик
+        await db.execute(update(ChatParticipant).filter(
+            ChatParticipant.chat_id == chat_id,
+            ChatParticipant.user_id != sender_id,
+            ChatParticipant.last_read_message_id < message_ids[0]
+        ).values(unread_count=ChatParticipant.unread_count + len(message_ids))
+        .execution_options(synchronize_session=False))
+
+
+async def mark_direct_read(db: AsyncSession, user_id: int, read_counts: Dict[int, int]):
+    # read_counts: отправитель -> сколько его сообщений пользователь прочитал в этом сбросе
+    for peer_id, count in read_counts.items():
+        await db.execute(update(ConversationSummary).filter(
+            ConversationSummary.user_id == user_id,
+            ConversationSummary.peer_id == peer_id
+        ).values(unread_count=case(
+            (ConversationSummary.unread_count > count, ConversationSummary.unread_count - count),
+            else_=0
+        )).execution_options(synchronize_session=False))
+
+
+def chat_unread_after(chat_id: int, user_id: int, message_id: int):
+    # Непрочитанное после нового курсора пересчитывается по индексу (chat_id, id), счетчик не расходится с курсором
+    return select(func.count(Message.id)).filter(
+        Message.chat_id == chat_id,
+        Message.receiver_id.is_(None),
+        Message.id > message_id,
+        Message.sender_id != user_id
+    ).scalar_subquery()
+
+
+async def fetch_inbox(db: AsyncSession, user_id: int, limit: Optional[int] = None, offset: int = 0) -> list:
+    """Список переписок пользователя одним запросом: личные и групповые, новые сверху."""
+    limit = min(limit or INBOX_PAGE_SIZE, INBOX_MAX_PAGE_SIZE)
+    direct = select(
+        literal_column("'direct'").label("kind"),
+        ConversationSummary.peer_id.label("peer_id"),
+        null().label("chat_id"),
+        null().label("name"),
+        ConversationSummary.last_message_id.label("last_message_id"),
+        ConversationSummary.last_sender_id.label("last_sender_id"),
+        ConversationSummary.preview.label("preview"),
+        ConversationSummary.last_message_at.label("last_message_at"),
+        ConversationSummary.unread_count.label("unread_count"),
+        ConversationSummary.last_message_id.label("sort_key"),
+    ).filter(ConversationSummary.user_id == user_id)
+    chats = select(
+        literal_column("'chat'"),
+        null(),
+        Chat.id,
+        Chat.name,
+        Chat.last_message_id,
+        Chat.last_sender_id,
+        Chat.last_preview,
+        Chat.last_message_at,
+        ChatParticipant.unread_count,
+        # Чаты без сообщений — в конце списка
+        func.coalesce(Chat.last_message_id, 0),
+    ).join(Chat, Chat.id == ChatParticipant.chat_id).filter(ChatParticipant.user_id == user_id)
+
+    query = union_all(direct, chats).order_by(
+        literal_column("sort_key").desc(), literal_column("kind"), literal_column("peer_id"), literal_column("chat_id")
+    ).limit(limit).offset(offset)
+    result = await db.execute(query)
+    return [
+        {
+            "kind": row.kind,
+            "peer_id": row.peer_id,
+            "chat_id": row.chat_id,
+            "name": row.name,
+            "last_message_id": row.last_message_id,
+            "last_sender_id": row.last_sender_id,
+            "preview": row.preview,
+            "last_message_at": row.last_message_at.isoformat() if row.last_message_at else None,
+            "unread_count": row.unread_count,
+        }
+        for row in result.all()
+    ]
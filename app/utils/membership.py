@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+from typing import Dict, FrozenSet, Iterable, Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import Chat, ChatParticipant
+from utils.backplane import Backplane
+from utils.ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", "50000"))
+# Страховка на случай потерянного события инвалидации
+MEMBERSHIP_CACHE_TTL = float(os.getenv("MEMBERSHIP_CACHE_TTL", "60"))
+
+EVENT_MEMBERSHIP = "membership"
+
+
+async def bump_membership_version(db: AsyncSession, chat_id: int) -> int:
+    # Вызывать в транзакции, меняющей состав чата
+    result = await db.execute(
+        update(Chat).filter(Chat.id == chat_id)
+        .values(membership_version=Chat.membership_version + 1)
+        .returning(Chat.membership_version)
+        .execution_options(synchronize_session=False)
+    )
+    return result.scalar_one()
+
+
+class MembershipIndex:
+    """
+    Кэш состава чатов в памяти процесса: chat_id -> участники и user_id -> чаты.
+    Изменения записываются сквозь кэш, остальные узлы получают событие с новой версией
+    состава через бэкплейн и сбрасывают устаревшие записи.
+    """
+
+    def __init__(
+            self,
+            backplane: Optional[Backplane] = None,
+            size: int = MEMBERSHIP_CACHE_SIZE,
+            ttl: float = MEMBERSHIP_CACHE_TTL
+    ):
+        self.backplane = backplane
+        # chat_id -> (версия, участники или None, если чата нет)
+        self.chats = TTLCache(size, ttl)
+        self.user_chats = TTLCache(size, ttl)
+        # Последняя версия из событий: не дает сохранить результат загрузки, начатой до изменения
+        self.seen_versions = TTLCache(size, ttl)
+        self.loading: Dict[int, asyncio.Future] = {}
+        if backplane:
+            backplane.add_event_handler(self.handle_event)
+
+    async def participants(self, chat_id: int, db: Optional[AsyncSession] = None) -> Optional[FrozenSet[int]]:
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            entry = await self.load_chat(chat_id, db)
+        return entry[1]
+
+    async def is_member(self, chat_id: int, user_id: int, db: Optional[AsyncSession] = None) -> bool:
+        members = await self.participants(chat_id, db)
+        return members is not None and user_id in members
+
+    async def chats_of(self, user_id: int, db: Optional[AsyncSession] = None) -> FrozenSet[int]:
+        chat_ids = self.user_chats.get(user_id)
+        if chat_ids is None:
+            if db is None:
+                async with AsyncSessionLocal() as session:
+                    chat_ids = await self.fetch_user_chats(session, user_id)
+            else:
+                chat_ids = await self.fetch_user_chats(db, user_id)
+            self.user_chats.set(user_id, chat_ids)
+        return chat_ids
+
+    async def load_chat(self, chat_id: int, db: Optional[AsyncSession]) -> tuple:
+        # Одновременные промахи по одному чату ждут один запрос
+        future = self.loading.get(chat_id)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.loading[chat_id] = future
+        try:
+            if db is None:
+                async with AsyncSessionLocal() as session:
+                    entry = await self.fetch_chat(session, chat_id)
+            else:
+                entry = await self.fetch_chat(db, chat_id)
+            if entry[0] >= self.seen_versions.get(chat_id, -1):
+                self.chats.set(chat_id, entry)
+            future.set_result(entry)
+            return entry
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, повторно из future его не поднимаем
+            future.exception()
+            raise
+        finally:
+            del self.loading[chat_id]
+
+    @staticmethod
+    async def fetch_chat(db: AsyncSession, chat_id: int) -> tuple:
+        result = await db.execute(
+            select(Chat.membership_version, ChatParticipant.user_id)
+            .select_from(Chat)
+            .outerjoin(ChatParticipant, ChatParticipant.chat_id == Chat.id)
+            .filter(Chat.id == chat_id)
+        )
+        rows = result.all()
+        if not rows:
+            return -1, None
+        return rows[0][0], frozenset(user_id for _, user_id in rows if user_id is not None)
+
+    @staticmethod
+    async def fetch_user_chats(db: AsyncSession, user_id: int) -> FrozenSet[int]:
+        result = await db.execute(select(ChatParticipant.chat_id).filter(ChatParticipant.user_id == user_id))
+        return frozenset(result.scalars().all())
+
+    async def chat_changed(self, chat_id: int, version: int, members: Iterable[int], changed_user_ids: Iterable[int]):
+        """Сквозная запись после коммита изменения состава и рассылка события остальным узлам."""
+        changed_user_ids = list(changed_user_ids)
+        self.apply_change(chat_id, version, changed_user_ids)
+        self.chats.set(chat_id, (version, frozenset(members)))
+        if self.backplane:
+            try:
+                await self.backplane.broadcast({
+                    "type": EVENT_MEMBERSHIP,
+                    "chat_id": chat_id,
+                    "version": version,
+                    "user_ids": changed_user_ids,
+                })
+            except Exception as e:
+                logger.error(f"Error broadcasting membership change of chat {chat_id}: {e}")
+
+    def apply_change(self, chat_id: int, version: int, user_ids: Iterable[int]):
+        self.seen_versions.set(chat_id, max(version, self.seen_versions.get(chat_id, -1)))
+        entry = self.chats.peek(chat_id)
+        if entry is not None and entry[0] < version:
+            self.chats.pop(chat_id)
+        for user_id in user_ids:
+            self.user_chats.pop(user_id)
+
+    async def handle_event(self, event: dict):
+        if event.get("type") == EVENT_MEMBERSHIP:
+            self.apply_change(event["chat_id"], event["version"], event.get("user_ids", []))
+
+    def stats(self) -> dict:
+        return {"chats": self.chats.stats(), "users": self.user_chats.stats()}
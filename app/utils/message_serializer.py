@@ -1,16 +1,107 @@
+import json
+from typing import Optional, Union
+
 from models import Message
-from schemas import MessageSchema
-
-
-def serialize_message(message: Message) -> str:
-    message_data = MessageSchema(
-        message_id=message.id,
-        sender_id=message.sender_id,
-        receiver_id=message.receiver_id,
-        chat_id=message.chat_id,
-        content=message.content,
-        content_type=message.content_type,
-        timestamp=message.timestamp,
-        file_url=message.file_url
-    )
-    return message_data.json()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+
+RECEIVER_PLACEHOLDER = '"receiver_id":null'
+
+
+def dumps(data) -> str:
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def negotiate_encoding(requested: Optional[str]) -> str:
+    if requested == ENCODING_MSGPACK and msgpack is not None:
+        return ENCODING_MSGPACK
+    return ENCODING_JSON
+
+
+class MessagePayload:
+    """
+    Сообщение, закодированное один раз для всех получателей рассылки.
+    Поля совпадают с MessageSchema; receiver_id подставляется для каждого
+    получателя без повторной сериализации.
+    """
+
+    __slots__ = ("data", "json_parts", "msgpack_cache")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.json_parts = None
+        self.msgpack_cache = None
+
+    @classmethod
+    def from_message(cls, message: Message) -> "MessagePayload":
+        return cls({
+            "action": "new_message",
+            "message_id": message.id,
+            "sender_id": message.sender_id,
+            "receiver_id": message.receiver_id,
+            "chat_id": message.chat_id,
+            "content": message.content,
+            "content_type": message.content_type.value,
+            "timestamp": message.timestamp.isoformat() if message.timestamp else None,
+            "file_url": message.file_url,
+        })
+
+    def json(self, receiver_id: Optional[int] = None) -> str:
+        if self.json_parts is None:
+            encoded = dumps(dict(self.data, receiver_id=None))
+            prefix, _, suffix = encoded.partition(RECEIVER_PLACEHOLDER)
+            self.json_parts = (prefix + '"receiver_id":', suffix)
+        if receiver_id is None:
+            receiver_id = self.data["receiver_id"]
+        prefix, suffix = self.json_parts
+        return prefix + ("null" if receiver_id is None else str(int(receiver_id))) + suffix
+
+    def as_dict(self, receiver_id: Optional[int] = None) -> dict:
+        if receiver_id is None:
+            return self.data
+        return dict(self.data, receiver_id=receiver_id)
+
+    def msgpack(self, receiver_id: Optional[int] = None) -> bytes:
+        # В групповой рассылке receiver_id у каждого свой, кэшируется только исходный вариант
+        if receiver_id is None or receiver_id == self.data["receiver_id"]:
+            if self.msgpack_cache is None:
+                self.msgpack_cache = msgpack.packb(self.data)
+            return self.msgpack_cache
+        return msgpack.packb(self.as_dict(receiver_id))
+
+    def encode(self, encoding: str, receiver_id: Optional[int] = None) -> Union[str, bytes]:
+        if encoding == ENCODING_MSGPACK:
+            return self.msgpack(receiver_id)
+        return self.json(receiver_id)
+
+
+def serialize_message(message: Message, receiver_id: Optional[int] = None) -> str:
+    return MessagePayload.from_message(message).json(receiver_id)
+
+
+def message_to_dict(message: Message) -> dict:
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "chat_id": message.chat_id,
+        "content": message.content,
+        "content_type": message.content_type.value,
+        "timestamp": message.timestamp.isoformat() if message.timestamp else None,
+        "status": message.status.value if message.status else None,
+        "file_url": message.file_url,
+    }
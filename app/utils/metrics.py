@@ -0,0 +1,194 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.children: Dict[Tuple[str, ...], "Metric"] = {}
+
+    def labels(self, *values) -> "Metric":
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.new_child()
+        return child
+
+    @abstractmethod
+    def new_child(self) -> "Metric":
+        pass
+
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], str, float]]:
+        # (суффикс имени, значения меток, дополнительная метка, значение)
+        if not self.label_names:
+            return [(suffix, (), extra, value) for suffix, extra, value in self.own_samples()]
+        return [
+            (suffix, key, extra, value)
+            for key, child in self.children.items()
+            for suffix, extra, value in child.own_samples()
+        ]
+
+    @abstractmethod
+    def own_samples(self):
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(self.label_names, values, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def new_child(self) -> "Counter":
+        return Counter(self.name, self.help_text)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set_function(self, function: Callable[[], float]):
+        # Счетчик, который ведет другой компонент (например, попадания кэша): читается при запросе /metrics
+        self.function = function
+
+    def own_samples(self):
+        return [("", "", self.function() if self.function else self.value)]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text)
+        self.value = 0.0
+        self.function = function
+
+    def new_child(self) -> "Gauge":
+        return Gauge(self.name, self.help_text)
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        # Значение вычисляется при каждом запросе /metrics
+        self.function = function
+
+    def own_samples(self):
+        return [("", "", self.function() if self.function else self.value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def new_child(self) -> "Histogram":
+        return Histogram(self.name, self.help_text, self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at)
+
+    def own_samples(self):
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            samples.append(("_bucket", f'le="{format_value(bound)}"', cumulative))
+        samples.append(("_sum", "", self.sum))
+        samples.append(("_count", "", self.count))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help_text, function))
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS, label_names: Sequence[str] = ()) -> Histogram:
+        return self.register(Histogram(name, help_text, buckets, label_names))
+
+    def render(self) -> str:
+        # Текстовый формат Prometheus 0.0.4
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
+
+active_connections = registry.gauge("chat_active_connections", "Open WebSocket connections on this process")
+messages_in = registry.counter("chat_messages_in_total", "Messages accepted from senders", ["kind"])
+messages_out = registry.counter("chat_messages_out_total", "Frames queued to local WebSocket connections")
+connections_reaped = registry.counter("chat_connections_reaped_total", "Connections closed by the heartbeat after a period of silence")
+frames_dropped = registry.counter("chat_frames_dropped_total", "Frames dropped by the slow consumer policy")
+frames_spilled = registry.counter("chat_frames_spilled_total", "Frames left for backlog replay because the send queue was full")
+slow_consumer_disconnects = registry.counter("chat_slow_consumer_disconnects_total", "Connections closed because their send queue was full")
+queued_frames = registry.gauge("chat_queued_frames", "Frames waiting in send queues of local connections")
+fanout_size = registry.histogram("chat_fanout_size", "Recipients per group message", SIZE_BUCKETS)
+serialization_seconds = registry.histogram("chat_serialization_seconds", "Time to encode a frame for one connection")
+db_commit_seconds = registry.histogram("chat_db_commit_seconds", "Duration of DB commits on the message path", label_names=["path"])
+retry_pending = registry.gauge("chat_retry_pending", "Messages waiting for a scheduled resend")
+retry_parked = registry.gauge("chat_retry_parked", "Resends parked until the receiver reconnects")
+backlog_replay_seconds = registry.histogram("chat_backlog_replay_seconds", "Time to replay the offline backlog on connect")
+backlog_replayed = registry.counter("chat_backlog_replayed_total", "Messages replayed from the offline backlog")
+auth_cache_hits = registry.counter("chat_auth_cache_hits_total", "Token checks served from the verified claims cache")
+auth_cache_misses = registry.counter("chat_auth_cache_misses_total", "Token checks that had to decode the JWT")
+auth_cache_size = registry.gauge("chat_auth_cache_size", "Entries in the verified claims cache")
+auth_user_cache_hits = registry.counter("chat_auth_user_cache_hits_total", "User lookups served from the user cache")
+auth_user_cache_misses = registry.counter("chat_auth_user_cache_misses_total", "User lookups that had to query the database")
+auth_user_cache_size = registry.gauge("chat_auth_user_cache_size", "Entries in the resolved user cache")
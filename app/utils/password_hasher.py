@@ -0,0 +1,55 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Сколько проверок может ждать в очереди сверх работающих, дальше — отказ
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+class HasherOverloaded(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Хэширование и проверка паролей bcrypt в отдельном ограниченном пуле потоков,
+    чтобы не блокировать цикл событий. bcrypt отпускает GIL, поэтому потоков достаточно.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_limit: int = PASSWORD_HASH_QUEUE_LIMIT):
+        self.workers = workers
+        self.limit = workers + queue_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self.in_flight = 0
+        self.rejected = 0
+
+    async def run(self, func, *args):
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            raise HasherOverloaded(f"{self.in_flight} password operations in flight")
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.run(pwd_context.verify, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self.run(pwd_context.hash, password)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "in_flight": self.in_flight, "rejected": self.rejected}
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import func, insert, select, text
+
+from database import AsyncSessionLocal, async_engine
+from models import Message, direct_conversation_key
+from utils import metrics
+from utils.backlog import advance_delivery_cursors
+from utils.inbox import record_messages
+
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_PIPELINE = os.getenv("PERSISTENCE_PIPELINE", "0").lower() in ("1", "true", "yes")
+PERSIST_BATCH_WINDOW_MS = float(os.getenv("PERSIST_BATCH_WINDOW_MS", "5"))
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "500"))
+PERSIST_ID_BLOCK = int(os.getenv("PERSIST_ID_BLOCK", "1000"))
+
+
+class IdAllocator:
+    """
+    Выдача id сообщений до вставки. В PostgreSQL id резервируются блоком из последовательности
+    messages, в SQLite отсчитываются от MAX(id) — это корректно только при одном процессе-писателе.
+    """
+
+    def __init__(self, block_size: int = PERSIST_ID_BLOCK):
+        self.block_size = block_size
+        self.ids: List[int] = []
+        self.next_local_id: Optional[int] = None
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def next_id(self) -> int:
+        if self.ids:
+            return self.ids.pop()
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.ids:
+                self.ids = list(reversed(await self.reserve()))
+            return self.ids.pop()
+
+    async def reserve(self) -> List[int]:
+        async with AsyncSessionLocal() as db:
+            if async_engine.dialect.name == "postgresql":
+                result = await db.execute(text(
+                    "SELECT nextval(pg_get_serial_sequence('messages', 'id')) FROM generate_series(1, :count)"
+                ), {"count": self.block_size})
+                return sorted(result.scalars().all())
+            if self.next_local_id is None:
+                result = await db.execute(select(func.max(Message.id)))
+                self.next_local_id = (result.scalar() or 0) + 1
+        start, self.next_local_id = self.next_local_id, self.next_local_id + self.block_size
+        return list(range(start, self.next_local_id))
+
+
+class PendingWrite:
+    __slots__ = ("message", "delivered_to", "notify_sender", "client_id", "future")
+
+    def __init__(self, message: Message, delivered_to: List[int], notify_sender: bool, client_id, future):
+        self.message = message
+        self.delivered_to = delivered_to
+        self.notify_sender = notify_sender
+        self.client_id = client_id
+        self.future = future
+
+
+def message_row(message: Message) -> dict:
+    conversation_key = None
+    if message.chat_id is None and message.receiver_id is not None:
+        conversation_key = direct_conversation_key(message.sender_id, message.receiver_id)
+    return {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "chat_id": message.chat_id,
+        "content": message.content,
+        "content_type": message.content_type,
+        "timestamp": message.timestamp,
+        "status": message.status,
+        "file_url": message.file_url,
+        "conversation_key": conversation_key,
+    }
+
+
+class PersistencePipeline:
+    """
+    Отложенная запись сообщений группами. Сообщение получает id сразу и доставляется
+    до записи, а в БД попадает вместе с остальными за окно PERSIST_BATCH_WINDOW_MS:
+    один INSERT на всю пачку с уже итоговым статусом, курсоры доставки групп и один коммит.
+    После коммита отправитель получает кадр persisted.
+    """
+
+    def __init__(
+            self,
+            notify: Callable[[str, int], Awaitable[bool]],
+            on_committed: Callable[[List[Message]], Awaitable[None]],
+            window_ms: float = PERSIST_BATCH_WINDOW_MS,
+            batch_size: int = PERSIST_BATCH_SIZE
+    ):
+        self.notify = notify
+        self.on_committed = on_committed
+        self.window = window_ms / 1000
+        self.batch_size = batch_size
+        self.allocator = IdAllocator()
+        self.queue: List[PendingWrite] = []
+        # Выданные id, чья запись еще не завершилась: по ним подтверждения ждут коммита
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closing = False
+
+        self.batches_total = 0
+        self.messages_total = 0
+        self.failed_total = 0
+
+    async def allocate_id(self) -> int:
+        message_id = await self.allocator.next_id()
+        self.pending[message_id] = asyncio.get_running_loop().create_future()
+        return message_id
+
+    def release(self, message_id: int):
+        # Сообщение с выданным id не дошло до submit: ожидающие его не должны висеть
+        future = self.pending.pop(message_id, None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    async def wait_persisted(self, message_ids: Iterable[int]):
+        """
+        Ждет завершения записи сообщений, которые уже доставлены, но еще не закоммичены:
+        подтверждение, применяемое раньше коммита, не нашло бы строку и потерялось.
+        """
+        futures = [self.pending[message_id] for message_id in message_ids if message_id in self.pending]
+        if futures:
+            await asyncio.wait(futures)
+
+    def submit(
+            self,
+            message: Message,
+            delivered_to: List[int] = (),
+            notify_sender: bool = False,
+            client_id=None
+    ) -> asyncio.Future:
+        future = self.pending.get(message.id) or asyncio.get_running_loop().create_future()
+        self.queue.append(PendingWrite(message, list(delivered_to), notify_sender, client_id, future))
+        self.wakeup.set()
+        return future
+
+    def start(self):
+        if self.task is None:
+            self.closing = False
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Все принятое до остановки должно попасть в БД: цикл дописывает очередь и завершается
+        if self.task:
+            self.closing = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            # Ждем окно, чтобы собрать пачку, но не дольше, чем до ее заполнения
+            if len(self.queue) < self.batch_size and not self.closing:
+                await asyncio.sleep(self.window)
+            while self.queue:
+                await self.write_next_batch()
+            if self.closing:
+                return
+
+    async def write_next_batch(self):
+        batch, self.queue = self.queue[:self.batch_size], self.queue[self.batch_size:]
+        try:
+            await self.write_batch(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                await self.fail(batch, e)
+                return
+            # Одна плохая строка (например, чат удален после проверки) не должна ронять всю пачку:
+            # сообщения пишутся по одному, отказ получают только те, что не записались
+            logger.warning(f"Error persisting batch of {len(batch)} messages, writing them one by one: {e}")
+            committed = []
+            for write in sorted(batch, key=lambda write: write.message.id):
+                try:
+                    await self.write_batch([write])
+                except Exception as e:
+                    await self.fail([write], e)
+                else:
+                    committed.append(write)
+            if committed:
+                await self.succeed(committed)
+            return
+        await self.succeed(batch)
+
+    async def fail(self, batch: List[PendingWrite], error: Exception):
+        self.failed_total += len(batch)
+        logger.error(f"Error persisting batch of {len(batch)} messages: {error}")
+        for write in batch:
+            self.pending.pop(write.message.id, None)
+            if not write.future.done():
+                write.future.set_exception(error)
+                write.future.exception()
+        await self.notify_senders(batch, "persist_failed")
+
+    async def succeed(self, batch: List[PendingWrite]):
+        self.batches_total += 1
+        self.messages_total += len(batch)
+        for write in batch:
+            self.pending.pop(write.message.id, None)
+            if not write.future.done():
+                write.future.set_result(write.message.id)
+        await self.notify_senders(batch, "persisted")
+        try:
+            await self.on_committed([write.message for write in batch])
+        except Exception as e:
+            logger.error(f"Error in post-commit handling of {len(batch)} messages: {e}")
+
+    async def write_batch(self, batch: List[PendingWrite]):
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(Message), [message_row(write.message) for write in batch])
+            await record_messages(db, [write.message for write in batch])
+            # Курсоры доставки групп — по сообщениям в порядке id, чтобы каждое следующее
+            # продолжало уже сдвинутые курсоры
+            for write in sorted(batch, key=lambda write: write.message.id):
+                message = write.message
+                if message.chat_id is not None:
+                    await advance_delivery_cursors(
+                        db, message.chat_id, message.id, write.delivered_to + [message.sender_id]
+                    )
+            with metrics.db_commit_seconds.labels("batch").time():
+                await db.commit()
+
+    async def notify_senders(self, batch: List[PendingWrite], action: str):
+        by_sender: Dict[int, list] = {}
+        for write in batch:
+            if write.notify_sender:
+                entry = {"message_id": write.message.id}
+                if write.client_id is not None:
+                    entry["client_id"] = write.client_id
+                by_sender.setdefault(write.message.sender_id, []).append(entry)
+        for sender_id, messages in by_sender.items():
+            await self.notify(json.dumps({"action": action, "messages": messages}), sender_id)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.queue),
+            "batches_total": self.batches_total,
+            "messages_total": self.messages_total,
+            "failed_total": self.failed_total,
+        }
@@ -0,0 +1,204 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select, update
+
+from database import AsyncSessionLocal
+from models import Message, MessageStatus
+from utils import metrics
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = float(os.getenv("RETRY_DELAY", "10"))
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BATCH_SIZE = int(os.getenv("RETRY_BATCH_SIZE", "500"))
+RETRY_MAX_CONCURRENCY = int(os.getenv("RETRY_MAX_CONCURRENCY", "50"))
+RETRY_MAX_PENDING = int(os.getenv("RETRY_MAX_PENDING", "100000"))
+
+
+class RetryScheduler:
+    """
+    Единая очередь повторной отправки сообщений без подтверждения.
+
+    Повторы хранятся в куче по времени срабатывания, один фоновый цикл забирает
+    все наступившие повторы, загружает сообщения одним запросом и рассылает их
+    с ограничением параллельности. Повторы для пользователей, которые заведомо
+    офлайн, откладываются до их подключения.
+    """
+
+    def __init__(
+            self,
+            send: Callable[[Message], Awaitable[bool]],
+            offline_users: Callable[[Iterable[int]], Awaitable[Set[int]]],
+            delay: float = RETRY_DELAY,
+            attempts: int = RETRY_ATTEMPTS,
+            batch_size: int = RETRY_BATCH_SIZE,
+            max_concurrency: int = RETRY_MAX_CONCURRENCY,
+            max_pending: int = RETRY_MAX_PENDING
+    ):
+        self.send = send
+        self.offline_users = offline_users
+        self.delay = delay
+        self.attempts = attempts
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_concurrency = max_concurrency
+        # Примитивы asyncio создаются в start(), в цикле событий, где будет работать планировщик
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+        # (время срабатывания, порядковый номер, message_id, receiver_id, попытка)
+        self.heap: List[Tuple[float, int, int, int, int]] = []
+        self.pending: Dict[int, int] = {}
+        self.parked: Dict[int, Dict[int, int]] = {}
+        # Подключившиеся, пока шел запрос присутствия: их повторы не откладываются
+        self.resumed: Set[int] = set()
+        self.sequence = itertools.count()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+        self.scheduled_total = 0
+        self.resent_total = 0
+        self.delivered_total = 0
+        self.dropped_total = 0
+        self.batches_total = 0
+
+    @property
+    def parked_count(self) -> int:
+        return sum(len(entries) for entries in self.parked.values())
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "parked": self.parked_count,
+            "scheduled_total": self.scheduled_total,
+            "resent_total": self.resent_total,
+            "delivered_total": self.delivered_total,
+            "dropped_total": self.dropped_total,
+            "batches_total": self.batches_total,
+        }
+
+    def schedule(self, message_id: int, receiver_id: int, attempt: int = 0, due: Optional[float] = None):
+        if message_id in self.pending or attempt >= self.attempts:
+            return
+        if len(self.pending) + self.parked_count >= self.max_pending:
+            self.dropped_total += 1
+            logger.warning(f"Retry queue is full, message {message_id} left for backlog replay")
+            return
+        due = due if due is not None else time.monotonic() + self.delay
+        self.pending[message_id] = attempt
+        heapq.heappush(self.heap, (due, next(self.sequence), message_id, receiver_id, attempt))
+        self.scheduled_total += 1
+        if self.heap[0][2] == message_id and self.wakeup:
+            self.wakeup.set()
+
+    def resume(self, receiver_id: int):
+        self.resumed.add(receiver_id)
+        entries = self.parked.pop(receiver_id, None)
+        if not entries:
+            return
+        # Даем клиенту время подтвердить сообщения, досланные при подключении
+        due = time.monotonic() + self.delay
+        for message_id, attempt in entries.items():
+            self.schedule(message_id, receiver_id, attempt, due)
+
+    def start(self):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            timeout = self.heap[0][0] - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = self.pop_due()
+            if not due:
+                continue
+            try:
+                due = await self.park_offline(due)
+                if due:
+                    await self.process(due)
+            except Exception as e:
+                logger.error(f"Error processing retry batch of {len(due)} messages: {e}")
+                for message_id, receiver_id, attempt in due:
+                    self.schedule(message_id, receiver_id, attempt + 1)
+
+    def pop_due(self) -> List[Tuple[int, int, int]]:
+        now = time.monotonic()
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            _, _, message_id, receiver_id, attempt = heapq.heappop(self.heap)
+            self.pending.pop(message_id, None)
+            due.append((message_id, receiver_id, attempt))
+        return due
+
+    async def park_offline(self, due: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+        # Присутствие получателей пачки — одним запросом; повторы офлайн-получателей ждут их подключения
+        self.resumed.clear()
+        offline = await self.offline_users({receiver_id for _, receiver_id, _ in due})
+        offline -= self.resumed
+        if not offline:
+            return due
+        remaining = []
+        for message_id, receiver_id, attempt in due:
+            if receiver_id in offline:
+                self.parked.setdefault(receiver_id, {})[message_id] = attempt
+            else:
+                remaining.append((message_id, receiver_id, attempt))
+        return remaining
+
+    async def process(self, due: List[Tuple[int, int, int]]):
+        self.batches_total += 1
+        attempts = {message_id: attempt for message_id, _, attempt in due}
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(Message).filter(
+                Message.id.in_(attempts.keys()),
+                Message.status != MessageStatus.READ
+            ))
+            messages = result.scalars().all()
+
+            async def resend(message: Message) -> bool:
+                async with self.semaphore:
+                    return await self.send(message)
+
+            results = await asyncio.gather(*(resend(message) for message in messages))
+            self.resent_total += len(messages)
+
+            delivered = [message.id for message, ok in zip(messages, results) if ok]
+            if delivered:
+                self.delivered_total += len(delivered)
+                await db.execute(update(Message).filter(
+                    Message.id.in_(delivered),
+                    Message.status == MessageStatus.SENT
+                ).values(status=MessageStatus.DELIVERED))
+                with metrics.db_commit_seconds.labels("retry").time():
+                    await db.commit()
+
+        # Как и раньше, повторяем до прочтения или исчерпания попыток
+        for message in messages:
+            self.schedule(message.id, message.receiver_id, attempts[message.id] + 1)
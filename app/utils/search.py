@@ -0,0 +1,237 @@
+import logging
+import math
+import os
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal, async_engine
+from models import Message
+from utils.message_serializer import message_to_dict
+
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "100"))
+# Конфигурация полнотекстового поиска PostgreSQL; должна совпадать с выражением индекса
+SEARCH_TS_CONFIG = os.getenv("SEARCH_TS_CONFIG", "simple")
+SEARCH_BUILD_BATCH = int(os.getenv("SEARCH_BUILD_BATCH", "5000"))
+
+BACKEND_POSTGRESQL = "postgresql"
+BACKEND_FTS5 = "fts5"
+BACKEND_MEMORY = "memory"
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+if not re.fullmatch(r"[a-z_]+", SEARCH_TS_CONFIG):
+    raise ValueError(f"Invalid SEARCH_TS_CONFIG: {SEARCH_TS_CONFIG}")
+
+# Внешнее содержимое: FTS5 хранит только индекс, текст берется из messages по rowid
+FTS5_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content); END",
+)
+
+POSTGRESQL_SCHEMA = (
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_search ON messages "
+    f"USING GIN (to_tsvector('{SEARCH_TS_CONFIG}', coalesce(content, '')))"
+)
+
+# Область поиска: личные переписки пользователя и групповые сообщения его чатов
+SCOPE_SQL = (
+    "((m.chat_id IS NULL AND (m.sender_id = :user_id OR m.receiver_id = :user_id)) "
+    "OR (m.chat_id IN :chat_ids AND m.receiver_id IS NULL))"
+)
+
+# bm25 тем меньше, чем лучше совпадение; в ответе rank у всех бэкендов растет с релевантностью
+FTS5_QUERY = text(
+    "SELECT m.id, -bm25(messages_fts) AS rank FROM messages_fts "
+    "JOIN messages m ON m.id = messages_fts.rowid "
+    f"WHERE messages_fts MATCH :match AND {SCOPE_SQL} "
+    "ORDER BY rank DESC, m.id DESC LIMIT :limit OFFSET :offset"
+).bindparams(bindparam("chat_ids", expanding=True))
+
+POSTGRESQL_QUERY = text(
+    f"SELECT m.id, ts_rank(to_tsvector('{SEARCH_TS_CONFIG}', coalesce(m.content, '')), query) AS rank "
+    f"FROM messages m, plainto_tsquery('{SEARCH_TS_CONFIG}', :q) AS query "
+    f"WHERE to_tsvector('{SEARCH_TS_CONFIG}', coalesce(m.content, '')) @@ query AND {SCOPE_SQL} "
+    "ORDER BY rank DESC, m.id DESC LIMIT :limit OFFSET :offset"
+).bindparams(bindparam("chat_ids", expanding=True))
+
+
+def tokenize(content: Optional[str]) -> List[str]:
+    return TOKEN_RE.findall(content.lower()) if content else []
+
+
+def fts5_match(tokens: Iterable[str]) -> str:
+    # Каждый терм в кавычках: пользовательский ввод не разбирается как синтаксис FTS5, термы объединяются через AND
+    return " ".join('"' + token.replace('"', '""') + '"' for token in tokens)
+
+
+def create_search_schema(conn) -> Optional[str]:
+    """
+    Создает структуры поиска, если их нет. Возвращает бэкенд или None,
+    если СУБД их не поддерживает (SQLite без FTS5) и остается индекс в памяти.
+    """
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(POSTGRESQL_SCHEMA))
+        return BACKEND_POSTGRESQL
+    if conn.dialect.name != "sqlite":
+        return None
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )).first()
+    try:
+        for statement in FTS5_SCHEMA:
+            conn.execute(text(statement))
+    except OperationalError as e:
+        logger.warning(f"SQLite FTS5 is not available, falling back to in-memory search index: {e}")
+        return None
+    if not exists:
+        # Индексируем уже существующие сообщения
+        conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+    return BACKEND_FTS5
+
+
+class InvertedIndex:
+    """
+    Инвертированный индекс в памяти процесса для СУБД без полнотекстового поиска:
+    терм -> {message_id: число вхождений}. Строится при старте и пополняется после
+    коммита новых сообщений; корректен только при одном процессе-писателе.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, int]] = {}
+        # message_id -> (chat_id, sender_id, receiver_id) для проверки области поиска
+        self.scopes: Dict[int, Tuple[Optional[int], int, Optional[int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.scopes)
+
+    def add(self, message_id: int, content: Optional[str], chat_id: Optional[int], sender_id: int, receiver_id: Optional[int]):
+        if message_id in self.scopes:
+            return
+        tokens = tokenize(content)
+        if not tokens:
+            return
+        self.scopes[message_id] = (chat_id, sender_id, receiver_id)
+        for token in tokens:
+            postings = self.postings.setdefault(token, {})
+            postings[message_id] = postings.get(message_id, 0) + 1
+
+    def in_scope(self, message_id: int, user_id: int, chat_ids: FrozenSet[int]) -> bool:
+        chat_id, sender_id, receiver_id = self.scopes[message_id]
+        if chat_id is None:
+            return user_id in (sender_id, receiver_id)
+        return receiver_id is None and chat_id in chat_ids
+
+    def search(self, tokens: List[str], user_id: int, chat_ids: FrozenSet[int], limit: int, offset: int) -> List[Tuple[int, float]]:
+        postings = [self.postings.get(token) for token in set(tokens)]
+        if not postings or not all(postings):
+            return []
+        postings.sort(key=len)
+        candidates = [message_id for message_id in postings[0] if all(message_id in other for other in postings[1:])]
+
+        # TF-IDF: редкие термы весят больше
+        total = len(self.scopes)
+        weights = [math.log(1 + total / len(entries)) for entries in postings]
+        hits = [
+            (message_id, sum(weight * entries[message_id] for weight, entries in zip(weights, postings)))
+            for message_id in candidates
+            if self.in_scope(message_id, user_id, chat_ids)
+        ]
+        hits.sort(key=lambda hit: (-hit[1], -hit[0]))
+        return hits[offset:offset + limit]
+
+
+class SearchIndex:
+    """
+    Поиск по истории в пределах переписок пользователя. Индекс поддерживает СУБД
+    (FTS5 с триггерами в SQLite, GIN по tsvector в PostgreSQL), без них — InvertedIndex,
+    который пополняется через add_messages после коммита.
+    """
+
+    def __init__(self):
+        self.backend: Optional[str] = None
+        self.memory: Optional[InvertedIndex] = None
+
+    async def start(self, backend: Optional[str] = None):
+        if backend is None:
+            async with async_engine.begin() as conn:
+                backend = await conn.run_sync(create_search_schema)
+        self.backend = backend or BACKEND_MEMORY
+        if self.backend == BACKEND_MEMORY:
+            self.memory = InvertedIndex()
+            await self.build_memory_index()
+        logger.info(f"Message search backend: {self.backend}")
+
+    async def build_memory_index(self):
+        after_id = 0
+        async with AsyncSessionLocal() as db:
+            while True:
+                result = await db.execute(
+                    select(Message.id, Message.content, Message.chat_id, Message.sender_id, Message.receiver_id)
+                    .filter(Message.id > after_id, Message.content.isnot(None))
+                    .order_by(Message.id)
+                    .limit(SEARCH_BUILD_BATCH)
+                )
+                rows = result.all()
+                if not rows:
+                    break
+                for row in rows:
+                    self.memory.add(*row)
+                after_id = rows[-1][0]
+        logger.info(f"Built in-memory search index over {len(self.memory)} messages")
+
+    def add_messages(self, messages: Iterable[Message]):
+        # Для FTS5 и PostgreSQL индекс обновляет сама СУБД
+        if self.memory is None:
+            return
+        for message in messages:
+            self.memory.add(message.id, message.content, message.chat_id, message.sender_id, message.receiver_id)
+
+    async def search(
+            self,
+            db: AsyncSession,
+            q: str,
+            user_id: int,
+            chat_ids: FrozenSet[int],
+            limit: Optional[int] = None,
+            offset: int = 0
+    ) -> list:
+        limit = min(limit or SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        tokens = tokenize(q)
+        if not tokens:
+            return []
+
+        params = {"user_id": user_id, "chat_ids": list(chat_ids), "limit": limit, "offset": offset}
+        if self.backend == BACKEND_FTS5:
+            hits = (await db.execute(FTS5_QUERY, {**params, "match": fts5_match(tokens)})).all()
+        elif self.backend == BACKEND_POSTGRESQL:
+            hits = (await db.execute(POSTGRESQL_QUERY, {**params, "q": q})).all()
+        else:
+            hits = self.memory.search(tokens, user_id, chat_ids, limit, offset)
+        if not hits:
+            return []
+
+        result = await db.execute(select(Message).filter(Message.id.in_([message_id for message_id, _ in hits])))
+        messages = {message.id: message for message in result.scalars()}
+        return [
+            {**message_to_dict(messages[message_id]), "rank": rank}
+            for message_id, rank in hits
+            if message_id in messages
+        ]
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "indexed": len(self.memory) if self.memory is not None else None}